@@ -0,0 +1,225 @@
+import datetime
+
+import ckan.plugins.toolkit as tk
+
+from . import daputil, jobs
+
+# The most package or resource ids one dapr_access_counts call may ask for.
+MAX_IDS = 1000
+
+# The most buckets one dapr_access_series call may return, and the days
+# it covers by default.
+MAX_SERIES_BUCKETS = 1000
+DEFAULT_SERIES_DAYS = 90
+
+
+def _date_range_schema():
+    ignore_missing = tk.get_validator('ignore_missing')
+    isodate = tk.get_validator('isodate')
+    return {
+        'start_date': [ignore_missing, isodate],
+        'end_date': [ignore_missing, isodate],
+    }
+
+def access_counts_schema():
+    ignore_missing = tk.get_validator('ignore_missing')
+    as_list = tk.get_validator('convert_to_list_if_string')
+    list_of_strings = tk.get_validator('list_of_strings')
+    schema = _date_range_schema()
+    schema.update({
+        'package_ids': [ignore_missing, as_list, list_of_strings],
+        'resource_ids': [ignore_missing, as_list, list_of_strings],
+    })
+    return schema
+
+def top_schema():
+    default = tk.get_validator('default')
+    natural_number = tk.get_validator('natural_number_validator')
+    schema = _date_range_schema()
+    schema.update({
+        'limit': [default(daputil.DEFAULT_TOP_NUMBER), natural_number],
+    })
+    return schema
+
+def access_series_schema():
+    ignore_missing = tk.get_validator('ignore_missing')
+    default = tk.get_validator('default')
+    one_of = tk.get_validator('one_of')
+    unicode_safe = tk.get_validator('unicode_safe')
+    schema = _date_range_schema()
+    schema.update({
+        'package_id': [ignore_missing, unicode_safe],
+        'resource_id': [ignore_missing, unicode_safe],
+        'interval': [default('day'), one_of(list(daputil.INTERVALS))],
+    })
+    return schema
+
+def _check_date_range(start_date, end_date):
+    if start_date is not None and end_date is not None and start_date > end_date:
+        raise tk.ValidationError({'start_date': ['The start date is after the end date.']})
+
+def _validate(context, data_dict, schema):
+    data, errors = tk.navl_validate(data_dict, schema, context)
+    if errors:
+        raise tk.ValidationError(errors)
+    for name in ('start_date', 'end_date'):
+        # isodate gives datetimes, but the access tables hold dates.
+        if data.get(name) is not None:
+            data[name] = data[name].date()
+    _check_date_range(data.get('start_date', None), data.get('end_date', None))
+    return data
+
+@tk.side_effect_free
+def dapr_access_counts(context, data_dict):
+    '''Return the DAP access counts of several packages or resources over an
+    optional date range, each computed in one grouped query.
+
+    :param package_ids: ids of the packages to count accesses of
+    :type package_ids: list of strings
+    :param resource_ids: ids of the resources to count accesses of
+    :type resource_ids: list of strings
+    :param start_date: count accesses from this date, YYYY-mm-dd (optional)
+    :type start_date: string
+    :param end_date: count accesses up to this date, YYYY-mm-dd (optional)
+    :type end_date: string
+
+    :returns: a dictionary with ``packages`` and ``resources`` keys for the
+        kinds of ids given, each mapping every id to its access count
+    :rtype: dictionary
+    '''
+    tk.check_access('dapr_access_counts', context, data_dict)
+    data = _validate(context, data_dict, access_counts_schema())
+    package_ids = data.get('package_ids', None)
+    resource_ids = data.get('resource_ids', None)
+    if not package_ids and not resource_ids:
+        raise tk.ValidationError({'package_ids': ['Give package_ids or resource_ids.']})
+    for name, ids in (('package_ids', package_ids), ('resource_ids', resource_ids)):
+        if ids and len(ids) > MAX_IDS:
+            raise tk.ValidationError({name: [f'At most {MAX_IDS} ids can be given.']})
+
+    start_date = data.get('start_date', None)
+    end_date = data.get('end_date', None)
+    result = {}
+    if package_ids:
+        result['packages'] = daputil.package_accesses(package_ids, start_date, end_date)
+    if resource_ids:
+        result['resources'] = daputil.resource_accesses(resource_ids, start_date, end_date)
+    return result
+
+@tk.side_effect_free
+def dapr_top_packages(context, data_dict):
+    '''Return the most accessed packages over an optional date range, most accessed first.
+
+    :param start_date: count accesses from this date, YYYY-mm-dd (optional)
+    :type start_date: string
+    :param end_date: count accesses up to this date, YYYY-mm-dd (optional)
+    :type end_date: string
+    :param limit: the number of packages to return (optional, default: 20, at most 100)
+    :type limit: int
+
+    :rtype: list of dictionaries with ``package_id`` and ``access_count``
+    '''
+    tk.check_access('dapr_top_packages', context, data_dict)
+    data = _validate(context, data_dict, top_schema())
+    limit = min(data['limit'], daputil.MAX_TOP_NUMBER)
+    top = daputil.top_packages(data.get('start_date', None), data.get('end_date', None), limit)
+    return [{'package_id': row.package_id, 'access_count': row.access_count} for row in top]
+
+@tk.side_effect_free
+def dapr_top_resources(context, data_dict):
+    '''Return the most accessed resources over an optional date range, most accessed first.
+
+    :param start_date: count accesses from this date, YYYY-mm-dd (optional)
+    :type start_date: string
+    :param end_date: count accesses up to this date, YYYY-mm-dd (optional)
+    :type end_date: string
+    :param limit: the number of resources to return (optional, default: 20, at most 100)
+    :type limit: int
+
+    :rtype: list of dictionaries with ``resource_id``, ``package_id`` and ``access_count``
+    '''
+    tk.check_access('dapr_top_resources', context, data_dict)
+    data = _validate(context, data_dict, top_schema())
+    limit = min(data['limit'], daputil.MAX_TOP_NUMBER)
+    top = daputil.top_resources(data.get('start_date', None), data.get('end_date', None), limit)
+    return [{'resource_id': row.resource_id, 'package_id': row.package_id,
+        'access_count': row.access_count} for row in top]
+
+@tk.side_effect_free
+def dapr_access_series(context, data_dict):
+    '''Return the DAP access counts of a package, a resource or the whole site
+    per day, week or month, with zero counts for buckets without accesses.
+
+    :param package_id: the id of the package to count accesses of (optional)
+    :type package_id: string
+    :param resource_id: the id of the resource to count accesses of (optional)
+    :type resource_id: string
+    :param start_date: the first day, YYYY-mm-dd (optional, default: 90 days
+        before the end date)
+    :type start_date: string
+    :param end_date: the last day, YYYY-mm-dd (optional, default: the latest
+        day with recorded accesses)
+    :type end_date: string
+    :param interval: ``day``, ``week`` or ``month`` (optional, default: ``day``)
+    :type interval: string
+
+    :rtype: list of dictionaries with ``date``, the first day of the bucket,
+        and ``count``
+    '''
+    tk.check_access('dapr_access_series', context, data_dict)
+    data = _validate(context, data_dict, access_series_schema())
+    end_date = data.get('end_date', None) or daputil.latest_resource_access() or datetime.date.today()
+    start_date = data.get('start_date', None) or end_date - datetime.timedelta(days=DEFAULT_SERIES_DAYS - 1)
+    _check_date_range(start_date, end_date)
+    if len(daputil.series_buckets(start_date, end_date, data['interval'])) > MAX_SERIES_BUCKETS:
+        raise tk.ValidationError({'interval': [f'At most {MAX_SERIES_BUCKETS} buckets can be returned.']})
+    series = daputil.access_series(start_date, end_date, data['interval'],
+        data.get('package_id', None), data.get('resource_id', None))
+    return [{'date': day.isoformat(), 'count': count} for day, count in series]
+
+@tk.side_effect_free
+def dapr_load_status(context, data_dict):
+    '''Return the status of the latest DAP load windows queued as background
+    jobs, latest first. Only sysadmins may see it.
+
+    :param limit: the number of windows to return (optional, default: 50)
+    :type limit: int
+
+    :rtype: list of dictionaries with ``id``, ``start_date``, ``end_date``,
+        ``status`` (queued, running, failed or done), ``pages``,
+        ``rows_written``, ``updated`` and ``error``
+    '''
+    tk.check_access('dapr_load_status', context, data_dict)
+    default = tk.get_validator('default')
+    natural_number = tk.get_validator('natural_number_validator')
+    data = _validate(context, data_dict, {'limit': [default(50), natural_number]})
+    return jobs.load_status(data['limit'])
+
+@tk.auth_allow_anonymous_access
+def access_statistics_auth(context, data_dict):
+    '''Access statistics are public, as on the resource pages and top datasets page.
+    '''
+    return {'success': True}
+
+def get_actions():
+    return {
+        'dapr_access_counts': dapr_access_counts,
+        'dapr_top_packages': dapr_top_packages,
+        'dapr_top_resources': dapr_top_resources,
+        'dapr_access_series': dapr_access_series,
+        'dapr_load_status': dapr_load_status,
+    }
+
+def load_status_auth(context, data_dict):
+    '''Only sysadmins, who pass every auth check, may see load progress.
+    '''
+    return {'success': False}
+
+def get_auth_functions():
+    return {
+        'dapr_access_counts': access_statistics_auth,
+        'dapr_top_packages': access_statistics_auth,
+        'dapr_top_resources': access_statistics_auth,
+        'dapr_access_series': access_statistics_auth,
+        'dapr_load_status': load_status_auth,
+    }
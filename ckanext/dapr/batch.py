@@ -0,0 +1,129 @@
+import array
+import datetime
+
+
+class AccessBatch(object):
+    '''Matched download records held in compact columns until they are written.
+
+    Each record takes a code for its resource and package id pair, the
+    ordinal of its date and its count, in typed arrays of 16 bytes a
+    record, instead of a dictionary of a few hundred bytes. The id pairs
+    are kept once each however many records name them, and are shared by
+    the batches derived from this one, so clearing a batch between chunks
+    keeps them coded for the next pages.
+
+    >>> batch = AccessBatch()
+    >>> batch.append('res-1', 'pkg-1', datetime.date(2020, 5, 20), 5)
+    >>> batch.append('res-1', 'pkg-1', datetime.date(2020, 5, 20), 3)
+    >>> batch.append('res-2', 'pkg-1', datetime.date(2020, 6, 1), 1)
+    >>> len(batch), sorted(batch.resource_ids())
+    (3, ['res-1', 'res-2'])
+    >>> [(r['resource_id'], r['access_date'].isoformat(), r['access_count']) for r in batch.rows()]
+    [('res-1', '2020-05-20', 8), ('res-2', '2020-06-01', 1)]
+    '''
+
+    __slots__ = ('_ids', '_codes', '_ordinals', '_counts')
+
+    def __init__(self, ids = None):
+        # The (resource_id, package_id) pairs by code, and their codes.
+        self._ids = ids if ids is not None else ([], {})
+        self._codes = array.array('I')
+        self._ordinals = array.array('I')
+        self._counts = array.array('q')
+
+    @classmethod
+    def from_downloads(cls, downloads):
+        '''Build a batch from download dictionaries.
+        '''
+        batch = cls()
+        for d in downloads:
+            batch.append(d['resource_id'], d['package_id'], d['date'], d['count'])
+        return batch
+
+    def __len__(self):
+        return len(self._codes)
+
+    def _code(self, resource_id, package_id):
+        ids, codes = self._ids
+        key = (resource_id, package_id)
+        code = codes.get(key)
+        if code is None:
+            code = codes[key] = len(ids)
+            ids.append(key)
+        return code
+
+    def append(self, resource_id, package_id, day, count):
+        self._codes.append(self._code(resource_id, package_id))
+        self._ordinals.append(day.toordinal())
+        self._counts.append(count)
+
+    def extend(self, records):
+        '''Append (resource_id, package_id, date, count) records.
+        '''
+        for resource_id, package_id, day, count in records:
+            self.append(resource_id, package_id, day, count)
+
+    def clear(self):
+        '''Drop the records, keeping the coded ids for the next records.
+        '''
+        self._codes = array.array('I')
+        self._ordinals = array.array('I')
+        self._counts = array.array('q')
+
+    def nbytes(self):
+        '''The bytes taken by the record columns, not counting the shared ids.
+        '''
+        return sum(len(c) * c.itemsize for c in (self._codes, self._ordinals, self._counts))
+
+    def resource_ids(self):
+        ids = self._ids[0]
+        return {ids[code][0] for code in set(self._codes)}
+
+    def date_range(self):
+        '''The first and last date of the records, or None for an empty batch.
+        '''
+        if not self._ordinals:
+            return None
+        return (datetime.date.fromordinal(min(self._ordinals)),
+            datetime.date.fromordinal(max(self._ordinals)))
+
+    def months(self):
+        '''The first day of each month with records.
+        '''
+        return {datetime.date.fromordinal(o).replace(day=1) for o in set(self._ordinals)}
+
+    def _summed(self):
+        # Records for the same resource and date, such as the same file
+        # linked from several pages, are summed in first seen order.
+        summed = {}
+        for code, ordinal, count in zip(self._codes, self._ordinals, self._counts):
+            summed[code, ordinal] = summed.get((code, ordinal), 0) + count
+        return summed
+
+    def rows(self):
+        '''Generate a table row dictionary for each resource and date, made
+        only as the writer consumes them.
+        '''
+        ids = self._ids[0]
+        dates = {}
+        for (code, ordinal), count in self._summed().items():
+            day = dates.get(ordinal)
+            if day is None:
+                day = dates[ordinal] = datetime.date.fromordinal(ordinal)
+            resource_id, package_id = ids[code]
+            yield {'resource_id': resource_id, 'package_id': package_id, 'access_date': day,
+                'access_count': count}
+
+    def summed(self, keep = None):
+        '''A batch with one record per resource and date, holding their summed
+        count, sharing this batch's coded ids. When keep is given, only the
+        records for which keep(resource_id, date, count) is true are kept.
+        '''
+        ids = self._ids[0]
+        selected = AccessBatch(self._ids)
+        for (code, ordinal), count in self._summed().items():
+            if keep is None or keep(ids[code][0], datetime.date.fromordinal(ordinal), count):
+                selected._codes.append(code)
+                selected._ordinals.append(ordinal)
+                selected._counts.append(count)
+        return selected
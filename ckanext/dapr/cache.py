@@ -0,0 +1,81 @@
+import json
+import logging
+
+from ckan.lib.redis import connect_to_redis
+
+from . import reporting
+
+_log = logging.getLogger(__name__)
+
+_PREFIX = 'ckanext.dapr'
+_GENERATION_KEY = f'{_PREFIX}:generation'
+
+# Cached report results are kept for at most a day, so entries from earlier
+# generations expire on their own after a load invalidates them.
+DEFAULT_TTL = 24 * 60 * 60
+
+def _generation(redis):
+    return int(redis.get(_GENERATION_KEY) or 0)
+
+def _position_key(generation):
+    return f'{_PREFIX}:{generation}:position'
+
+def _replica_current(redis, generation):
+    # The reporting database holds the counts of a generation once it has
+    # replayed the primary's writes up to where the generation began.
+    key = _position_key(generation)
+    position = redis.get(key)
+    if position is None:
+        return True
+    if reporting.caught_up(position.decode()):
+        redis.delete(key)
+        return True
+    return False
+
+def cache_key(name, *args):
+    '''
+    >>> cache_key('top_packages', None, '2020-05-31', 20)
+    'top_packages:None:2020-05-31:20'
+    '''
+    return ':'.join([name] + [str(a) for a in args])
+
+def cached(key, compute, ttl = DEFAULT_TTL):
+    '''Return the JSON-serializable result of compute() from CKAN's Redis
+    store, computing and storing it if it is not there. Entries are scoped
+    to the current load generation, so invalidate() drops all of them at once.
+    Results computed on a reporting replica that has not caught up with the
+    load that began the generation are returned but not stored. Any Redis
+    error falls back to calling compute() directly.
+    '''
+    try:
+        redis = connect_to_redis()
+        generation = _generation(redis)
+        full_key = f'{_PREFIX}:{generation}:{key}'
+        value = redis.get(full_key)
+        if value is not None:
+            return json.loads(value)
+    except Exception:
+        _log.exception('Error reading DAP report cache.', extra={'Key': key})
+        return compute()
+
+    result = compute()
+    try:
+        if _replica_current(redis, generation):
+            redis.setex(full_key, ttl, json.dumps(result))
+    except Exception:
+        _log.exception('Error writing DAP report cache.', extra={'Key': key})
+    return result
+
+def invalidate():
+    '''Discard all cached report results, typically after a load commits new counts.
+    '''
+    try:
+        redis = connect_to_redis()
+        position = reporting.position()
+        if position is not None:
+            # Set before the generation begins, so no result of it is stored
+            # before the replica is checked.
+            redis.setex(_position_key(_generation(redis) + 1), DEFAULT_TTL, position)
+        redis.incr(_GENERATION_KEY)
+    except Exception:
+        _log.exception('Error invalidating DAP report cache.')
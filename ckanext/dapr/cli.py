@@ -1,23 +1,32 @@
 # encoding: utf-8
 import datetime
 import logging
+import multiprocessing
+import time
+from concurrent.futures import ProcessPoolExecutor
+
 import click
 
-from . import daputil
+import ckan.model as model
+
+from . import daputil, export, jobs, matching
+from .metrics import format_summary, metrics, publish_load
 
 log = logging.getLogger(__name__)
 
+_WINDOW_DAYS = {"day": 1, "week": 7}
+
 def get_commands():
     return [
-        dap
+        dapr
     ]
 
 
 @click.group()
-def dap():
+def dapr():
     pass
 
-@dap.command(short_help=u"Initialize the database for storing Digital Analytics Program analytics.")
+@dapr.command(short_help=u"Initialize the database for storing Digital Analytics Program analytics.")
 def init():
     """Initialise the local DAP analytics database tables
     """
@@ -27,31 +36,67 @@ def init():
     log.info("Set up DAP access tables in main database")
 
 
-@dap.command(short_help=u"Load resource access data from Digital Analytics Program API.")
+@dapr.command(short_help=u"Rebuild the monthly and all-time access count rollups.")
+def rollup():
+    """Recompute the rollup tables from all recorded daily access counts
+    """
+    daputil.refresh_downloads()
+    log.info("Rebuilt DAP access count rollups")
+
+
+@dapr.command(short_help=u"Load resource access data from Digital Analytics Program API.")
 @click.option("-s", "--start-date", required=False, help="Load events from this date forward (YYYY-mm-dd).")
 @click.option("-e", "--end-date", required=False, help="Load events up to this date (YYYY-mm-dd)")
-@click.option("-u", "--update", is_Flag=True, help="Load new events since last run.")
-def load(start_date: str = None, end_date: str = None, update: bool):
+@click.option("-u", "--update", is_flag=True,
+    help="Load new events since last run, and revisions of the days before it, writing only changed counts.")
+@click.option("--trailing-days", type=int, default=None,
+    help="Days before the last recorded event that --update loads again (ckanext.dapr.update_trailing_days).")
+@click.option("-r", "--resume", is_flag=True, help="Continue the loads that did not finish.")
+@click.option("-w", "--workers", type=int, default=1, help="Load date windows in this many parallel processes.")
+@click.option("--window", type=click.Choice(list(_WINDOW_DAYS)), default="week",
+    help="Size of the date windows loaded in parallel with --workers.")
+@click.option("--profile", is_flag=True, help="Print the time spent in each phase of the load.")
+@click.option("--from-cache", is_flag=True,
+    help="Match the raw DAP responses saved in ckanext.dapr.raw_cache_dir instead of calling the DAP API.")
+@click.option("--jobs", "as_jobs", is_flag=True,
+    help="Queue a background job per date window instead of loading in this process.")
+def load(start_date: str = None, end_date: str = None, update: bool = False, trailing_days: int = None,
+        resume: bool = False, workers: int = 1, window: str = "week", profile: bool = False,
+        from_cache: bool = False, as_jobs: bool = False):
     start_day = None
     end_day = None
-    if update:
-        # Retrieve the latest date recorded in the database event tracking table, and set
-        # that as the starting date for retrieval.
-        start_day = dap_util.latest_resource_access()
-        if start_day is None:
-            # No resource accesses recorded yet. Default to the date DAP was first mandated. 
-            try:
-                start_day = datetime.datetime.strptime(DAP_FIRST_DAY, '%Y-%m-%d')
-            except Exception:
-                log.exception('Error defaulting to start date %s. Load failed.', DAP_FIRST_DAY)
-                return
+    metrics.reset_load()
+    began = time.perf_counter()
+    if resume and as_jobs:
+        retried = jobs.retry_failed()
+        click.echo(f"Queued {len(retried)} failed DAP load window(s) again.")
+        return
+    if resume:
+        # Continue each interrupted load with its own date window and the
+        # page after the last one it wrote.
+        checkpoints = daputil.unfinished_checkpoints()
+        if not checkpoints:
+            log.info("No unfinished DAP load to resume.")
+            return
+        if workers > 1:
+            _backfill([(c.start_date, c.end_date, c.id, c.source) for c in checkpoints], workers)
+        else:
+            for checkpoint in checkpoints:
+                _load(checkpoint.start_date, checkpoint.end_date, checkpoint)
+        _report(profile, began)
+        return
+    elif update:
+        # Load again the trailing days before the latest date recorded, as
+        # DAP revises the counts of recent days, and every day since.
+        # Defaults to the date DAP was first mandated if nothing is recorded.
+        start_day = daputil.update_start_date(trailing_days)
     else:
         if start_date is None:
             # Not updating, but no start date specified. Default to the date DAP was first mandated.
             try: 
-                start_day = datetime.datetime.strptime(DAP_FIRST_DAY, '%Y-%m-%d')
+                start_day = datetime.datetime.strptime(daputil.DAP_FIRST_DAY, '%Y-%m-%d')
             except Exception:
-                log.exception('Error defaulting to start date %s. Load failed', DAP_FIRST_DAY)
+                log.exception('Error defaulting to start date %s. Load failed', daputil.DAP_FIRST_DAY)
                 return
         else:
             try:
@@ -66,11 +111,155 @@ def load(start_date: str = None, end_date: str = None, update: bool):
                 log.exception('Ignoring error interpreting end date %s', end_date)
 
     """Parse data from Digital Analytics Program API, cross-reference it
-    to package resources and get a list of resource access counts by date.
+    to package resources and record the resource access counts by date,
+    one chunk at a time.
     """
-    downloads = daputil.dap_retrieve(start_day, end_day)
+    source = daputil.SOURCE_CACHE if from_cache else daputil.SOURCE_API
+    if as_jobs:
+        queued = jobs.enqueue_windows(start_day, end_day or datetime.date.today(), _WINDOW_DAYS[window], source,
+            only_changed=update)
+        click.echo(f"Queued {len(queued)} DAP load window(s). Run ckan dapr status to follow them.")
+        return
+    if workers > 1:
+        end_day = end_day or datetime.date.today()
+        windows = daputil.date_windows(start_day, end_day, _WINDOW_DAYS[window])
+        _backfill([(ws, we, None, source) for ws, we in windows], workers, only_changed=update)
+    else:
+        _load(start_day, end_day, source=source, only_changed=update)
+    if update:
+        counters = metrics.snapshot()["counters"]
+        click.echo(f"Inserted {counters.get('rows_inserted', 0)}, changed {counters.get('rows_changed', 0)}"
+            f" and left {counters.get('rows_unchanged', 0)} unchanged DAP access count rows.")
+    _report(profile, began)
+
 
-    if len(downloads) > 0:
-        daputil.update_access_counts(downloads, start_day, end_day)
+@dapr.command("export", short_help=u"Export daily resource access counts as CSV or newline-delimited JSON.")
+@click.option("-s", "--start-date", required=False, help="Export counts from this date forward (YYYY-mm-dd).")
+@click.option("-e", "--end-date", required=False, help="Export counts up to this date (YYYY-mm-dd).")
+@click.option("-p", "--package", "package_id", required=False, help="Export the counts of this package id.")
+@click.option("--resource", "resource_id", required=False, help="Export the counts of this resource id.")
+@click.option("--organization", required=False, help="Export the counts of this organization's packages.")
+@click.option("-f", "--format", "fmt", type=click.Choice(list(export.RENDERERS)), default=export.FORMAT_CSV)
+@click.option("-o", "--output", type=click.File("w"), default="-", help="File to write, standard output by default.")
+def export_(start_date: str = None, end_date: str = None, package_id: str = None, resource_id: str = None,
+        organization: str = None, fmt: str = export.FORMAT_CSV, output=None):
+    """Write the recorded daily access counts, one row per resource and day
+    """
+    try:
+        start_day = datetime.date.fromisoformat(start_date) if start_date else None
+        end_day = datetime.date.fromisoformat(end_date) if end_date else None
+    except ValueError as e:
+        raise click.BadParameter(str(e))
+    filters = {'start_date': start_day, 'end_date': end_day, 'package_id': package_id,
+        'resource_id': resource_id}
+    if organization is not None:
+        filters['organization_id'] = export.organization_id(organization)
+        if filters['organization_id'] is None:
+            raise click.BadParameter(f"Organization {organization} not found", param_hint="--organization")
+    for chunk in export.export_chunks(fmt, **filters):
+        output.write(chunk)
+
+
+@dapr.command(short_help=u"Show the progress of DAP loads queued as background jobs.")
+@click.option("-n", "--number", type=int, default=50, help="Show this many of the latest windows.")
+def status(number: int = 50):
+    """List the latest background load windows with their status, pages,
+    rows written and the error that stopped any failed window
+    """
+    click.echo(f"{'Window':<25} {'Status':<8} {'Pages':>6} {'Rows':>10}  Error")
+    for w in jobs.load_status(number):
+        label = f"{w['start_date'] or ''} to {w['end_date'] or ''}"
+        click.echo(f"{label:<25} {w['status']:<8} {w['pages']:>6} {w['rows_written']:>10}  {w['error'] or ''}")
 
 
+def _report(profile, began):
+    """Publish the load's phase timings and counters, and print them if asked.
+    """
+    snapshot = metrics.snapshot()
+    elapsed = time.perf_counter() - began
+    publish_load(snapshot, elapsed)
+    if profile:
+        click.echo(format_summary(snapshot, elapsed))
+
+
+def _load(start_day, end_day, checkpoint=None, source=daputil.SOURCE_API, only_changed=False):
+    try:
+        written = daputil.load_downloads(start_day, end_day, checkpoint, source=source,
+            only_changed=only_changed)
+    except Exception:
+        log.exception("DAP load interrupted. Run the load command with --resume to continue it.")
+        return
+    log.info("Recorded %d DAP resource access counts", written)
+
+
+def _init_worker():
+    # Each worker process opens its own database connections instead of
+    # sharing the ones inherited from the parent.
+    model.Session.remove()
+    model.meta.engine.dispose(close=False)
+
+
+def _load_window(start_day, end_day, checkpoint_id, source, only_changed=False):
+    """Load one date window in a worker process, leaving the rollups to the parent.
+    Returns the number of rows written and the months whose counts changed,
+    or the error that stopped the load, and the worker's load metrics for
+    the parent to add to its own.
+    """
+    metrics.reset_load()
+    try:
+        checkpoint = None
+        if checkpoint_id is not None:
+            checkpoint = model.Session.query(daputil.DAPLoadCheckpoint).get(checkpoint_id)
+        written, months = daputil.load_window(start_day, end_day, checkpoint, source=source,
+            only_changed=only_changed)
+        return written, months, None, metrics.snapshot()
+    except Exception as e:
+        log.exception("DAP load of window %s to %s interrupted.", start_day, end_day)
+        return None, None, str(e), metrics.snapshot()
+    finally:
+        model.Session.remove()
+
+
+def _backfill(jobs, workers, only_changed=False):
+    """Load (start, end, checkpoint id, source) date windows in a pool of worker
+    processes, then refresh the rollups of the months whose counts changed
+    once and print rows per window.
+    """
+    # Load the resource URL index before forking, so no worker waits for its own.
+    matching.url_index.load()
+    model.Session.remove()
+    context = multiprocessing.get_context("fork")
+    with ProcessPoolExecutor(max_workers=workers, mp_context=context, initializer=_init_worker) as executor:
+        futures = [executor.submit(_load_window, *job, only_changed) for job in jobs]
+        results = []
+        months = set()
+        for (start, end, _, _), future in zip(jobs, futures):
+            written, window_months, error, snapshot = future.result()
+            metrics.merge(snapshot)
+            results.append((written, error))
+            if error is not None:
+                # The chunks written before the error are not known, so
+                # refresh every month of the window.
+                window_months = daputil.months_between(
+                    start or datetime.date.fromisoformat(daputil.DAP_FIRST_DAY), end or datetime.date.today())
+            months.update(window_months)
+
+    if months:
+        daputil.refresh_downloads(months)
+    else:
+        daputil.reindex_downloads()
+
+    click.echo(f"{'Window':<25} {'Rows':>10}")
+    total = 0
+    failed = 0
+    for (start, end, _, _), (written, error) in zip(jobs, results):
+        label = f"{start or ''} to {end or ''}"
+        if error is None:
+            total += written
+            click.echo(f"{label:<25} {written:>10}")
+        else:
+            failed += 1
+            click.echo(f"{label:<25} {'failed':>10}  {error}")
+    click.echo(f"{'Total':<25} {total:>10}")
+    if failed:
+        click.echo(f"{failed} window(s) failed. Run the load command with --resume to continue them.")
@@ -1,28 +1,71 @@
 import datetime
-import _logging
+import logging
+import os
+import re
 
-from sqlalchemy import Base, Column, Date, Integer, String, func
+from sqlalchemy import Boolean, Column, Date, DateTime, Float, Index, Integer, String, Text, case, func, literal, text
 from sqlalchemy.ext.declarative import declarative_base
 
-from ckan.plugins.toolkit import config, get_action
+from ckan.plugins.toolkit import asbool, asint, aslist, config
 
+import ckan.lib.search as search
 import ckan.model as model
+from ckan.lib.redis import connect_to_redis
+
+from . import cache, fetch, matching, misscache, rawcache, reporting
+from .batch import AccessBatch
+from .metrics import metrics
 
 _DOWNLOAD_REPORT = "/reports/download/data"
 
 DAP_FIRST_DAY = "2018-11-08"
 
-_log = _logging.get_logger(__name__)
+DEFAULT_WRITE_BATCH_SIZE = 5000
+
+DEFAULT_TOP_NUMBER = 20
+MAX_TOP_NUMBER = 100
+
+# Days before the latest recorded access that an update loads again,
+# to pick up DAP's late revisions of recent days.
+DEFAULT_UPDATE_TRAILING_DAYS = 7
+
+# Rolling windows, in days, that rankings are precomputed for.
+DEFAULT_RANKING_WINDOWS = (7, 30, 90)
+# Ranking kinds: most accessed, and fastest growing since the previous window.
+RANKING_TOP = 'top'
+RANKING_TRENDING = 'trending'
+# Accesses a package needs in a window to be ranked as trending, so a
+# jump from one access to three does not top the list.
+DEFAULT_TRENDING_MIN_ACCESSES = 10
+
+# Time series bucket sizes.
+INTERVALS = ('day', 'week', 'month')
+
+# Days of downloads counted as recent in the search index.
+DEFAULT_INDEX_RECENT_DAYS = 30
+# The first day of the recent window when the search index was last refreshed.
+_RECENT_START_KEY = 'ckanext.dapr:index_recent_start'
+
+# Where a load reads DAP download records from.
+SOURCE_API = "api"
+SOURCE_CACHE = "cache"
+
+# Rows per INSERT statement when writing access counts.
+UPSERT_BATCH_SIZE = 2500
+
+_log = logging.getLogger(__name__)
 
 _Base = declarative_base(metadata=model.meta.metadata)
 
 def get_resource_ids(url):
+    '''Find the resource and package ids for a resource URL.
+    The lookup is answered from the in-memory resource URL index, which
+    is built with one bulk query the first time it is needed.
+    '''
     ids = (None,None)
     try:
-        response = get_action('resource_search')({'query':f'url:{url}','limit':1'})
-        if response.get('count', 0) > 0:
-            resource = response['results'][0]
-            ids = (resource['id'],resource['package_id']])
+        matching.url_index.ensure_loaded()
+        ids = matching.url_index.lookup(url)
     except Exception as e:
         _log.exception('Error retrieving resource ids in DAP analytics.', extra={'URL': url})
     return ids
@@ -34,250 +77,1321 @@ def construct_resource_url_from_dap(filename: str, page: str) -> str:
     >>> construct_resource_url_from_dap('/example_downloadable.csv', 'example.usa.gov/example_grouping/example_page')
     'https://example.usa.gov/example_downloadable.csv'
     """
-    site = split(page,'/')[0]
+    site = page.split('/')[0]
     return f'https://{site}{filename}'
 
 
-def dap_retrieve(start_date, end_date):
-    downloads = []
-    params = {}
-    if start_date is not None:
-        params['after'] = start_date.strftime('%Y-%m-%d')
-    if end_date is not None:
-        params['before'] = end_date.strftime('%Y-%m-%d')
-
+def _api_settings():
+    '''Collect the API call URL, request headers and page size for the
+    DAP downloads report from the environment and the CKAN configuration.
+    Raises ValueError if the retrieval cannot proceed.
+    '''
     # Retrieve the API Key. Look for it in an environment variable first.
     api_key = os.getenv('DAP_KEY', None)
     if api_key is None:
         # Try reading the key from a file specified in the configuration.
-        loc = config.get('ckanext.dapanalytics.keyfile', None)
+        loc = config.get('ckanext.dapr.keyfile', None)
         if loc is not None:
             try:
-                api_key = open(loc,'r').read()
+                with open(loc,'r') as f:
+                    api_key = f.read().strip()
             except Exception as e:
-                _log.exception("Aborting DAP analytics retrieval due to an error reading API key file.", extra={'Filename': loc})
-                return downloads
+                raise ValueError(f"Aborting DAP analytics retrieval due to an error reading API key file {loc}.") from e
         else:
-            _log.error("Aborting DAP analytics retrieval since the DAP API key is not specified in either the CKAN configuration or an environment variable.")
-            return downloads
+            raise ValueError("Aborting DAP analytics retrieval since the DAP API key is not specified in either the CKAN configuration or an environment variable.")
 
     headers = {"x-api-key": api_key}
 
-    limit = config.get('ckanext.dapanalytics.batch_size',None)
+    limit = config.get('ckanext.dapr.batch_size',None)
     if limit is None:
         _log.info("DAP API batch size not set in CKAN configuration. Defaulting to 1000.")
         limit = 1000
 
-    api_url = config.get('ckanext.dapanalytics.api_url',None)
+    api_url = config.get('ckanext.dapr.api_url',None)
     if api_url is None:
-        _log.error("DAP API URL not specified.")
-        return downloads
-    
-    # Make sure the API URL ends with a "/", in case it was set incorrectly in the CKAN configuration.
-    api_url += '/' if api_url[-1] != '/'
-        
-    # Iterate over the DAP API downloads report until an empty response list is returned.
-    page = 1
-    params['limit'] = limit
-    params['page'] = page
+        raise ValueError("Aborting DAP analytics retrieval since the DAP API URL is not specified.")
 
-    agency = config.get('ckanext.dap.retrieval_agency', None)
+    # Drop any trailing "/" from the API URL, since the report paths below start with one.
+    api_url = api_url.rstrip('/')
+
+    agency = config.get('ckanext.dapr.retrieval_agency', None)
     if agency is None:
-        _log.info("Defaulting to retrieving all agency downloads since ckanext.dap.retrieval_agency is not set in the CKAN configuration.")
+        _log.info("Defaulting to retrieving all agency downloads since ckanext.dapr.retrieval_agency is not set in the CKAN configuration.")
         api_call = f'{api_url}{_DOWNLOAD_REPORT}'
     else :
-        api_call = f'{api_url}{agency}/{_DOWNLOAD_REPORT}'
-
-    result = requests.get(api_call, headers=headers, params=params)
-    if result.status_code != 200:
-        _log.error('Error retrieving analytics from DAP API.', 
-            extra = {'Page': page, 'Limit': limit,
-                'Status code': result.status_code,
-                'Message': result.text}
-        )
-        return downloads
-
-    jr = result.json()    
-    while len(jr) > 0:
-        # Process the results to construct the URLs of the downloads.
-        for rec in jr:
-            file = rec.get('file_name', None)
-            if file is None:
-                continue
+        api_call = f'{api_url}/agencies/{agency}{_DOWNLOAD_REPORT}'
 
-            page =  rec.get('page', None)
-            if page is None:
-                continue
+    return api_call, headers, int(limit)
+
+
+def dap_pages(start_date, end_date, first_page = 1):
+    '''Generate the decoded pages of the DAP downloads report for a date range,
+    one list of records per page from first_page on, until an empty page is
+    returned. Only the pages in flight are held in memory at a time.
+    Raises fetch.DAPRetrievalError if a page cannot be retrieved, and
+    ValueError if the API key or URL is not configured.
+    '''
+    api_call, headers, limit = _api_settings()
+
+    params = {}
+    if start_date is not None:
+        params['after'] = start_date.strftime('%Y-%m-%d')
+    if end_date is not None:
+        params['before'] = end_date.strftime('%Y-%m-%d')
+    params['limit'] = limit
 
-            site = split(page,'/')[0]
-            url = construct_resource_url_from_dap(page,file)
+    # Iterate over the DAP API downloads report until an empty response list is returned,
+    # keeping several page requests in flight over one pooled connection.
+    # Pages of up to ckanext.dapr.max_batch_size records are requested
+    # while the API keeps up, and throttled requests are retried.
+    # The request budget is shared through Redis with every other load
+    # process and job worker, so parallel loads stay within it together.
+    concurrency = max(1, asint(config.get('ckanext.dapr.concurrency', fetch.DEFAULT_CONCURRENCY)))
+    requests_per_hour = float(config.get('ckanext.dapr.requests_per_hour', fetch.DEFAULT_REQUESTS_PER_HOUR))
+    fetcher = fetch.PageFetcher(api_call, headers, params,
+        concurrency=concurrency,
+        requests_per_hour=requests_per_hour,
+        limiter=fetch.SharedRateLimiter(connect_to_redis(), requests_per_hour / 3600, capacity=concurrency),
+        max_limit=min(max(asint(config.get('ckanext.dapr.max_batch_size', fetch.MAX_BATCH_SIZE)), limit),
+            fetch.MAX_BATCH_SIZE),
+        max_retries=config.get('ckanext.dapr.max_retries', fetch.DEFAULT_MAX_RETRIES),
+        backoff=config.get('ckanext.dapr.retry_backoff_seconds', fetch.DEFAULT_BACKOFF_SECONDS),
+        target_seconds=config.get('ckanext.dapr.target_page_seconds', fetch.DEFAULT_TARGET_PAGE_SECONDS))
+    store = rawcache.configured_store()
+    for jr in fetcher.pages(first_page):
+        # Keep the raw page, if configured, so it can be matched again later without the API.
+        if store is not None:
+            store.write_page(jr)
+        yield jr
 
-            date_str = rec.get('date', None)
-            date_val = None
-            if date_str is None:
+
+def parse_dap_record(rec):
+    '''Extract the file path, page, access date and access count from a DAP
+    download record. Returns None for records missing any of them.
+
+    >>> parse_dap_record({'file_name': '/data.csv', 'page': 'example.usa.gov/data', 'date': '2020-05-20', 'total_events': 5})
+    ('/data.csv', 'example.usa.gov/data', datetime.date(2020, 5, 20), 5)
+    '''
+    file = rec.get('file_name', None)
+    if file is None:
+        return None
+
+    page =  rec.get('page', None)
+    if page is None:
+        return None
+
+    date_str = rec.get('date', None)
+    if date_str is None:
+        return None
+    try:
+        date_val = datetime.date.fromisoformat(date_str)
+    except ValueError as e:
+        _log.exception('Error interpreting DAP access date %s', date_str)
+        return None
+
+    count = rec.get('total_events', None)
+    if count is None:
+        return None
+
+    return file, page, date_val, count
+
+
+def match_resource(file, page, path_matcher):
+    '''Find the resource and package ids for the file of a DAP record.
+    Files of the local site with the resource id in their path are checked
+    against the index of active resource ids; other files are looked up by
+    the URL constructed from the record.
+    '''
+    res_id = path_matcher.resource_id(page.split('/')[0], file)
+    if res_id is not None:
+        ids = matching.url_index.lookup_id(res_id)
+        if ids[0] is not None:
+            return ids
+    return get_resource_ids(construct_resource_url_from_dap(file, page))
+
+def miss_cache():
+    '''Load the cache of DAP record files known not to match, as of the
+    current resources and matching settings.
+    '''
+    return misscache.configured_cache(matching.configured_path_matcher().stamp(),
+        matching.resources_modified(), matching.urls_modified_since)
+
+def match_records(pages, misses = None):
+    '''Generate a (resource_id, package_id, date, count) tuple for each
+    record in the given pages that corresponds to a resource in the CKAN
+    instance.
+
+    Records from sites that no resource URL points to are dropped without
+    a lookup. When a miss cache is given, files it holds are dropped too,
+    and files that match no resource are added to it.
+    '''
+    path_matcher = matching.configured_path_matcher()
+    matching.url_index.ensure_loaded()
+    for jr in pages:
+        metrics.count('records_seen', len(jr))
+        for rec in jr:
+            parsed = parse_dap_record(rec)
+            if parsed is None:
+                metrics.count('records_skipped')
                 continue
-            try:
-                date_val = datetime.date.fromisoformat(date_str)
-            except ValueError as e:
-                _log.exception('Error interpreting DAP access date %s', date_str)
+            file, page, date_val, count = parsed
+            site = page.split('/')[0]
+            if not (matching.url_index.has_host(site) or path_matcher.is_local(site)):
+                metrics.count('records_skipped')
                 continue
-
-            count = rec.get('total_events', None)
-            if count is None:
+            # Files are remembered by their normalized URL, so they can be
+            # forgotten when a resource with that URL is created or changed.
+            key = matching.normalize_url(construct_resource_url_from_dap(file, page))
+            if misses is not None and key in misses:
+                metrics.count('records_skipped')
                 continue
-
-            # Only record the URL access count and date in the downloads list if it corresponds to a resource in the CKAN instance.
-            res_id, pkg_id = get_resource_ids(url)
+            res_id, pkg_id = match_resource(file, page, path_matcher)
             if res_id is not None:
-                downloads.append({'resource_id': res_id, 'package_id': pkg_id,'date': date_val, 'count': count})
+                metrics.count('records_matched')
+                yield res_id, pkg_id, date_val, count
+            else:
+                metrics.count('records_skipped')
+                # Files matched by the resource id in their path are not
+                # remembered, as their URL need not be the resource's.
+                if misses is not None and path_matcher.resource_id(site, file) is None:
+                    misses.add(key)
+
+
+def match_downloads(pages, misses = None):
+    '''Generate a download dictionary for each record in the given pages that
+    corresponds to a resource in the CKAN instance, as match_records does.
+    '''
+    for res_id, pkg_id, date_val, count in match_records(pages, misses):
+        yield {'resource_id': res_id, 'package_id': pkg_id, 'date': date_val, 'count': count}
+
+
+def chunked(iterable, size):
+    '''Group the items of an iterable into lists of at most size items.
 
-        # Try retrieving another page of DAP access counts.
-        page += 1
-        result = requests.get(api_call, headers=headers, params=params)
-        if result.status_code == 200:
-            jr = result.json()
+    >>> list(chunked(range(5), 2))
+    [[0, 1], [2, 3], [4]]
+    '''
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def dap_retrieve(start_date, end_date):
+    '''Generate the download counts the DAP API reports for resources in the
+    CKAN instance over a date range. Pages are fetched lazily as the result
+    is consumed, so memory use does not grow with the date range.
+    '''
+    # Build the resource URL index once for this load, so matching each
+    # DAP record is an in-memory lookup instead of a search.
+    matching.url_index.load()
+    return match_downloads(dap_pages(start_date, end_date))
+
+
+def write_batch_size():
+    '''The number of matched download records written to the database per commit.
+    '''
+    return int(config.get('ckanext.dapr.write_batch_size', DEFAULT_WRITE_BATCH_SIZE))
+
+
+def _changed_rows(batch):
+    '''Select the rows of a batch that are not recorded yet or whose count
+    differs from the recorded one, counting the inserted, changed and
+    unchanged rows. The batch must hold the full counts of its days.
+    '''
+    if not batch:
+        return batch
+    first_day, last_day = batch.date_range()
+    recorded = {}
+    for res_ids in chunked(batch.resource_ids(), UPSERT_BATCH_SIZE):
+        recorded.update(((res_id, day), count) for res_id, day, count in model.Session.query(
+                DAPResourceAccess.resource_id, DAPResourceAccess.access_date, DAPResourceAccess.access_count)\
+            .filter(DAPResourceAccess.resource_id.in_(res_ids))\
+            .filter(DAPResourceAccess.access_date >= first_day)\
+            .filter(DAPResourceAccess.access_date <= last_day))
+
+    def changed(res_id, day, count):
+        recorded_count = recorded.get((res_id, day))
+        if recorded_count is None:
+            metrics.count('rows_inserted')
+            return True
+        if recorded_count != count:
+            metrics.count('rows_changed')
+            return True
+        metrics.count('rows_unchanged')
+        return False
+
+    return batch.summed(changed)
+
+def _save_chunk(batch, checkpoint, page, only_changed = False, clear = False):
+    '''Write a batch of matched records and advance the load checkpoint to
+    the given page in the same commit. The counts are added to those
+    written by the load's earlier chunks, since a resource's records for
+    one day can span pages. With clear, the counts recorded in the load's
+    window are deleted first, in the same commit. With only_changed, rows
+    holding the counts already recorded are left alone. Returns the first
+    day of each month whose counts were written or deleted.
+    '''
+    with metrics.phase('write'):
+        months = _clear_window(checkpoint) if clear else set()
+        rows = batch.summed()
+        if only_changed:
+            rows = _changed_rows(rows)
+        if rows:
+            _write_access_rows(rows.rows(), add=not only_changed)
+        checkpoint.page = page
+        checkpoint.rows_written += len(rows)
+        checkpoint.updated = datetime.datetime.utcnow()
+        model.Session.commit()
+    metrics.count('rows_written', len(rows))
+    return months | rows.months()
+
+def _day_ranges(days):
+    '''Group ISO dates, in order, into inclusive ranges of consecutive days.
+
+    >>> _day_ranges(['2020-05-01', '2020-05-02', '2020-05-04'])
+    [(datetime.date(2020, 5, 1), datetime.date(2020, 5, 2)), (datetime.date(2020, 5, 4), datetime.date(2020, 5, 4))]
+    '''
+    ranges = []
+    for day in map(datetime.date.fromisoformat, days):
+        if ranges and ranges[-1][1] + datetime.timedelta(days=1) == day:
+            ranges[-1] = (ranges[-1][0], day)
         else:
-            _log.error('Error retrieving analytics from DAP API.', 
-                extra = {'Page': page, 'Limit': limit, 
-                    'Status code': result.status_code, 
-                    'Message': result.text}
-            )
-            jr = []
+            ranges.append((day, day))
+    return ranges
+
+def _clear_window(checkpoint):
+    '''Delete the recorded counts in a load's date window, without
+    committing, so the load can add up its chunks from zero. A replay from
+    the raw response store only deletes the days the store holds, since
+    it cannot load the others again. Returns the months that held counts.
+    '''
+    if checkpoint.source == SOURCE_CACHE:
+        ranges = _day_ranges(rawcache.configured_store().days(checkpoint.start_date, checkpoint.end_date))
+    else:
+        ranges = [(checkpoint.start_date, checkpoint.end_date)]
+    months = set()
+    for start_date, end_date in ranges:
+        query = model.Session.query(DAPResourceAccess)
+        if start_date is not None:
+            query = query.filter(DAPResourceAccess.access_date >= start_date)
+        if end_date is not None:
+            query = query.filter(DAPResourceAccess.access_date <= end_date)
+        first_day, last_day = query.with_entities(
+            func.min(DAPResourceAccess.access_date), func.max(DAPResourceAccess.access_date)).one()
+        if first_day is not None:
+            query.delete(synchronize_session=False)
+            months.update(months_between(first_day, last_day))
+    return months
+
+def _overlaps(checkpoint, start_date, end_date):
+    return (checkpoint.start_date is None or end_date is None or checkpoint.start_date <= end_date) and \
+        (checkpoint.end_date is None or start_date is None or start_date <= checkpoint.end_date)
 
-    return downloads
+def _covers(start_date, end_date, checkpoint):
+    return (start_date is None or checkpoint.start_date is not None and start_date <= checkpoint.start_date) and \
+        (end_date is None or checkpoint.end_date is not None and checkpoint.end_date <= end_date)
 
- class DAPResourceAccess(_Base):
-    __table_name__ = "dap_resource_accesses"
+def supersede_checkpoints(checkpoint):
+    '''Stop unfinished loads whose window a new load overlaps from adding
+    their remaining pages to the counts the new load records. Those inside
+    the new window are marked completed, and the others start again from
+    their first page, so resuming them replaces their whole window.
+    Does not commit.
+    '''
+    start_date, end_date = checkpoint.start_date, checkpoint.end_date
+    unfinished = model.Session.query(DAPLoadCheckpoint)\
+        .filter(DAPLoadCheckpoint.completed == False)\
+        .filter(DAPLoadCheckpoint.page > 0)\
+        .filter(DAPLoadCheckpoint.id != checkpoint.id).all()
+    for old in unfinished:
+        if old.only_changed or not _overlaps(old, start_date, end_date):
+            continue
+        _log.info('DAP load of %s to %s is superseded by the load of %s to %s.', old.start_date,
+            old.end_date, start_date, end_date)
+        if _covers(start_date, end_date, old):
+            old.completed = True
+        else:
+            old.page = 0
+            old.rows_written = 0
+        old.updated = datetime.datetime.utcnow()
+
+def _source_pages(source, start_date, end_date, first_page):
+    if source == SOURCE_CACHE:
+        store = rawcache.configured_store()
+        if store is None:
+            raise ValueError('Replaying DAP downloads needs ckanext.dapr.raw_cache_dir to be set.')
+        return store.pages(start_date, end_date, first_page)
+    return dap_pages(start_date, end_date, first_page)
+
+def load_window(start_date, end_date, checkpoint = None, source = SOURCE_API, only_changed = False):
+    '''Retrieve download counts from the DAP API and record them in
+    fixed-size chunks, committing each chunk before the next page is
+    matched, leaving the rollups to the caller. Returns the number of
+    rows written and the first day of each month whose counts changed.
+
+    Progress is saved in a load checkpoint with each chunk. Passing an
+    unfinished checkpoint continues that load after its last saved page.
+    With source=SOURCE_CACHE the records are replayed from the raw
+    response store instead of the DAP API.
+
+    The counts recorded in the date window are replaced: they are deleted
+    in the transaction of the first chunk, once a page is received, and
+    each chunk adds its counts, so a day whose records span chunks is
+    recorded in full. Unfinished loads the window overlaps are superseded,
+    so resuming them does not add their pages again. With
+    only_changed, only new rows and rows whose counts changed are written.
+    Their counts are compared once the window's records are all matched,
+    so it is written in one chunk, and an interrupted update loads the
+    window again from its first page.
+    '''
+    now = datetime.datetime.utcnow()
+    # Have the partitions of the coming month ready before it is loaded.
+    ensure_partitions()
+    if checkpoint is None:
+        checkpoint = DAPLoadCheckpoint(start_date=_as_date(start_date), end_date=_as_date(end_date),
+            source=source, only_changed=only_changed, page=0, rows_written=0, completed=False,
+            started=now, updated=now)
+        model.Session.add(checkpoint)
+        model.Session.flush()
+        supersede_checkpoints(checkpoint)
+        model.Session.commit()
+        months = set()
+    else:
+        only_changed = bool(checkpoint.only_changed)
+        _log.info('Resuming DAP load after page %d.', checkpoint.page,
+            extra={'Rows written': checkpoint.rows_written})
+        months = set()
+        if checkpoint.page:
+            # The months written before the interruption are not known, so
+            # refresh every month in the checkpoint's date window.
+            first_day = checkpoint.start_date or datetime.date.fromisoformat(DAP_FIRST_DAY)
+            last_day = checkpoint.end_date or latest_resource_access() or now.date()
+            months = months_between(first_day, last_day)
+
+    # Build the resource URL index once for this process, so matching each
+    # DAP record is an in-memory lookup instead of a search.
+    matching.url_index.ensure_loaded()
+    misses = miss_cache()
+
+    # The window is cleared with the first chunk, so a load that received no
+    # page leaves it as it is, and one interrupted before saving a page
+    # clears it again when resumed.
+    clear = not only_changed and checkpoint.page == 0
+
+    # Matched records are held in compact columns until they are written.
+    chunk = AccessBatch()
+    first_page = checkpoint.page + 1
+    pages = _source_pages(checkpoint.source, checkpoint.start_date, checkpoint.end_date, first_page)
+    try:
+        for page, jr in enumerate(pages, start=first_page):
+            with metrics.phase('match'):
+                chunk.extend(match_records([jr], misses))
+            if only_changed:
+                # Keep one record per resource and day until the window is matched.
+                if len(chunk) >= write_batch_size():
+                    chunk = chunk.summed()
+            # Chunks end on page boundaries, so the checkpoint always names the
+            # last page whose records are all written.
+            elif not chunk or len(chunk) >= write_batch_size():
+                months.update(_save_chunk(chunk, checkpoint, page, only_changed, clear))
+                clear = False
+                chunk.clear()
+        if chunk:
+            months.update(_save_chunk(chunk, checkpoint, page, only_changed, clear))
+    finally:
+        misses.save()
+
+    checkpoint.completed = True
+    checkpoint.updated = datetime.datetime.utcnow()
+    model.Session.commit()
+    return checkpoint.rows_written, months
+
+def load_downloads(start_date, end_date, checkpoint = None, source = SOURCE_API, only_changed = False):
+    '''Load download counts as load_window does, then refresh the rollups
+    for the months whose counts changed. Loads running side by side call
+    load_window instead and refresh the months of all of them once.
+    Returns the number of rows written by the load.
+    '''
+    written, months = load_window(start_date, end_date, checkpoint, source, only_changed)
+    # A load that wrote nothing leaves the rollups and cached reports as
+    # they are, but days still leave the recent window of the search index.
+    if months:
+        refresh_downloads(months)
+    else:
+        reindex_downloads()
+    return written
+
+def update_trailing_days() -> int:
+    return asint(config.get('ckanext.dapr.update_trailing_days', DEFAULT_UPDATE_TRAILING_DAYS))
+
+def update_start_date(trailing_days = None):
+    '''The first day an update loads: the given number of days, or
+    ckanext.dapr.update_trailing_days, before the latest recorded access,
+    or the first day of DAP if none is recorded.
+    '''
+    latest = latest_resource_access()
+    if latest is None:
+        return datetime.date.fromisoformat(DAP_FIRST_DAY)
+    if trailing_days is None:
+        trailing_days = update_trailing_days()
+    return _as_date(latest) - datetime.timedelta(days=trailing_days)
 
-    resource_id =   Column(String(60), primary_key=True),
-    access_date = Column(Date, primry_key=True),
-    package_id = Column(String(60)),
+def unfinished_checkpoints():
+    '''Retrieve the checkpoints of all loads that did not finish, latest first.
+    Windows loaded by background jobs are left to those jobs.
+    '''
+    return model.Session.query(DAPLoadCheckpoint)\
+        .filter(DAPLoadCheckpoint.completed == False)\
+        .filter(DAPLoadCheckpoint.job_id == None)\
+        .order_by(DAPLoadCheckpoint.started.desc()).all()
+
+def unfinished_checkpoint():
+    '''Retrieve the checkpoint of the latest load that did not finish, if any.
+    '''
+    checkpoints = unfinished_checkpoints()
+    return checkpoints[0] if checkpoints else None
+
+def date_windows(start_date, end_date, days):
+    '''Split an inclusive date range into consecutive windows of at most the given number of days.
+
+    >>> date_windows(datetime.date(2020, 5, 1), datetime.date(2020, 5, 16), 7)
+    [(datetime.date(2020, 5, 1), datetime.date(2020, 5, 7)), (datetime.date(2020, 5, 8), datetime.date(2020, 5, 14)), (datetime.date(2020, 5, 15), datetime.date(2020, 5, 16))]
+    '''
+    start_date = _as_date(start_date)
+    end_date = _as_date(end_date)
+    windows = []
+    while start_date <= end_date:
+        window_end = min(start_date + datetime.timedelta(days=days - 1), end_date)
+        windows.append((start_date, window_end))
+        start_date = window_end + datetime.timedelta(days=1)
+    return windows
+
+class DAPResourceAccess(_Base):
+    __tablename__ = "dap_resource_accesses"
+    __table_args__ = (
+        Index("ix_dap_resource_accesses_package_date", "package_id", "access_date"),
+        Index("ix_dap_resource_accesses_access_date", "access_date"),
+    )
+
+    resource_id =   Column(String(60), primary_key=True)
+    access_date = Column(Date, primary_key=True)
+    package_id = Column(String(60))
     access_count = Column(Integer)
 
     def __repr__(self):
         return f'id:{self.resource_id}, package:{self.package_id}, accesses: {self.access_count}, date: {self.access_date:%Y-%m-%d}'
 
 
+class DAPResourceMonthly(_Base):
+    '''Access counts per resource and calendar month, keyed by the first day of the month.
+    '''
+    __tablename__ = "dap_resource_monthly"
+
+    resource_id = Column(String(60), primary_key=True)
+    month = Column(Date, primary_key=True)
+    package_id = Column(String(60))
+    access_count = Column(Integer)
+
+
+class DAPPackageMonthly(_Base):
+    '''Access counts per package and calendar month, keyed by the first day of the month.
+    '''
+    __tablename__ = "dap_package_monthly"
+
+    package_id = Column(String(60), primary_key=True)
+    month = Column(Date, primary_key=True)
+    access_count = Column(Integer)
+
+
+class DAPResourceTotal(_Base):
+    __tablename__ = "dap_resource_totals"
+
+    resource_id = Column(String(60), primary_key=True)
+    package_id = Column(String(60))
+    access_count = Column(Integer)
+
+
+class DAPPackageTotal(_Base):
+    __tablename__ = "dap_package_totals"
+
+    package_id = Column(String(60), primary_key=True)
+    access_count = Column(Integer)
+
+
+class DAPLoadCheckpoint(_Base):
+    '''Progress of a load, saved with each committed chunk so an
+    interrupted load can be resumed after its last written page.
+    Loads run as background jobs also keep the job id and the error that
+    stopped the last attempt, and updates writing only changed counts are
+    flagged so they resume as updates.
+    '''
+    __tablename__ = "dap_load_checkpoints"
+
+    id = Column(Integer, primary_key=True)
+    start_date = Column(Date)
+    end_date = Column(Date)
+    source = Column(String(10), default=SOURCE_API)
+    page = Column(Integer)
+    rows_written = Column(Integer)
+    completed = Column(Boolean)
+    started = Column(DateTime)
+    updated = Column(DateTime)
+    job_id = Column(String(64))
+    error = Column(Text)
+    only_changed = Column(Boolean, default=False)
+
+
+class DAPPackageRanking(_Base):
+    '''Precomputed package rankings for rolling windows ending on the latest
+    recorded day, with each package's count in the window before, so a
+    ranking is read with one indexed query.
+    '''
+    __tablename__ = "dap_package_rankings"
+
+    window_days = Column(Integer, primary_key=True)
+    ranking = Column(String(10), primary_key=True)
+    rank = Column(Integer, primary_key=True)
+    package_id = Column(String(60))
+    access_count = Column(Integer)
+    previous_count = Column(Integer)
+    growth = Column(Float)
+    end_date = Column(Date)
+
+
 def init_dap_tables():
-    '''Initialize the database to include the table for the class declared above.
+    '''Initialize the database to include the tables for the classes declared above.
+    Sites should use the extension's migrations (ckan db upgrade -p dapr)
+    instead, so the tables can be changed in place by later versions.
     '''
     model.meta.metadata.create_all(model.meta.engine)
 
-def update_access_counts(downloads, start_date, end_date):
-    # Retrieve any existing entries within the specificed date range,
-    # to update their access counts if needed.
-    access_list = meta.Session.query(DAPResourceAccesses).filter(access_date >= start_date).filter(access_date <= end_date)
+_PARTITION_NAME = re.compile(r'_(\d{4})_(\d{2})$')
 
-    for res_id, pkg_id, date, count in downloads:
-        da = DAPResourceAccess(resource_id=res_id, package_id = pkg_id, access_date = date, access_count = count)
-        model.Session.add(da)
+def ensure_partitions(today = None):
+    '''Create the monthly partitions of the daily access count table
+    through the month after today's, when ckanext.dapr.partition_accesses
+    had the table partitioned, so new counts are not written to its default
+    partition, which could then not be split into months. Counts the default
+    partition already holds for the new months are moved into them.
+    Returns the first day of each month created.
+    '''
+    session = model.Session
+    if session.get_bind().dialect.name != 'postgresql':
+        return []
+    table = DAPResourceAccess.__tablename__
+    names = session.execute(text('SELECT CAST(inhrelid::regclass AS text) FROM pg_inherits '
+        'WHERE inhparent = to_regclass(:table)'), {'table': table}).scalars().all()
+    existing = [datetime.date(int(m.group(1)), int(m.group(2)), 1)
+        for m in map(_PARTITION_NAME.search, names) if m is not None]
+    if not existing:
+        return []
+    last = _next_month(_month_start(today or datetime.date.today()))
+    months = sorted(months_between(_next_month(max(existing)), last))
+    if not months:
+        return []
 
-    model.Session.commit()
+    default = f'{table}_default'
+    # Loads running side by side wait for the first to create the partitions.
+    session.execute(text('SELECT pg_advisory_xact_lock(hashtext(:table))'), {'table': table})
+    session.execute(text(f'CREATE TEMPORARY TABLE dap_moved_accesses ON COMMIT DROP AS '
+        f'SELECT * FROM {default} WITH NO DATA'))
+    created = []
+    for month in months:
+        name = f'{table}_{month:%Y_%m}'
+        if session.execute(text('SELECT to_regclass(:name)'), {'name': name}).scalar() is not None:
+            continue
+        bounds = {'start': month, 'end': _next_month(month)}
+        session.execute(text(f'WITH moved AS (DELETE FROM {default} '
+            'WHERE access_date >= :start AND access_date < :end RETURNING *) '
+            'INSERT INTO dap_moved_accesses SELECT * FROM moved'), bounds)
+        session.execute(text(f"CREATE TABLE {name} PARTITION OF {table} "
+            f"FOR VALUES FROM ('{month}') TO ('{_next_month(month)}')"))
+        session.execute(text(f'INSERT INTO {table} SELECT * FROM dap_moved_accesses'))
+        session.execute(text('TRUNCATE dap_moved_accesses'))
+        created.append(month)
+    session.commit()
+    if created:
+        _log.info('Created DAP access count partitions for %s.', ', '.join(f'{m:%Y-%m}' for m in created))
+    return created
+
+def _access_rows(downloads):
+    '''Convert download dictionaries to table rows, summing the counts of
+    records for the same resource and date, such as the same file linked
+    from several pages.
+    '''
+    return list(AccessBatch.from_downloads(downloads).rows())
+
+def _upsert_on_conflict(insert, rows, add = False):
+    '''Write rows with multi-row INSERT ... ON CONFLICT DO UPDATE statements.
+    '''
+    table = DAPResourceAccess.__table__
+    for batch in chunked(rows, UPSERT_BATCH_SIZE):
+        stmt = insert(table).values(batch)
+        access_count = stmt.excluded.access_count
+        if add:
+            access_count = table.c.access_count + access_count
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[table.c.resource_id, table.c.access_date],
+            set_={'package_id': stmt.excluded.package_id, 'access_count': access_count})
+        model.Session.execute(stmt)
+
+def _upsert_portable(rows, add = False):
+    '''Write rows on databases without an upsert statement, by looking up
+    which keys already exist and bulk updating those and inserting the rest.
+    '''
+    for batch in chunked(rows, UPSERT_BATCH_SIZE):
+        res_ids = {r['resource_id'] for r in batch}
+        dates = [r['access_date'] for r in batch]
+        existing = {(res_id, day): count for res_id, day, count in model.Session.query(
+                DAPResourceAccess.resource_id, DAPResourceAccess.access_date, DAPResourceAccess.access_count)\
+            .filter(DAPResourceAccess.resource_id.in_(res_ids))\
+            .filter(DAPResourceAccess.access_date >= min(dates))\
+            .filter(DAPResourceAccess.access_date <= max(dates))}
+        updates = [r for r in batch if (r['resource_id'], r['access_date']) in existing]
+        inserts = [r for r in batch if (r['resource_id'], r['access_date']) not in existing]
+        if add:
+            updates = [dict(r, access_count=existing[r['resource_id'], r['access_date']] + r['access_count'])
+                for r in updates]
+        model.Session.bulk_update_mappings(DAPResourceAccess, updates)
+        model.Session.bulk_insert_mappings(DAPResourceAccess, inserts)
+
+def _write_access_rows(rows, add = False):
+    '''Write access count rows, replacing the counts recorded for the same
+    resource and date, or adding to them with add.
+    '''
+    dialect = model.Session.get_bind().dialect.name
+    if dialect == 'postgresql':
+        from sqlalchemy.dialects.postgresql import insert
+        _upsert_on_conflict(insert, rows, add)
+    elif dialect == 'sqlite':
+        from sqlalchemy.dialects.sqlite import insert
+        _upsert_on_conflict(insert, rows, add)
+    else:
+        _upsert_portable(rows, add)
+
+def update_access_counts(downloads) -> int:
+    '''Record a chunk of download dictionaries and commit it.
+    Existing rows for the same resource and date are replaced, so loading
+    an overlapping date range again is safe. Returns the number of rows written.
+    '''
+    rows = _access_rows(downloads)
+    if not rows:
+        return 0
+    with metrics.phase('write'):
+        _write_access_rows(rows)
+        model.Session.commit()
+    metrics.count('rows_written', len(rows))
+    return len(rows)
+
+def _as_date(d):
+    if isinstance(d, datetime.datetime):
+        return d.date()
+    return d
+
+def _month_start(d):
+    return d.replace(day=1)
+
+def _next_month(d):
+    '''
+    >>> _next_month(datetime.date(2020, 12, 15))
+    datetime.date(2021, 1, 1)
+    '''
+    if d.month == 12:
+        return datetime.date(d.year + 1, 1, 1)
+    return datetime.date(d.year, d.month + 1, 1)
+
+def months_between(first_day, last_day):
+    '''
+    >>> sorted(months_between(datetime.date(2020, 11, 8), datetime.date(2021, 1, 2)))
+    [datetime.date(2020, 11, 1), datetime.date(2020, 12, 1), datetime.date(2021, 1, 1)]
+    '''
+    months = set()
+    month = _month_start(_as_date(first_day))
+    while month <= _as_date(last_day):
+        months.add(month)
+        month = _next_month(month)
+    return months
+
+def _is_month_end(d):
+    return _next_month(d) - d == datetime.timedelta(days=1)
+
+def _monthly_ids(session, months):
+    '''The ids of the resources and packages with monthly counts in the given months.
+    '''
+    resource_ids = {resource_id for resource_id, in session.query(DAPResourceMonthly.resource_id)\
+        .filter(DAPResourceMonthly.month.in_(months)).distinct()}
+    package_ids = {package_id for package_id, in session.query(DAPPackageMonthly.package_id)\
+        .filter(DAPPackageMonthly.month.in_(months)).distinct()}
+    return resource_ids, package_ids
+
+def _refresh_totals(session, total, monthly, key_columns, ids):
+    '''Recompute the all-time totals of the given ids, or of every id when
+    ids is None, from a monthly rollup. Returns the totals before and after.
+    '''
+    key = getattr(total, key_columns[0])
+    monthly_key = getattr(monthly, key_columns[0])
+    columns = [monthly_key] + [func.max(getattr(monthly, c)) for c in key_columns[1:]] + \
+        [func.sum(monthly.access_count)]
+    batches = [None] if ids is None else chunked(sorted(ids), UPSERT_BATCH_SIZE)
+    previous, current = {}, {}
+    for batch in batches:
+        totals = session.query(total)
+        sums = session.query(*columns)
+        if batch is not None:
+            totals = totals.filter(key.in_(batch))
+            sums = sums.filter(monthly_key.in_(batch))
+        previous.update(totals.with_entities(key, total.access_count))
+        totals.delete(synchronize_session=False)
+        session.execute(total.__table__.insert().from_select(
+            list(key_columns) + ['access_count'], sums.group_by(monthly_key).statement))
+        current.update(totals.with_entities(key, total.access_count))
+    return previous, current
+
+def refresh_rollups(months = None):
+    '''Recompute the monthly and all-time rollup tables from the daily
+    access counts for the given months (first-of-month dates), or for
+    every month recorded if none are given, and commit.
+    Returns the ids of the packages whose all-time totals changed.
+    '''
+    session = model.Session
+    R = DAPResourceAccess
+    if months is None:
+        first, last = session.query(func.min(R.access_date), func.max(R.access_date)).one()
+        months = months_between(first, last) if first is not None else set()
+        session.query(DAPResourceMonthly).delete(synchronize_session=False)
+        session.query(DAPPackageMonthly).delete(synchronize_session=False)
+        # Every total is recomputed.
+        resource_ids = package_ids = None
+    else:
+        # Taken before the months are rebuilt, so ids whose counts in them
+        # dropped to nothing are recomputed too.
+        resource_ids, package_ids = _monthly_ids(session, months)
+
+    for month in sorted(months):
+        session.query(DAPResourceMonthly).filter(DAPResourceMonthly.month == month).delete(synchronize_session=False)
+        session.query(DAPPackageMonthly).filter(DAPPackageMonthly.month == month).delete(synchronize_session=False)
+        resource_month = session.query(R.resource_id, literal(month, Date), func.max(R.package_id), func.sum(R.access_count))\
+            .filter(R.access_date >= month)\
+            .filter(R.access_date < _next_month(month))\
+            .group_by(R.resource_id)
+        session.execute(DAPResourceMonthly.__table__.insert().from_select(
+            ['resource_id', 'month', 'package_id', 'access_count'], resource_month.statement))
+        package_month = session.query(DAPResourceMonthly.package_id, literal(month, Date), func.sum(DAPResourceMonthly.access_count))\
+            .filter(DAPResourceMonthly.month == month)\
+            .group_by(DAPResourceMonthly.package_id)
+        session.execute(DAPPackageMonthly.__table__.insert().from_select(
+            ['package_id', 'month', 'access_count'], package_month.statement))
+
+    # Recompute the all-time totals of the resources and packages with counts
+    # in the refreshed months, before or after.
+    if resource_ids is not None:
+        refreshed_resources, refreshed_packages = _monthly_ids(session, months)
+        resource_ids |= refreshed_resources
+        package_ids |= refreshed_packages
+    _refresh_totals(session, DAPResourceTotal, DAPResourceMonthly, ('resource_id', 'package_id'), resource_ids)
+    previous_totals, totals = _refresh_totals(session, DAPPackageTotal, DAPPackageMonthly, ('package_id',),
+        package_ids)
+
+    session.commit()
+    return {package_id for package_id in set(totals) | set(previous_totals)
+        if totals.get(package_id) != previous_totals.get(package_id)}
+
+def index_downloads() -> bool:
+    '''Whether download counts are added to the search index.
+    '''
+    return asbool(config.get('ckanext.dapr.index_downloads', True))
+
+def index_recent_days() -> int:
+    return asint(config.get('ckanext.dapr.index_recent_days', DEFAULT_INDEX_RECENT_DAYS))
+
+def _recent_start():
+    return datetime.date.today() - datetime.timedelta(days=index_recent_days())
+
+def package_index_fields(package_id) -> dict:
+    '''The download count fields to add to a package's search index document:
+    its all-time total and its total over the recent days, read from the
+    primary database, which the load refreshing the index just wrote.
+    '''
+    recent_start = _recent_start()
+    with reporting.primary():
+        return {
+            'dapr_downloads_total': package_accesses([package_id])[package_id],
+            'dapr_downloads_recent': package_accesses([package_id], recent_start)[package_id],
+        }
+
+def reindex_packages(package_ids):
+    '''Update the search index documents of the given packages, with one
+    search index commit at the end. Ids of packages that no longer exist
+    are skipped.
+    '''
+    package_ids = list(package_ids)
+    if not package_ids or not index_downloads():
+        return
+    reindexed = 0
+    for batch in chunked(package_ids, UPSERT_BATCH_SIZE):
+        existing = [package_id for package_id, in model.Session.query(model.Package.id)\
+            .filter(model.Package.id.in_(batch))\
+            .filter(model.Package.state == 'active')]
+        if existing:
+            search.rebuild(package_ids=existing, defer_commit=True, quiet=True)
+            reindexed += len(existing)
+    search.commit()
+    _log.info('Reindexed %d packages with changed DAP download counts.', reindexed)
+
+def _left_recent_window(redis, recent_start):
+    '''The ids of the packages with accesses on the days that left the recent
+    window since the search index was last refreshed, taken to be only the
+    day before the window when no refresh is recorded.
+    '''
+    previous = redis.get(_RECENT_START_KEY)
+    if previous is None:
+        previous = recent_start - datetime.timedelta(days=1)
+    else:
+        previous = datetime.date.fromisoformat(previous.decode())
+    if previous >= recent_start:
+        return set()
+    return {package_id for package_id, in model.Session.query(DAPResourceAccess.package_id)\
+        .filter(DAPResourceAccess.access_date >= previous)\
+        .filter(DAPResourceAccess.access_date < recent_start)\
+        .distinct()}
+
+def reindex_downloads(changed = ()):
+    '''Reindex the given packages, whose download counts changed, and the
+    packages whose recent counts dropped as days left the recent window,
+    even when no load changed them.
+    '''
+    if not index_downloads():
+        return
+    try:
+        redis = connect_to_redis()
+        recent_start = _recent_start()
+        package_ids = set(changed) | _left_recent_window(redis, recent_start)
+        reindex_packages(package_ids)
+        redis.set(_RECENT_START_KEY, recent_start.isoformat())
+    except Exception:
+        _log.exception('Error reindexing packages with changed DAP download counts.',
+            extra={'Number of packages': len(changed)})
+
+def ranking_windows():
+    return [int(days) for days in aslist(config.get('ckanext.dapr.ranking_windows', DEFAULT_RANKING_WINDOWS))]
+
+def _growth(count, previous):
+    '''
+    >>> _growth(15, 10), _growth(5, 0)
+    (0.5, None)
+    '''
+    return (count - previous) / previous if previous else None
+
+def refresh_rankings(end_date = None):
+    '''Recompute the rankings of every configured rolling window ending on
+    end_date, by default the latest recorded day, and commit. Each window
+    is ranked by accesses, and by growth over the window before it, with
+    one grouped query per window.
+    '''
+    session = model.Session
+    end_date = _as_date(end_date or latest_resource_access())
+    session.query(DAPPackageRanking).delete(synchronize_session=False)
+    if end_date is None:
+        session.commit()
+        return
+    min_accesses = asint(config.get('ckanext.dapr.trending_min_accesses', DEFAULT_TRENDING_MIN_ACCESSES))
+    R = DAPResourceAccess
+    for days in ranking_windows():
+        start_date = end_date - datetime.timedelta(days=days - 1)
+        previous_start = start_date - datetime.timedelta(days=days)
+        current = func.sum(case((R.access_date >= start_date, R.access_count), else_=0))
+        previous = func.sum(case((R.access_date < start_date, R.access_count), else_=0))
+        counts = session.query(R.package_id, current, previous)\
+            .filter(R.access_date >= previous_start)\
+            .filter(R.access_date <= end_date)\
+            .group_by(R.package_id).all()
+        top = sorted((c for c in counts if c[1]), key=lambda c: (-c[1], c[0]))[:MAX_TOP_NUMBER]
+        trending = sorted((c for c in counts if c[1] >= min_accesses and c[2]),
+            key=lambda c: (-_growth(c[1], c[2]), -c[1], c[0]))[:MAX_TOP_NUMBER]
+        session.bulk_insert_mappings(DAPPackageRanking, [
+            {'window_days': days, 'ranking': ranking, 'rank': rank, 'package_id': package_id,
+                'access_count': count, 'previous_count': previous_count,
+                'growth': _growth(count, previous_count), 'end_date': end_date}
+            for ranking, ranked in ((RANKING_TOP, top), (RANKING_TRENDING, trending))
+            for rank, (package_id, count, previous_count) in enumerate(ranked, start=1)])
+    session.commit()
+
+def refresh_downloads(months = None):
+    '''Bring everything derived from the daily access counts up to date
+    after a load: refresh the rollups for the months written and the
+    rankings, discard cached reports, and reindex the packages whose
+    download counts changed.
+    '''
+    with metrics.phase('rollup'):
+        changed = refresh_rollups(months)
+        refresh_rankings()
+    cache.invalidate()
+    with metrics.phase('index'):
+        reindex_downloads(changed)
+
+def _split_range(start_date, end_date):
+    '''Split an inclusive, optionally open-ended date range into the whole
+    calendar months it covers and the days of partial months at either end.
+    Returns the first and last whole months (None when open-ended, or
+    an empty tuple when no whole month is covered) and a list of
+    inclusive (start, end) day ranges.
+
+    >>> _split_range(datetime.date(2020, 5, 20), datetime.date(2020, 8, 10))
+    ((datetime.date(2020, 6, 1), datetime.date(2020, 7, 1)), [(datetime.date(2020, 5, 20), datetime.date(2020, 5, 31)), (datetime.date(2020, 8, 1), datetime.date(2020, 8, 10))])
+    >>> _split_range(None, datetime.date(2020, 8, 31))
+    ((None, datetime.date(2020, 8, 1)), [])
+    >>> _split_range(datetime.date(2020, 5, 2), datetime.date(2020, 5, 9))
+    ((), [(datetime.date(2020, 5, 2), datetime.date(2020, 5, 9))])
+
+    A range ending before it starts covers nothing.
+
+    >>> _split_range(datetime.date(2020, 8, 10), datetime.date(2020, 5, 20))
+    ((), [])
+    '''
+    start_date = _as_date(start_date)
+    end_date = _as_date(end_date)
+    if start_date is not None and end_date is not None and start_date > end_date:
+        return (), []
+    one_day = datetime.timedelta(days=1)
+    if start_date is not None and end_date is not None and \
+            _month_start(start_date) == _month_start(end_date) and \
+            not (start_date.day == 1 and _is_month_end(end_date)):
+        return (), [(start_date, end_date)]
+
+    partial = []
+    first_month = None
+    if start_date is not None:
+        if start_date.day == 1:
+            first_month = start_date
+        else:
+            first_month = _next_month(start_date)
+            partial.append((start_date, first_month - one_day))
+    last_month = None
+    if end_date is not None:
+        if _is_month_end(end_date):
+            last_month = _month_start(end_date)
+        else:
+            partial.append((_month_start(end_date), end_date))
+            last_month = _month_start(_month_start(end_date) - one_day)
+    if first_month is not None and last_month is not None and first_month > last_month:
+        return (), partial
+    return (first_month, last_month), partial
+
+def _rollup_sum(monthly_count, monthly_month, monthly_filters, raw_filters, start_date, end_date):
+    '''Sum access counts over a date range from the monthly rollup for whole
+    months, plus the daily table for the days of partial months.
+    '''
+    session = reporting.session()
+    months, partial = _split_range(start_date, end_date)
+    accesses = 0
+    if months:
+        first_month, last_month = months
+        query = session.query(func.sum(monthly_count)).filter(*monthly_filters)
+        if first_month is not None:
+            query = query.filter(monthly_month >= first_month)
+        if last_month is not None:
+            query = query.filter(monthly_month <= last_month)
+        accesses += query.scalar() or 0
+    for day_from, day_to in partial:
+        accesses += session.query(func.sum(DAPResourceAccess.access_count)).filter(*raw_filters)\
+            .filter(DAPResourceAccess.access_date >= day_from)\
+            .filter(DAPResourceAccess.access_date <= day_to)\
+            .scalar() or 0
+    return accesses
 
 def latest_resource_access():
     '''Retrieve the latest date recorded for a DAP resource tracking event.
     '''
     latest = None
     try:
-        latest = model.meta.Session.query(func.max(DAPResourceAccess.access_date)).all()
+        latest = model.meta.Session.query(func.max(DAPResourceAccess.access_date)).scalar()
     except Exception as e:
         _log.debug('No DAP access records found.', exc_info=e)
     return latest
 
+def _date_log_params(lp, start_date, end_date):
+    if start_date is not None:
+        lp['Starting date'] = start_date.strftime('%Y-%m-%d')
+    if end_date is not None:
+        lp['Ending date'] = end_date.strftime('%Y-%m-%d')
+    return lp
+
+@metrics.timed('total_resource_accesses')
 def total_resource_accesses(resource_id, start_date = None, end_date = None) -> int:
     '''Calculate how many accesses a specified resource had over an optional date range.
     '''
     accesses = 0
     try:
-        access_query = model.meta.Session.query(func.sum(DAPResourceAccess.access_count)).filter(resource_id=resource_id)
-        if start_date is not None:
-            access_query.filter(access_date >= start_date)
-        if end_date is not None:
-            access_query = access_query.filter(access_date <= end_date)
-        accesses = access_query.all()
+        if start_date is None and end_date is None:
+            accesses = reporting.session().query(DAPResourceTotal.access_count)\
+                .filter(DAPResourceTotal.resource_id == resource_id).scalar() or 0
+        else:
+            accesses = _rollup_sum(DAPResourceMonthly.access_count, DAPResourceMonthly.month,
+                [DAPResourceMonthly.resource_id == resource_id],
+                [DAPResourceAccess.resource_id == resource_id], start_date, end_date)
     except Exception as e:
-        lp = {'resource': resource_id}
-        if start_date is not None:
-            lp['Starting date'] = start_date.strftime('%Y-%m-%d')
-        if end_date is not None:
-            lp['Ending date'] = end_date.strftime('%Y-%m-%d')
+        lp = _date_log_params({'resource': resource_id}, start_date, end_date)
         _log.exception('Error retrieving DAP access count', extra=lp)
     return accesses
 
+@metrics.timed('total_package_accesses')
 def total_package_accesses(package_id, start_date = None, end_date = None) -> int:
     '''Calculate how many accesses a specified package's resources had over an optional date range.
     '''
     accesses = 0
     try:
-        access_query = model.meta.Session.query(func.sum(DAPResourceAccess.access_count)).filter(package_id=package_id)
-        if start_date is not None:
-            access_query.filter(access_date >= start_date)
-        if end_date is not None:
-            access_query = access_query.filter(access_date <= end_date)
-        accesses = access_query.all()
+        if start_date is None and end_date is None:
+            accesses = reporting.session().query(DAPPackageTotal.access_count)\
+                .filter(DAPPackageTotal.package_id == package_id).scalar() or 0
+        else:
+            accesses = _rollup_sum(DAPPackageMonthly.access_count, DAPPackageMonthly.month,
+                [DAPPackageMonthly.package_id == package_id],
+                [DAPResourceAccess.package_id == package_id], start_date, end_date)
     except Exception:
-        lp = {'package': package_id}
-        if start_date is not None:
-            lp['Starting date'] = start_date.strftime('%Y-%m-%d')
-        if end_date is not None:
-            lp['Ending date'] = end_date.strftime('%Y-%m-%d')
+        lp = _date_log_params({'package': package_id}, start_date, end_date)
         _log.exception('Error retrieving DAP access count', extra=lp)
     return accesses
 
+@metrics.timed('total_accesses')
 def total_accesses(start_date = None, end_date = None) -> int:
     '''Calculate the total number of accesses for all resources in the CKAN instance,
     optionally within a specified date range.
     '''
     accesses = 0
     try:
-        access_query = model.meta.Session.query(func.sum(DAPResourceAccess.access_count))
-        if start_date is not None:
-            access_query = access_query.filter(access_date >= start_date)
-        if end_date is not None:
-            access_query = access_query.filter(access_date <= end_date)
-        accesses = access_query.all()
+        if start_date is None and end_date is None:
+            accesses = reporting.session().query(func.sum(DAPPackageTotal.access_count)).scalar() or 0
+        else:
+            accesses = _rollup_sum(DAPPackageMonthly.access_count, DAPPackageMonthly.month,
+                [], [], start_date, end_date)
     except Exception as e:
-        lp = {}
-        if start_date is not None:
-            lp['Starting date'] = start_date.strftime('%Y-%m-%d')
-        if end_date is not None:
-            lp['Ending date'] = end_date.strftime('%Y-%m-%d')
+        lp = _date_log_params({}, start_date, end_date)
         _log.exception('Error retrieving DAP access count', extra=lp)
     return accesses
 
-def top_resources(start_date = None, end_date = None, number = 20):
+@metrics.timed('package_resource_accesses')
+def package_resource_accesses(package_id, start_date = None, end_date = None) -> dict:
+    '''Calculate the access counts of all of a package's resources over an
+    optional date range in one query. Returns a dictionary mapping resource
+    ids to counts; resources without recorded accesses are left out.
+    '''
+    counts = {}
+    try:
+        if start_date is None and end_date is None:
+            access_query = reporting.session().query(DAPResourceTotal.resource_id, DAPResourceTotal.access_count)\
+                .filter(DAPResourceTotal.package_id == package_id)
+        else:
+            access_query = reporting.session().query(DAPResourceAccess.resource_id, func.sum(DAPResourceAccess.access_count))\
+                .filter(DAPResourceAccess.package_id == package_id)\
+                .group_by(DAPResourceAccess.resource_id)
+            if start_date is not None:
+                access_query = access_query.filter(DAPResourceAccess.access_date >= start_date)
+            if end_date is not None:
+                access_query = access_query.filter(DAPResourceAccess.access_date <= end_date)
+        counts = {res_id: count for res_id, count in access_query}
+    except Exception:
+        lp = _date_log_params({'package': package_id}, start_date, end_date)
+        _log.exception('Error retrieving DAP resource access counts', extra=lp)
+    return counts
+
+def _rollup_sums(monthly_key, monthly_count, monthly_month, raw_key, ids, start_date, end_date):
+    '''Sum access counts over a date range for several ids at once, grouped
+    by id, from the monthly rollup for whole months plus the daily table
+    for the days of partial months. Returns a dictionary mapping ids to counts.
+    '''
+    session = reporting.session()
+    months, partial = _split_range(start_date, end_date)
+    counts = {}
+    if months:
+        first_month, last_month = months
+        query = session.query(monthly_key, func.sum(monthly_count))\
+            .filter(monthly_key.in_(ids)).group_by(monthly_key)
+        if first_month is not None:
+            query = query.filter(monthly_month >= first_month)
+        if last_month is not None:
+            query = query.filter(monthly_month <= last_month)
+        for key, count in query:
+            counts[key] = counts.get(key, 0) + (count or 0)
+    for day_from, day_to in partial:
+        query = session.query(raw_key, func.sum(DAPResourceAccess.access_count))\
+            .filter(raw_key.in_(ids))\
+            .filter(DAPResourceAccess.access_date >= day_from)\
+            .filter(DAPResourceAccess.access_date <= day_to)\
+            .group_by(raw_key)
+        for key, count in query:
+            counts[key] = counts.get(key, 0) + (count or 0)
+    return counts
+
+@metrics.timed('resource_accesses')
+def resource_accesses(resource_ids, start_date = None, end_date = None) -> dict:
+    '''Calculate the access counts of several resources over an optional
+    date range with grouped queries, rather than one query per resource.
+    Returns a dictionary mapping every resource id given to its count.
+    '''
+    resource_ids = list(resource_ids)
+    counts = {}
+    try:
+        if not resource_ids:
+            pass
+        elif start_date is None and end_date is None:
+            counts = dict(reporting.session().query(DAPResourceTotal.resource_id, DAPResourceTotal.access_count)\
+                .filter(DAPResourceTotal.resource_id.in_(resource_ids)))
+        else:
+            counts = _rollup_sums(DAPResourceMonthly.resource_id, DAPResourceMonthly.access_count,
+                DAPResourceMonthly.month, DAPResourceAccess.resource_id, resource_ids, start_date, end_date)
+    except Exception:
+        lp = _date_log_params({'Number of resources': len(resource_ids)}, start_date, end_date)
+        _log.exception('Error retrieving DAP resource access counts', extra=lp)
+    return {res_id: counts.get(res_id, 0) or 0 for res_id in resource_ids}
+
+@metrics.timed('package_accesses')
+def package_accesses(package_ids, start_date = None, end_date = None) -> dict:
+    '''Calculate the access counts of several packages over an optional
+    date range with grouped queries, rather than one query per package.
+    Returns a dictionary mapping every package id given to its count.
+    '''
+    package_ids = list(package_ids)
+    counts = {}
+    try:
+        if not package_ids:
+            pass
+        elif start_date is None and end_date is None:
+            counts = dict(reporting.session().query(DAPPackageTotal.package_id, DAPPackageTotal.access_count)\
+                .filter(DAPPackageTotal.package_id.in_(package_ids)))
+        else:
+            counts = _rollup_sums(DAPPackageMonthly.package_id, DAPPackageMonthly.access_count,
+                DAPPackageMonthly.month, DAPResourceAccess.package_id, package_ids, start_date, end_date)
+    except Exception:
+        lp = _date_log_params({'Number of packages': len(package_ids)}, start_date, end_date)
+        _log.exception('Error retrieving DAP package access counts', extra=lp)
+    return {pkg_id: counts.get(pkg_id, 0) or 0 for pkg_id in package_ids}
+
+def _bucket_start(d, interval):
+    '''The first day of the time series bucket holding a date. Weeks start on Mondays.
+
+    >>> _bucket_start(datetime.date(2020, 5, 20), 'week')
+    datetime.date(2020, 5, 18)
+    '''
+    if interval == 'month':
+        return _month_start(d)
+    if interval == 'week':
+        return d - datetime.timedelta(days=d.weekday())
+    return d
+
+def _next_bucket(d, interval):
+    if interval == 'month':
+        return _next_month(d)
+    return d + datetime.timedelta(days=7 if interval == 'week' else 1)
+
+def series_buckets(start_date, end_date, interval = 'day'):
+    '''List the first days of the buckets of a time series over an inclusive date range.
+
+    >>> series_buckets(datetime.date(2020, 5, 20), datetime.date(2020, 7, 1), 'month')
+    [datetime.date(2020, 5, 1), datetime.date(2020, 6, 1), datetime.date(2020, 7, 1)]
+    '''
+    buckets = []
+    bucket = _bucket_start(_as_date(start_date), interval)
+    while bucket <= _as_date(end_date):
+        buckets.append(bucket)
+        bucket = _next_bucket(bucket, interval)
+    return buckets
+
+@metrics.timed('access_series')
+def access_series(start_date, end_date, interval = 'day', package_id = None, resource_id = None) -> list:
+    '''Count the accesses of a resource, a package or the whole site per day,
+    week or month over an inclusive date range, with one query grouped by
+    day. Returns (bucket start, count) pairs for every bucket in the range,
+    including those without accesses. Partial buckets at either end only
+    count the days within the range.
+    '''
+    start_date = _as_date(start_date)
+    end_date = _as_date(end_date)
+    counts = dict.fromkeys(series_buckets(start_date, end_date, interval), 0)
+    try:
+        query = reporting.session().query(DAPResourceAccess.access_date, func.sum(DAPResourceAccess.access_count))\
+            .filter(DAPResourceAccess.access_date >= start_date)\
+            .filter(DAPResourceAccess.access_date <= end_date)\
+            .group_by(DAPResourceAccess.access_date)
+        if resource_id is not None:
+            query = query.filter(DAPResourceAccess.resource_id == resource_id)
+        if package_id is not None:
+            query = query.filter(DAPResourceAccess.package_id == package_id)
+        for day, count in query:
+            counts[_bucket_start(_as_date(day), interval)] += count or 0
+    except Exception:
+        lp = _date_log_params({'package': package_id, 'resource': resource_id, 'interval': interval},
+            start_date, end_date)
+        _log.exception('Error retrieving DAP access series', extra=lp)
+    return list(counts.items())
+
+@metrics.timed('top_resources')
+def top_resources(start_date = None, end_date = None, number = DEFAULT_TOP_NUMBER):
+    '''List the most accessed resources over an optional date range, as rows
+    with resource_id, package_id and access_count, most accessed first.
+    '''
     top = []
     try:
-        top_query = model.meta.Session.query(func.sum(DAPResourceAccess.access_count), \
-            DAPResourceAccess.resource_id, DAPResourceAccess.package_id)\
-                .order_by(text("1"))
-        if start_date is not None:
-            top_query = top_query.filter(access_date >= start_date)
-        if end_date is not None:
-            top_quuery = top_query.filter(access_date <= end_date)
+        if start_date is None and end_date is None:
+            top_query = reporting.session().query(DAPResourceTotal.resource_id, DAPResourceTotal.package_id,
+                DAPResourceTotal.access_count).order_by(DAPResourceTotal.access_count.desc())
+        else:
+            access_count = func.sum(DAPResourceAccess.access_count).label('access_count')
+            top_query = reporting.session().query(DAPResourceAccess.resource_id,
+                func.max(DAPResourceAccess.package_id).label('package_id'), access_count)\
+                .group_by(DAPResourceAccess.resource_id).order_by(access_count.desc())
+            if start_date is not None:
+                top_query = top_query.filter(DAPResourceAccess.access_date >= start_date)
+            if end_date is not None:
+                top_query = top_query.filter(DAPResourceAccess.access_date <= end_date)
         top = top_query.limit(number).all()
     except Exception as e:
-        lp = {'Number top resources': number}
-        if start_date is not None:
-            lp['Starting date'] = start_date.strftime('%Y-%m-%d')
-        if end_date is not None:
-            lp['Ending date'] = end_date.strftime('%Y-%m-%d')
+        lp = _date_log_params({'Number top resources': number}, start_date, end_date)
         _log.exception('Error retrieving DAP top resources', extra=lp)
+    return top
 
-def top_packages(start_date = None, end_date = None, number = 20):
+@metrics.timed('top_packages')
+def top_packages(start_date = None, end_date = None, number = DEFAULT_TOP_NUMBER):
+    '''List the most accessed packages over an optional date range, as rows
+    with package_id and access_count, most accessed first.
+    '''
     top = []
     try:
-        top_query = model.meta.Session.query(func.sum(DAPResourceAccess.access_count), \
-            DAPResourceAccess.package_id).order_by(text("1"))
-        if start_date is not None:
-            top_query = top_query.filter(access_date >= start_date)
-        if end_date is not None:
-            top_quuery = top_query.filter(access_date <= end_date)
+        if start_date is None and end_date is None:
+            top_query = reporting.session().query(DAPPackageTotal.package_id, DAPPackageTotal.access_count)\
+                .order_by(DAPPackageTotal.access_count.desc())
+        else:
+            access_count = func.sum(DAPResourceAccess.access_count).label('access_count')
+            top_query = reporting.session().query(DAPResourceAccess.package_id, access_count)\
+                .group_by(DAPResourceAccess.package_id).order_by(access_count.desc())
+            if start_date is not None:
+                top_query = top_query.filter(DAPResourceAccess.access_date >= start_date)
+            if end_date is not None:
+                top_query = top_query.filter(DAPResourceAccess.access_date <= end_date)
         top = top_query.limit(number).all()
     except Exception as e:
-        lp = {'Number top packages': number}
-        if start_date is not None:
-            lp['Starting date'] = start_date.strftime('%Y-%m-%d')
-        if end_date is not None:
-            lp['Ending date'] = end_date.strftime('%Y-%m-%d')
+        lp = _date_log_params({'Number top packages': number}, start_date, end_date)
         _log.exception('Error retrieving DAP top packages', extra=lp)
+    return top
+
+@metrics.timed('ranked_packages')
+def ranked_packages(window_days, ranking = RANKING_TOP, number = DEFAULT_TOP_NUMBER):
+    '''List a precomputed ranking of packages for a rolling window, as rows
+    with package_id, access_count, previous_count and growth, in rank order.
+    '''
+    ranked = []
+    try:
+        ranked = reporting.session().query(DAPPackageRanking.package_id, DAPPackageRanking.access_count,
+                DAPPackageRanking.previous_count, DAPPackageRanking.growth)\
+            .filter(DAPPackageRanking.window_days == window_days)\
+            .filter(DAPPackageRanking.ranking == ranking)\
+            .order_by(DAPPackageRanking.rank)\
+            .limit(number).all()
+    except Exception:
+        _log.exception('Error retrieving DAP package ranking',
+            extra={'Window days': window_days, 'Ranking': ranking, 'Number': number})
+    return ranked
@@ -0,0 +1,97 @@
+import csv
+import io
+import json
+import logging
+
+import ckan.model as model
+
+from . import reporting
+from .daputil import DAPResourceAccess
+
+_log = logging.getLogger(__name__)
+
+EXPORT_COLUMNS = ('access_date', 'package_id', 'resource_id', 'access_count')
+
+# Rows fetched from the server-side cursor at a time, and rows rendered
+# into each chunk of output.
+EXPORT_FETCH_SIZE = 10000
+EXPORT_CHUNK_ROWS = 1000
+
+FORMAT_CSV = 'csv'
+FORMAT_NDJSON = 'ndjson'
+MIMETYPES = {FORMAT_CSV: 'text/csv', FORMAT_NDJSON: 'application/x-ndjson'}
+
+
+def organization_id(organization):
+    '''Resolve an organization name or id to its id, or None if there is no such organization.
+    '''
+    group = model.Group.get(organization)
+    return group.id if group is not None else None
+
+def export_rows(start_date = None, end_date = None, package_id = None, resource_id = None,
+        organization_id = None):
+    '''Generate the daily access count rows matching the filters, in date order,
+    as (access_date, package_id, resource_id, access_count) tuples.
+    Rows are read through a server-side cursor on the reporting database,
+    a batch at a time, so any number of rows can be exported in constant memory.
+    '''
+    query = reporting.session().query(DAPResourceAccess.access_date, DAPResourceAccess.package_id,
+        DAPResourceAccess.resource_id, DAPResourceAccess.access_count)
+    if start_date is not None:
+        query = query.filter(DAPResourceAccess.access_date >= start_date)
+    if end_date is not None:
+        query = query.filter(DAPResourceAccess.access_date <= end_date)
+    if package_id is not None:
+        query = query.filter(DAPResourceAccess.package_id == package_id)
+    if resource_id is not None:
+        query = query.filter(DAPResourceAccess.resource_id == resource_id)
+    if organization_id is not None:
+        query = query.join(model.Package, model.Package.id == DAPResourceAccess.package_id)\
+            .filter(model.Package.owner_org == organization_id)
+    for row in query.order_by(DAPResourceAccess.access_date).yield_per(EXPORT_FETCH_SIZE):
+        yield tuple(row)
+
+def csv_chunks(rows):
+    '''Render rows as CSV text with a header line, a chunk of rows at a time.
+
+    >>> import datetime
+    >>> print(''.join(csv_chunks([(datetime.date(2020, 5, 20), 'p1', 'r1', 3)])), end='')
+    access_date,package_id,resource_id,access_count
+    2020-05-20,p1,r1,3
+    '''
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, lineterminator='\n')
+    writer.writerow(EXPORT_COLUMNS)
+    n = 0
+    for access_date, package_id, resource_id, access_count in rows:
+        writer.writerow((access_date.isoformat(), package_id, resource_id, access_count))
+        n += 1
+        if n % EXPORT_CHUNK_ROWS == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
+
+def ndjson_chunks(rows):
+    '''Render rows as newline-delimited JSON objects, a chunk of rows at a time.
+
+    >>> import datetime
+    >>> print(''.join(ndjson_chunks([(datetime.date(2020, 5, 20), 'p1', 'r1', 3)])), end='')
+    {"access_date": "2020-05-20", "package_id": "p1", "resource_id": "r1", "access_count": 3}
+    '''
+    lines = []
+    for access_date, package_id, resource_id, access_count in rows:
+        lines.append(json.dumps({'access_date': access_date.isoformat(), 'package_id': package_id,
+            'resource_id': resource_id, 'access_count': access_count}))
+        if len(lines) >= EXPORT_CHUNK_ROWS:
+            yield '\n'.join(lines) + '\n'
+            lines = []
+    if lines:
+        yield '\n'.join(lines) + '\n'
+
+RENDERERS = {FORMAT_CSV: csv_chunks, FORMAT_NDJSON: ndjson_chunks}
+
+def export_chunks(fmt, **filters):
+    '''Generate the rows matching the filters rendered in format fmt, csv or ndjson.
+    '''
+    return RENDERERS[fmt](export_rows(**filters))
@@ -0,0 +1,336 @@
+import collections
+import datetime
+import email.utils
+import logging
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from .metrics import metrics
+
+_log = logging.getLogger(__name__)
+
+# The api.gsa.gov default quota for a registered key.
+DEFAULT_REQUESTS_PER_HOUR = 1000
+DEFAULT_CONCURRENCY = 4
+# The most records the API returns in one page.
+MAX_BATCH_SIZE = 10000
+
+# Retrying throttled and failed requests.
+DEFAULT_MAX_RETRIES = 5
+DEFAULT_BACKOFF_SECONDS = 1.0
+MAX_BACKOFF_SECONDS = 300.0
+RETRY_STATUSES = frozenset((429, 500, 502, 503, 504))
+
+# Page requests taking longer than this are made smaller.
+DEFAULT_TARGET_PAGE_SECONDS = 10.0
+
+
+class DAPRetrievalError(Exception):
+    '''A page of a DAP report could not be retrieved.'''
+
+    def __init__(self, page, message):
+        super().__init__(f'Error retrieving page {page} from DAP API: {message}')
+        self.page = page
+
+
+class TokenBucket(object):
+    '''Thread-safe token bucket rate limiter.
+    Tokens are added at rate per second, up to capacity, and each
+    acquire call blocks until it can take one.
+    '''
+
+    def __init__(self, rate, capacity = 1):
+        self.rate = float(rate)
+        self.capacity = float(capacity)
+        self._tokens = float(capacity)
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+        self._paused_until = 0.0
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    wait = self._paused_until - now
+                else:
+                    self._tokens = min(self.capacity, self._tokens + (now - self._last) * self.rate)
+                    self._last = now
+                    if self._tokens >= 1:
+                        self._tokens -= 1
+                        return
+                    wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+    def pause(self, seconds):
+        '''Hold every acquire call for the given number of seconds, such as
+        while the API asks clients to back off.
+        '''
+        with self._lock:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+
+class SharedRateLimiter(object):
+    '''Rate limiter shared through Redis by every process loading from the
+    DAP API, such as parallel backfill workers and background job workers,
+    so together they stay within one request budget.
+
+    Requests are spaced 1/rate seconds apart, with bursts of up to capacity
+    requests, by keeping the theoretical arrival time of the next request
+    (the generic cell rate algorithm) under a Redis lock.
+    '''
+
+    def __init__(self, redis, rate, capacity = 1, key = 'ckanext.dapr:dap_rate'):
+        self.redis = redis
+        self.interval = 1.0 / float(rate)
+        self.tolerance = (max(1.0, float(capacity)) - 1) * self.interval
+        self.key = key
+
+    def _reserve(self, not_before = 0.0):
+        # Returns the seconds to wait before the reserved request.
+        with self.redis.lock(f'{self.key}:lock', timeout=60):
+            now = time.time()
+            arrival = max(float(self.redis.get(self.key) or 0), now, not_before + self.tolerance)
+            if not_before:
+                self.redis.set(self.key, arrival, ex=3600)
+                return 0.0
+            self.redis.set(self.key, arrival + self.interval, ex=3600)
+            return arrival - self.tolerance - now
+
+    def acquire(self):
+        wait = self._reserve()
+        if wait > 0:
+            time.sleep(wait)
+
+    def pause(self, seconds):
+        '''Hold every process's requests for the given number of seconds,
+        such as while the API asks clients to back off.
+        '''
+        self._reserve(time.time() + seconds)
+
+
+def retry_after_seconds(value, now = None):
+    '''Interpret a Retry-After header, given in seconds or as an HTTP date,
+    as the number of seconds to wait. Returns None if it cannot be read.
+
+    >>> retry_after_seconds('120')
+    120.0
+    >>> now = datetime.datetime(2020, 5, 20, 12, 0, tzinfo=datetime.timezone.utc)
+    >>> retry_after_seconds('Wed, 20 May 2020 12:00:30 GMT', now)
+    30.0
+    >>> retry_after_seconds('soon') is None
+    True
+    '''
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        when = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    now = now or datetime.datetime.now(datetime.timezone.utc)
+    return max(0.0, (when - now).total_seconds())
+
+
+def backoff_seconds(attempt, base = DEFAULT_BACKOFF_SECONDS, cap = MAX_BACKOFF_SECONDS, rng = random.random):
+    '''The wait before retrying a request for the given attempt, counting
+    from 0: exponential backoff with full jitter, so clients throttled
+    together do not retry together.
+
+    >>> backoff_seconds(3, base=1.0, rng=lambda: 0.5)
+    4.0
+    >>> backoff_seconds(20, base=1.0, cap=60.0, rng=lambda: 1.0)
+    60.0
+    '''
+    return rng() * min(cap, base * 2 ** attempt)
+
+
+class PageSizeController(object):
+    '''Choose the size of each page request, in multiples of a unit page.
+
+    Sizes are the unit times a power of two, up to the maximum. A page is
+    requested at a record offset that is a multiple of its size, so the
+    API's page numbers line up with the unit pages that loads checkpoint.
+    The size doubles after a request well within the target latency and
+    halves after a slow, throttled or failed one.
+
+    >>> controller = PageSizeController(unit=1000, maximum=10000, target_seconds=10)
+    >>> controller.succeeded(1, 1.0); controller.size
+    2
+    >>> controller.succeeded(2, 2.0); controller.succeeded(4, 3.0); controller.size
+    8
+    >>> controller.succeeded(8, 6.0); controller.size
+    8
+    >>> controller.plan(4), controller.plan(16)
+    (4, 8)
+    >>> controller.throttled(); controller.size
+    4
+    '''
+
+    def __init__(self, unit, maximum, target_seconds = DEFAULT_TARGET_PAGE_SECONDS):
+        self.unit = unit
+        self.largest = 1
+        while self.largest * 2 * unit <= maximum:
+            self.largest *= 2
+        self.target_seconds = target_seconds
+        # The size of the next request, in unit pages.
+        self.size = 1
+        self._lock = threading.Lock()
+
+    def plan(self, offset):
+        '''The number of unit pages to request at an offset counted in unit pages.
+        '''
+        with self._lock:
+            size = self.size
+        while offset % size:
+            size //= 2
+        return size
+
+    def succeeded(self, size, seconds):
+        with self._lock:
+            if seconds > self.target_seconds:
+                self.size = max(1, min(self.size, size) // 2)
+            elif seconds * 2 <= self.target_seconds and size == self.size:
+                self.size = min(self.largest, self.size * 2)
+
+    def throttled(self):
+        with self._lock:
+            self.size = max(1, self.size // 2)
+
+
+def pooled_session(pool_size):
+    '''Create a requests session that keeps up to pool_size connections open for reuse.
+    '''
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+class PageFetcher(object):
+    '''Retrieve the pages of a paginated DAP report with several requests
+    in flight over one pooled session.
+
+    Pages are handed back in order, each holding the records of one page
+    of the limit given in params. Requests are made ahead in a thread
+    pool, and cover as many of those pages at once as the page size
+    controller allows, up to max_limit records. Throttled and failed
+    requests are retried after the wait the API asks for in Retry-After,
+    or with exponential backoff, while the other requests pause too.
+    Paging stops after the first empty or partial page, and a request
+    still failing after max_retries raises DAPRetrievalError once the
+    pages before it are handed back.
+    '''
+
+    def __init__(self, api_call, headers, params, concurrency = DEFAULT_CONCURRENCY,
+            requests_per_hour = DEFAULT_REQUESTS_PER_HOUR, session = None, max_limit = None,
+            max_retries = DEFAULT_MAX_RETRIES, backoff = DEFAULT_BACKOFF_SECONDS,
+            target_seconds = DEFAULT_TARGET_PAGE_SECONDS, limiter = None):
+        self.api_call = api_call
+        self.headers = headers
+        self.params = dict(params)
+        self.concurrency = max(1, int(concurrency))
+        if limiter is None:
+            limiter = TokenBucket(float(requests_per_hour) / 3600, capacity=self.concurrency)
+        self.limiter = limiter
+        self.session = session if session is not None else pooled_session(self.concurrency)
+        self.limit = int(self.params.pop('limit', 1000))
+        self.controller = PageSizeController(self.limit, int(max_limit or self.limit), float(target_seconds))
+        self.max_retries = int(max_retries)
+        self.backoff = float(backoff)
+
+    def _retry_wait(self, page, attempt, message, retry_after = None):
+        if attempt >= self.max_retries:
+            raise DAPRetrievalError(page, message)
+        self.controller.throttled()
+        wait = retry_after_seconds(retry_after)
+        if wait is None:
+            wait = backoff_seconds(attempt, self.backoff)
+        else:
+            # Every request waits as long as the API asked.
+            self.limiter.pause(wait)
+        metrics.count('requests_retried')
+        _log.warning('Retrying DAP API request for page %s in %.1f seconds after %s.', page, wait, message)
+        time.sleep(wait)
+
+    def fetch(self, page, size = 1):
+        '''Request size pages at once from the given page, counted in pages
+        of the configured limit, and return their decoded records.
+        Raises DAPRetrievalError on a request failing after the retries.
+        '''
+        # The API numbers pages of the requested limit.
+        limit = self.limit * size
+        params = dict(self.params, page=(page - 1) // size + 1, limit=limit)
+        for attempt in range(self.max_retries + 1):
+            self.limiter.acquire()
+            began = time.perf_counter()
+            try:
+                with metrics.phase('fetch'):
+                    result = self.session.get(self.api_call, headers=self.headers, params=params)
+            except requests.RequestException as e:
+                _log.exception('Error retrieving analytics from DAP API.', extra={'Page': page})
+                self._retry_wait(page, attempt, str(e))
+                continue
+            if result.status_code in RETRY_STATUSES:
+                _log.error('Error retrieving analytics from DAP API.',
+                    extra = {'Page': page, 'Limit': limit, 'Status code': result.status_code,
+                        'Message': result.text})
+                self._retry_wait(page, attempt, f'status {result.status_code}',
+                    result.headers.get('Retry-After'))
+                continue
+            if result.status_code != 200:
+                _log.error('Error retrieving analytics from DAP API.',
+                    extra = {'Page': page, 'Limit': limit,
+                        'Status code': result.status_code,
+                        'Message': result.text}
+                )
+                raise DAPRetrievalError(page, f'status {result.status_code}')
+            self.controller.succeeded(size, time.perf_counter() - began)
+            metrics.count('pages_fetched')
+            metrics.count('bytes_downloaded', len(result.content))
+            with metrics.phase('decode'):
+                records = result.json()
+            metrics.count('records_fetched', len(records))
+            return records
+
+    def pages(self, first_page = 1):
+        '''Generate the decoded pages in order, starting at first_page.
+        '''
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            pending = collections.deque()
+            next_page = first_page
+
+            def submit():
+                nonlocal next_page
+                size = self.controller.plan(next_page - 1)
+                pending.append((size, executor.submit(self.fetch, next_page, size)))
+                next_page += size
+
+            for _ in range(self.concurrency):
+                submit()
+            try:
+                while pending:
+                    size, future = pending.popleft()
+                    with metrics.phase('fetch_wait'):
+                        jr = future.result()
+                    if not jr:
+                        return
+                    submit()
+                    for start in range(0, len(jr), self.limit):
+                        yield jr[start:start + self.limit]
+                    if len(jr) < self.limit * size:
+                        # A partial page is the last one.
+                        return
+            finally:
+                for _, future in pending:
+                    future.cancel()
@@ -0,0 +1,56 @@
+import datetime
+
+from ckan.common import g
+from ckan.plugins.toolkit import asbool, config
+
+from . import cache, daputil
+
+SPARKLINE_DAYS = 30
+SPARKLINE_WIDTH = 100
+SPARKLINE_HEIGHT = 20
+
+def show_downloads() -> bool:
+    '''Whether resource pages should display their download counts.
+    '''
+    return asbool(config.get('ckanext.dapr.show_downloads', True))
+
+def resource_downloads(package_id) -> dict:
+    '''Map each of a package's resource ids to its download count.
+    The counts for all of the package's resources are retrieved with one
+    query and remembered for the rest of the request, so templates can
+    look up a count per resource at no extra cost.
+    '''
+    try:
+        memo = g.setdefault('dapr_resource_downloads', {})
+    except (AttributeError, RuntimeError):
+        # Not rendering within a request.
+        return daputil.package_resource_accesses(package_id)
+    if package_id not in memo:
+        memo[package_id] = daputil.package_resource_accesses(package_id)
+    return memo[package_id]
+
+def _sparkline_points(counts):
+    '''Scale counts to the points of an SVG polyline filling the sparkline box.
+
+    >>> _sparkline_points([0, 5, 10])
+    '0.0,20.0 50.0,10.0 100.0,0.0'
+    '''
+    peak = max(counts) or 1
+    step = SPARKLINE_WIDTH / max(len(counts) - 1, 1)
+    return ' '.join(f'{i * step:.1f},{SPARKLINE_HEIGHT - c * SPARKLINE_HEIGHT / peak:.1f}'
+        for i, c in enumerate(counts))
+
+def download_sparkline(package_id, days = SPARKLINE_DAYS) -> dict:
+    '''Summarize a package's daily downloads over the latest days with
+    recorded accesses, for drawing a sparkline: the first and last day,
+    the daily counts, their total and the SVG polyline points.
+    The result is cached until the next load records new access counts.
+    '''
+    def compute():
+        end_date = daputil.latest_resource_access() or datetime.date.today()
+        start_date = end_date - datetime.timedelta(days=days - 1)
+        counts = [count for _, count in daputil.access_series(start_date, end_date, 'day', package_id)]
+        return {'start_date': start_date.isoformat(), 'end_date': end_date.isoformat(),
+            'counts': counts, 'total': sum(counts), 'points': _sparkline_points(counts)}
+
+    return cache.cached(cache.cache_key('sparkline', package_id, days), compute)
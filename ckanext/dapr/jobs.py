@@ -0,0 +1,179 @@
+import datetime
+import logging
+import traceback
+
+import ckan.model as model
+from ckan.lib.jobs import job_from_id
+from ckan.lib.redis import connect_to_redis
+from ckan.plugins.toolkit import asint, config, enqueue_job
+
+from . import daputil
+
+_log = logging.getLogger(__name__)
+
+_LOCK_PREFIX = 'ckanext.dapr:load_lock'
+_REFRESH_LOCK = 'ckanext.dapr:refresh_lock'
+
+DEFAULT_JOB_TIMEOUT = 4 * 60 * 60
+
+STATUS_QUEUED = 'queued'
+STATUS_RUNNING = 'running'
+STATUS_FAILED = 'failed'
+STATUS_DONE = 'done'
+
+# RQ statuses of a job that will not load its window any more.
+_ENDED_JOB_STATUSES = ('finished', 'failed', 'stopped', 'canceled')
+
+
+def _queue():
+    return config.get('ckanext.dapr.jobs_queue', 'default')
+
+def _job_timeout():
+    return asint(config.get('ckanext.dapr.job_timeout', DEFAULT_JOB_TIMEOUT))
+
+def _window_lock(redis, start_date, end_date):
+    # The lock expires with the job timeout, so a killed worker cannot hold a window forever.
+    return redis.lock(f'{_LOCK_PREFIX}:{start_date}:{end_date}', timeout=_job_timeout())
+
+def _enqueue(checkpoint):
+    job = enqueue_job(load_window, [checkpoint.id],
+        title=f'DAP load {checkpoint.start_date} to {checkpoint.end_date}', queue=_queue(),
+        rq_kwargs={'timeout': _job_timeout()})
+    checkpoint.job_id = job.id
+    checkpoint.error = None
+    model.Session.commit()
+
+def _job_lost(checkpoint):
+    # A worker killed while loading a window records no error; RQ marks
+    # its job failed, or the job's record has expired.
+    try:
+        job = job_from_id(checkpoint.job_id)
+    except KeyError:
+        return True
+    return job.get_status() in _ENDED_JOB_STATUSES
+
+def _failed(checkpoint, redis):
+    '''Whether the unfinished window of a checkpoint stopped with an error,
+    or its job ended without loading it and no worker is loading it.
+    '''
+    if checkpoint.error is not None:
+        return True
+    return not _window_lock(redis, checkpoint.start_date, checkpoint.end_date).locked() and \
+        _job_lost(checkpoint)
+
+def enqueue_windows(start_date, end_date, days, source = daputil.SOURCE_API, only_changed = False):
+    '''Queue a background job to load each date window of a range, writing
+    only the changed counts with only_changed. Windows already queued or
+    running are skipped, and windows whose last job failed or was lost
+    are queued again to continue after their last written page.
+    Returns the checkpoints of the windows queued.
+    '''
+    redis = connect_to_redis()
+    queued = []
+    for window_start, window_end in daputil.date_windows(start_date, end_date, days):
+        checkpoint = model.Session.query(daputil.DAPLoadCheckpoint)\
+            .filter(daputil.DAPLoadCheckpoint.job_id != None)\
+            .filter(daputil.DAPLoadCheckpoint.start_date == window_start)\
+            .filter(daputil.DAPLoadCheckpoint.end_date == window_end)\
+            .filter(daputil.DAPLoadCheckpoint.completed == False)\
+            .order_by(daputil.DAPLoadCheckpoint.started.desc()).first()
+        if checkpoint is not None and not _failed(checkpoint, redis):
+            _log.info('DAP load of %s to %s is already queued.', window_start, window_end)
+            continue
+        if checkpoint is None:
+            now = datetime.datetime.utcnow()
+            checkpoint = daputil.DAPLoadCheckpoint(start_date=window_start, end_date=window_end,
+                source=source, only_changed=only_changed, page=0, rows_written=0, completed=False,
+                started=now, updated=now)
+            model.Session.add(checkpoint)
+            model.Session.flush()
+            daputil.supersede_checkpoints(checkpoint)
+        _enqueue(checkpoint)
+        queued.append(checkpoint)
+    return queued
+
+def retry_failed():
+    '''Queue again the windows whose last job failed or was lost. Returns
+    their checkpoints.
+    '''
+    redis = connect_to_redis()
+    unfinished = model.Session.query(daputil.DAPLoadCheckpoint)\
+        .filter(daputil.DAPLoadCheckpoint.job_id != None)\
+        .filter(daputil.DAPLoadCheckpoint.completed == False).all()
+    failed = [checkpoint for checkpoint in unfinished if _failed(checkpoint, redis)]
+    for checkpoint in failed:
+        _enqueue(checkpoint)
+    return failed
+
+def load_window(checkpoint_id):
+    '''Background job loading one date window, continuing its checkpoint.
+    A window being loaded by another worker is left to it. The rollups of
+    the months whose counts changed are refreshed afterwards, one job at a time.
+    '''
+    checkpoint = model.Session.query(daputil.DAPLoadCheckpoint).get(checkpoint_id)
+    if checkpoint is None or checkpoint.completed:
+        return
+    redis = connect_to_redis()
+    lock = _window_lock(redis, checkpoint.start_date, checkpoint.end_date)
+    if not lock.acquire(blocking=False):
+        _log.info('DAP load of %s to %s is running in another job.', checkpoint.start_date,
+            checkpoint.end_date)
+        return
+    try:
+        try:
+            written, months = daputil.load_window(checkpoint.start_date, checkpoint.end_date, checkpoint)
+        except Exception as e:
+            model.Session.rollback()
+            checkpoint = model.Session.query(daputil.DAPLoadCheckpoint).get(checkpoint_id)
+            checkpoint.error = ''.join(traceback.format_exception_only(type(e), e)).strip()
+            checkpoint.updated = datetime.datetime.utcnow()
+            model.Session.commit()
+            raise
+        with redis.lock(_REFRESH_LOCK, timeout=_job_timeout()):
+            if months:
+                daputil.refresh_downloads(months)
+            else:
+                daputil.reindex_downloads()
+        _log.info('Recorded %d DAP resource access counts for %s to %s', written,
+            checkpoint.start_date, checkpoint.end_date)
+    finally:
+        lock.release()
+
+def checkpoint_status(checkpoint, redis = None):
+    if checkpoint.completed:
+        return STATUS_DONE
+    if checkpoint.error is not None:
+        return STATUS_FAILED
+    redis = redis or connect_to_redis()
+    if _window_lock(redis, checkpoint.start_date, checkpoint.end_date).locked():
+        return STATUS_RUNNING
+    if _job_lost(checkpoint):
+        return STATUS_FAILED
+    return STATUS_QUEUED
+
+def load_status(limit = 100):
+    '''Describe the latest background load windows, latest first, as
+    dictionaries with their dates, status, progress and any error.
+    '''
+    redis = connect_to_redis()
+    checkpoints = model.Session.query(daputil.DAPLoadCheckpoint)\
+        .filter(daputil.DAPLoadCheckpoint.job_id != None)\
+        .order_by(daputil.DAPLoadCheckpoint.started.desc(), daputil.DAPLoadCheckpoint.start_date)\
+        .limit(limit)
+    windows = []
+    for c in checkpoints:
+        status = checkpoint_status(c, redis)
+        error = c.error
+        if status == STATUS_FAILED and error is None:
+            error = 'The load job ended without finishing the window.'
+        windows.append({
+            'id': c.id,
+            'start_date': c.start_date.isoformat() if c.start_date else None,
+            'end_date': c.end_date.isoformat() if c.end_date else None,
+            'status': status,
+            'pages': c.page,
+            'rows_written': c.rows_written,
+            'updated': c.updated.isoformat() if c.updated else None,
+            'error': error,
+        })
+    return windows
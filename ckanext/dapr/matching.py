@@ -0,0 +1,232 @@
+import collections
+import datetime
+import logging
+import re
+import threading
+from urllib.parse import urlsplit
+
+from sqlalchemy import func, or_
+
+import ckan.model as model
+from ckan.plugins.toolkit import aslist, config
+
+_log = logging.getLogger(__name__)
+
+_DEFAULT_PORTS = {'http': 80, 'https': 443}
+
+# The path of a resource file served by CKAN, which carries the resource id.
+DOWNLOAD_PATH_PATTERN = r'/dataset/(?P<package>[^/]+)/resource/(?P<resource>[0-9a-fA-F-]{36})/download/'
+
+def normalize_url(url: str) -> str:
+    '''Reduce a URL to the form used as a key in the resource URL index.
+    The scheme, default port, fragment and trailing slash are dropped and
+    the host name is lower cased, so a resource URL recorded as http and
+    the https URL constructed from a DAP record compare equal.
+
+    >>> normalize_url('HTTPS://Example.usa.gov:443/Data/file.csv#top')
+    'example.usa.gov/Data/file.csv'
+    >>> normalize_url('https://example.usa.gov:8443/file.csv?v=2')
+    'example.usa.gov:8443/file.csv?v=2'
+    >>> normalize_url('example.usa.gov/downloads/')
+    'example.usa.gov/downloads'
+    '''
+    if url is None:
+        return None
+    url = url.strip()
+    if '://' not in url:
+        url = f'https://{url}'
+    try:
+        parts = urlsplit(url)
+        host = (parts.hostname or '').lower()
+        port = parts.port
+    except ValueError:
+        return None
+    if port is not None and port != _DEFAULT_PORTS.get(parts.scheme.lower()):
+        host = f'{host}:{port}'
+    path = parts.path.rstrip('/')
+    key = f'{host}{path}'
+    if parts.query:
+        key += f'?{parts.query}'
+    return key
+
+
+class DownloadPathMatcher(object):
+    '''Extract resource ids from the file paths of DAP records for the local
+    site, such as CKAN's own /dataset/<id>/resource/<id>/download/<file>
+    URLs, so those records need no URL lookup.
+
+    >>> matcher = DownloadPathMatcher(['data.example.gov'])
+    >>> matcher.resource_id('data.example.gov', '/dataset/d/resource/80bc1b6e-f748-4b2e-81a6-746d8fcbd975/download/a.csv')
+    '80bc1b6e-f748-4b2e-81a6-746d8fcbd975'
+    >>> matcher.resource_id('other.example.gov', '/dataset/d/resource/80bc1b6e-f748-4b2e-81a6-746d8fcbd975/download/a.csv') is None
+    True
+    '''
+
+    def __init__(self, hosts, patterns = (DOWNLOAD_PATH_PATTERN,)):
+        self.hosts = {h.lower() for h in hosts if h}
+        self.patterns = [re.compile(p) for p in patterns]
+
+    def is_local(self, host):
+        return host.lower() in self.hosts
+
+    def stamp(self):
+        '''A string identifying the hosts and patterns, for telling when they change.
+        '''
+        return ' '.join(sorted(self.hosts) + [p.pattern for p in self.patterns])
+
+    def resource_id(self, host, path):
+        '''The resource id in a local site path, or None if the host is not
+        local or the path matches no pattern.
+        '''
+        if not self.is_local(host):
+            return None
+        for pattern in self.patterns:
+            match = pattern.search(path)
+            if match is not None:
+                return match.group('resource')
+        return None
+
+
+def configured_path_matcher():
+    '''A DownloadPathMatcher for the host of ckan.site_url and any hosts in
+    ckanext.dapr.local_hosts, with CKAN's download path pattern and any
+    patterns in ckanext.dapr.download_path_patterns, each with a resource group.
+    '''
+    hosts = aslist(config.get('ckanext.dapr.local_hosts', ''))
+    site_url = config.get('ckan.site_url', None)
+    if site_url:
+        hosts.append(normalize_url(site_url).split('/')[0])
+    patterns = [DOWNLOAD_PATH_PATTERN] + aslist(config.get('ckanext.dapr.download_path_patterns', ''))
+    return DownloadPathMatcher(hosts, patterns)
+
+
+class ResourceURLIndex(object):
+    '''In-memory map from normalized resource URL to the
+    (resource id, package id) pair of the resource using that URL, and
+    from resource id to package id for checking ids taken from download paths.
+    The hosts of the indexed URLs are kept too, so records from sites no
+    resource links to can be dropped before any lookup.
+
+    The index is filled with one bulk query against the resource table
+    and kept current afterwards through the plugin's IResourceController
+    hooks, so matching a DAP record is a dictionary lookup.
+    '''
+
+    def __init__(self):
+        self._by_url = {}
+        self._url_by_id = {}
+        self._package_by_id = {}
+        self._hosts = collections.Counter()
+        self._lock = threading.RLock()
+        self.loaded = False
+
+    def __len__(self):
+        return len(self._by_url)
+
+    def load(self, batch_size = 5000):
+        '''(Re)build the index from the active resources of active packages.
+        '''
+        by_url = {}
+        url_by_id = {}
+        package_by_id = {}
+        hosts = collections.Counter()
+        query = model.Session.query(model.Resource.id, model.Resource.package_id, model.Resource.url)\
+            .join(model.Package, model.Package.id == model.Resource.package_id)\
+            .filter(model.Resource.state == 'active')\
+            .filter(model.Package.state == 'active')\
+            .order_by(model.Resource.created)
+        for res_id, pkg_id, url in query.yield_per(batch_size):
+            package_by_id[res_id] = pkg_id
+            key = normalize_url(url)
+            if not key:
+                continue
+            # Keep the first resource seen for a URL shared by several resources,
+            # matching the single result the former resource_search lookup used.
+            by_url.setdefault(key, (res_id, pkg_id))
+            url_by_id[res_id] = key
+            hosts[_host(key)] += 1
+        with self._lock:
+            self._by_url = by_url
+            self._url_by_id = url_by_id
+            self._package_by_id = package_by_id
+            self._hosts = hosts
+            self.loaded = True
+        _log.info('Loaded %d resource URLs into the DAP matching index.', len(by_url))
+
+    def ensure_loaded(self):
+        if not self.loaded:
+            self.load()
+
+    def lookup(self, url):
+        '''Return the (resource id, package id) pair for a URL, or (None, None).
+        '''
+        return self._by_url.get(normalize_url(url), (None, None))
+
+    def has_host(self, host):
+        '''Whether any indexed resource URL is on a host, given as in a normalized URL.
+        '''
+        return self._hosts[host.lower()] > 0
+
+    def lookup_id(self, resource_id):
+        '''Return the (resource id, package id) pair for the id of an active
+        resource, or (None, None).
+        '''
+        pkg_id = self._package_by_id.get(resource_id)
+        if pkg_id is None:
+            return None, None
+        return resource_id, pkg_id
+
+    def add(self, resource):
+        '''Record or refresh the URL of a resource dictionary.
+        '''
+        res_id = resource.get('id')
+        if res_id is None:
+            return
+        with self._lock:
+            self._discard(res_id)
+            self._package_by_id[res_id] = resource.get('package_id')
+            key = normalize_url(resource.get('url'))
+            if key:
+                self._by_url.setdefault(key, (res_id, resource.get('package_id')))
+                self._url_by_id[res_id] = key
+                self._hosts[_host(key)] += 1
+
+    def remove(self, resource_id):
+        with self._lock:
+            self._discard(resource_id)
+
+    def _discard(self, resource_id):
+        self._package_by_id.pop(resource_id, None)
+        key = self._url_by_id.pop(resource_id, None)
+        if key is not None:
+            self._hosts[_host(key)] -= 1
+        if key is not None and self._by_url.get(key, (None,))[0] == resource_id:
+            del self._by_url[key]
+
+
+def _host(key):
+    return key.split('/', 1)[0]
+
+def resources_modified():
+    '''The time, as an ISO string, at which a resource or package was last
+    created or modified, for telling when earlier matching results may be
+    stale. Empty when there are none.
+    '''
+    resources = model.Session.query(func.max(model.Resource.metadata_modified)).scalar()
+    packages = model.Session.query(func.max(model.Package.metadata_modified)).scalar()
+    latest = max((t for t in (resources, packages) if t is not None), default=None)
+    return latest.isoformat() if latest is not None else ''
+
+
+def urls_modified_since(since):
+    '''The normalized URLs of the resources created or modified after an
+    ISO time from resources_modified, or in packages modified after it.
+    '''
+    since = datetime.datetime.fromisoformat(since)
+    query = model.Session.query(model.Resource.url)\
+        .join(model.Package, model.Package.id == model.Resource.package_id)\
+        .filter(or_(model.Resource.metadata_modified > since, model.Package.metadata_modified > since))
+    return {normalize_url(url) for url, in query}
+
+
+url_index = ResourceURLIndex()
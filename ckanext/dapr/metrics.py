@@ -0,0 +1,220 @@
+import bisect
+import collections
+import contextlib
+import functools
+import json
+import logging
+import threading
+import time
+
+from ckan.lib.redis import connect_to_redis
+
+_log = logging.getLogger(__name__)
+
+_LAST_LOAD_KEY = 'ckanext.dapr:last_load_metrics'
+
+# Phases of a load, in pipeline order, for reporting.
+LOAD_PHASES = ('fetch', 'fetch_wait', 'decode', 'match', 'write', 'rollup', 'index')
+LOAD_COUNTERS = ('pages_fetched', 'requests_retried', 'bytes_downloaded', 'records_fetched',
+    'records_seen', 'records_matched', 'records_skipped', 'rows_written', 'rows_inserted',
+    'rows_changed', 'rows_unchanged')
+
+# Latency histogram bucket upper bounds in seconds, as in the Prometheus client defaults.
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.075, 0.1, 0.25, 0.5, 0.75, 1.0, 2.5, 5.0, 7.5, 10.0)
+
+
+class Metrics(object):
+    '''Thread-safe registry of load phase timings and counters, and of
+    report query latency histograms, for the current process.
+    '''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.phases = collections.defaultdict(float)
+            self.counters = collections.defaultdict(int)
+            self.histograms = {}
+
+    def reset_load(self):
+        '''Clear the load timings and counters before a new load, keeping the report latencies.
+        '''
+        with self._lock:
+            self.phases = collections.defaultdict(float)
+            self.counters = collections.defaultdict(int)
+
+    def count(self, name, n = 1):
+        with self._lock:
+            self.counters[name] += n
+
+    def add_time(self, name, seconds):
+        with self._lock:
+            self.phases[name] += seconds
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        '''Add the time spent in the enclosed block to a load phase.
+        '''
+        began = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(name, time.perf_counter() - began)
+
+    def observe(self, name, seconds):
+        '''Record one latency observation for a report query.
+        '''
+        with self._lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = {
+                    'buckets': [0] * len(LATENCY_BUCKETS), 'count': 0, 'sum': 0.0}
+            index = bisect.bisect_left(LATENCY_BUCKETS, seconds)
+            if index < len(LATENCY_BUCKETS):
+                histogram['buckets'][index] += 1
+            histogram['count'] += 1
+            histogram['sum'] += seconds
+
+    def timed(self, name):
+        '''Decorate a report query function to record its latency.
+        '''
+        def decorator(func):
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                began = time.perf_counter()
+                try:
+                    return func(*args, **kwargs)
+                finally:
+                    self.observe(name, time.perf_counter() - began)
+            return wrapper
+        return decorator
+
+    def snapshot(self):
+        '''The load phase timings and counters, as a JSON-serializable dictionary.
+        '''
+        with self._lock:
+            return {'phases': dict(self.phases), 'counters': dict(self.counters)}
+
+    def histogram_snapshot(self):
+        with self._lock:
+            return {name: dict(h, buckets=list(h['buckets'])) for name, h in self.histograms.items()}
+
+    def merge(self, snapshot):
+        '''Add the load timings and counters of another process, such as a backfill worker.
+        '''
+        with self._lock:
+            for name, seconds in snapshot.get('phases', {}).items():
+                self.phases[name] += seconds
+            for name, n in snapshot.get('counters', {}).items():
+                self.counters[name] += n
+
+
+metrics = Metrics()
+
+
+def throughput(snapshot, elapsed):
+    '''The records fetched from the DAP API per second of a load.
+
+    >>> throughput({'counters': {'records_fetched': 5000}}, 2.0)
+    2500.0
+    '''
+    return snapshot['counters'].get('records_fetched', 0) / elapsed if elapsed else 0.0
+
+
+def format_summary(snapshot, elapsed = None):
+    '''Render load timings and counters as a plain text table, with the
+    effective API throughput when the elapsed time is given.
+
+    >>> print(format_summary({'phases': {'fetch': 1.5}, 'counters': {'pages_fetched': 3}}))
+    Phase                 Seconds
+    fetch                   1.500
+    fetch_wait              0.000
+    decode                  0.000
+    match                   0.000
+    write                   0.000
+    rollup                  0.000
+    index                   0.000
+    Counter                 Value
+    pages_fetched               3
+    requests_retried            0
+    bytes_downloaded            0
+    records_fetched             0
+    records_seen                0
+    records_matched             0
+    records_skipped             0
+    rows_written                0
+    rows_inserted               0
+    rows_changed                0
+    rows_unchanged              0
+    '''
+    lines = [f"{'Phase':<16} {'Seconds':>12}"]
+    for name in LOAD_PHASES:
+        lines.append(f"{name:<16} {snapshot['phases'].get(name, 0.0):>12.3f}")
+    if elapsed is not None:
+        lines.append(f"{'total elapsed':<16} {elapsed:>12.3f}")
+    lines.append(f"{'Counter':<16} {'Value':>12}")
+    for name in LOAD_COUNTERS:
+        lines.append(f"{name:<16} {snapshot['counters'].get(name, 0):>12}")
+    if elapsed is not None:
+        lines.append(f"{'records/second':<16} {throughput(snapshot, elapsed):>12.1f}")
+    return '\n'.join(lines)
+
+
+def publish_load(snapshot, elapsed = None):
+    '''Save the metrics of a finished load, and how long it took, in CKAN's
+    Redis store, so the web processes can expose them.
+    '''
+    if elapsed is not None:
+        snapshot = dict(snapshot, elapsed=elapsed)
+    try:
+        connect_to_redis().set(_LAST_LOAD_KEY, json.dumps(dict(snapshot, finished=time.time())))
+    except Exception:
+        _log.exception('Error saving DAP load metrics.')
+
+
+def _last_load():
+    try:
+        value = connect_to_redis().get(_LAST_LOAD_KEY)
+        return json.loads(value) if value is not None else None
+    except Exception:
+        _log.exception('Error reading DAP load metrics.')
+        return None
+
+
+def prometheus_text():
+    '''Render the last load's metrics and this process's report query
+    latency histograms in the Prometheus text exposition format.
+    '''
+    lines = []
+    last = _last_load()
+    if last is not None:
+        lines.append('# HELP dapr_last_load_phase_seconds Time spent in each phase of the last DAP load.')
+        lines.append('# TYPE dapr_last_load_phase_seconds gauge')
+        for name in LOAD_PHASES:
+            lines.append(f'dapr_last_load_phase_seconds{{phase="{name}"}} {last["phases"].get(name, 0.0)}')
+        lines.append('# HELP dapr_last_load_count Counts of pages, bytes, records and rows in the last DAP load.')
+        lines.append('# TYPE dapr_last_load_count gauge')
+        for name in LOAD_COUNTERS:
+            lines.append(f'dapr_last_load_count{{counter="{name}"}} {last["counters"].get(name, 0)}')
+        if 'elapsed' in last:
+            lines.append('# HELP dapr_last_load_records_per_second Records fetched from the DAP API per second in the last DAP load.')
+            lines.append('# TYPE dapr_last_load_records_per_second gauge')
+            lines.append(f'dapr_last_load_records_per_second {throughput(last, last["elapsed"])}')
+        lines.append('# HELP dapr_last_load_finished_timestamp_seconds When the last DAP load finished.')
+        lines.append('# TYPE dapr_last_load_finished_timestamp_seconds gauge')
+        lines.append(f'dapr_last_load_finished_timestamp_seconds {last["finished"]}')
+
+    histograms = metrics.histogram_snapshot()
+    lines.append('# HELP dapr_report_query_seconds Latency of the DAP report queries.')
+    lines.append('# TYPE dapr_report_query_seconds histogram')
+    for name, histogram in sorted(histograms.items()):
+        cumulative = 0
+        for bound, n in zip(LATENCY_BUCKETS, histogram['buckets']):
+            cumulative += n
+            lines.append(f'dapr_report_query_seconds_bucket{{query="{name}",le="{bound}"}} {cumulative}')
+        lines.append(f'dapr_report_query_seconds_bucket{{query="{name}",le="+Inf"}} {histogram["count"]}')
+        lines.append(f'dapr_report_query_seconds_sum{{query="{name}"}} {histogram["sum"]}')
+        lines.append(f'dapr_report_query_seconds_count{{query="{name}"}} {histogram["count"]}')
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,30 @@
+"""Add load checkpoint job id and error
+
+Revision ID: 3b9d6f0e2c41
+Revises: 8e21b4c07d5a
+Create Date: 2026-10-18 14:52:31.604118
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3b9d6f0e2c41'
+down_revision = '8e21b4c07d5a'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # The columns are already there when ckan dapr init created the tables.
+    columns = {c['name'] for c in sa.inspect(op.get_bind()).get_columns('dap_load_checkpoints')}
+    if 'job_id' not in columns:
+        op.add_column('dap_load_checkpoints', sa.Column('job_id', sa.String(64)))
+    if 'error' not in columns:
+        op.add_column('dap_load_checkpoints', sa.Column('error', sa.Text))
+
+
+def downgrade():
+    op.drop_column('dap_load_checkpoints', 'error')
+    op.drop_column('dap_load_checkpoints', 'job_id')
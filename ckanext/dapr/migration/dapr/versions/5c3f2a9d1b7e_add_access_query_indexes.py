@@ -0,0 +1,133 @@
+"""Add access query indexes
+
+Revision ID: 5c3f2a9d1b7e
+Revises:
+Create Date: 2026-10-18 09:12:41.506339
+
+"""
+import datetime
+
+from alembic import op
+import sqlalchemy as sa
+
+from ckan.plugins.toolkit import asbool, config
+
+
+# revision identifiers, used by Alembic.
+revision = '5c3f2a9d1b7e'
+down_revision = None
+branch_labels = None
+depends_on = None
+
+_DAP_FIRST_MONTH = datetime.date(2018, 11, 1)
+
+
+def _create_missing_tables():
+    # Sites set up with ``ckan dapr init`` before migrations existed
+    # already have these tables, which are left as they are.
+    existing = sa.inspect(op.get_bind()).get_table_names()
+    if 'dap_resource_accesses' not in existing:
+        op.create_table(
+            'dap_resource_accesses',
+            sa.Column('resource_id', sa.String(60), primary_key=True),
+            sa.Column('access_date', sa.Date, primary_key=True),
+            sa.Column('package_id', sa.String(60)),
+            sa.Column('access_count', sa.Integer),
+        )
+    if 'dap_resource_monthly' not in existing:
+        op.create_table(
+            'dap_resource_monthly',
+            sa.Column('resource_id', sa.String(60), primary_key=True),
+            sa.Column('month', sa.Date, primary_key=True),
+            sa.Column('package_id', sa.String(60)),
+            sa.Column('access_count', sa.Integer),
+        )
+    if 'dap_package_monthly' not in existing:
+        op.create_table(
+            'dap_package_monthly',
+            sa.Column('package_id', sa.String(60), primary_key=True),
+            sa.Column('month', sa.Date, primary_key=True),
+            sa.Column('access_count', sa.Integer),
+        )
+    if 'dap_resource_totals' not in existing:
+        op.create_table(
+            'dap_resource_totals',
+            sa.Column('resource_id', sa.String(60), primary_key=True),
+            sa.Column('package_id', sa.String(60)),
+            sa.Column('access_count', sa.Integer),
+        )
+    if 'dap_package_totals' not in existing:
+        op.create_table(
+            'dap_package_totals',
+            sa.Column('package_id', sa.String(60), primary_key=True),
+            sa.Column('access_count', sa.Integer),
+        )
+    if 'dap_load_checkpoints' not in existing:
+        op.create_table(
+            'dap_load_checkpoints',
+            sa.Column('id', sa.Integer, primary_key=True),
+            sa.Column('start_date', sa.Date),
+            sa.Column('end_date', sa.Date),
+            sa.Column('page', sa.Integer),
+            sa.Column('rows_written', sa.Integer),
+            sa.Column('completed', sa.Boolean),
+            sa.Column('started', sa.DateTime),
+            sa.Column('updated', sa.DateTime),
+        )
+
+
+def _next_month(d):
+    if d.month == 12:
+        return datetime.date(d.year + 1, 1, 1)
+    return datetime.date(d.year, d.month + 1, 1)
+
+
+def _partition_accesses():
+    # Recreate the daily table partitioned by month, with partitions from
+    # the first DAP month through the end of next year and a default
+    # partition for any dates outside them, then copy the rows over.
+    op.rename_table('dap_resource_accesses', 'dap_resource_accesses_unpartitioned')
+    op.execute('ALTER TABLE dap_resource_accesses_unpartitioned '
+        'RENAME CONSTRAINT dap_resource_accesses_pkey TO dap_resource_accesses_unpartitioned_pkey')
+    op.execute('''
+        CREATE TABLE dap_resource_accesses (
+            resource_id varchar(60) NOT NULL,
+            access_date date NOT NULL,
+            package_id varchar(60),
+            access_count integer,
+            CONSTRAINT dap_resource_accesses_pkey PRIMARY KEY (resource_id, access_date)
+        ) PARTITION BY RANGE (access_date)
+    ''')
+    month = _DAP_FIRST_MONTH
+    last = datetime.date(datetime.date.today().year + 1, 12, 1)
+    while month <= last:
+        op.execute(f"CREATE TABLE dap_resource_accesses_{month:%Y_%m} PARTITION OF dap_resource_accesses "
+            f"FOR VALUES FROM ('{month}') TO ('{_next_month(month)}')")
+        month = _next_month(month)
+    op.execute('CREATE TABLE dap_resource_accesses_default PARTITION OF dap_resource_accesses DEFAULT')
+    op.execute('INSERT INTO dap_resource_accesses (resource_id, access_date, package_id, access_count) '
+        'SELECT resource_id, access_date, package_id, access_count FROM dap_resource_accesses_unpartitioned')
+    op.drop_table('dap_resource_accesses_unpartitioned')
+
+
+def upgrade():
+    _create_missing_tables()
+    if op.get_bind().dialect.name == 'postgresql' and \
+            asbool(config.get('ckanext.dapr.partition_accesses', False)):
+        _partition_accesses()
+    # Serve the per-package totals, top lists and date range filters. The
+    # indexes are already there when ckan dapr init created the tables.
+    existing = {i['name'] for i in sa.inspect(op.get_bind()).get_indexes('dap_resource_accesses')}
+    if 'ix_dap_resource_accesses_package_date' not in existing:
+        op.create_index('ix_dap_resource_accesses_package_date', 'dap_resource_accesses',
+            ['package_id', 'access_date'])
+    if 'ix_dap_resource_accesses_access_date' not in existing:
+        op.create_index('ix_dap_resource_accesses_access_date', 'dap_resource_accesses',
+            ['access_date'])
+
+
+def downgrade():
+    # The tables are kept, since they may hold counts loaded before
+    # the migrations were introduced.
+    op.drop_index('ix_dap_resource_accesses_access_date', 'dap_resource_accesses')
+    op.drop_index('ix_dap_resource_accesses_package_date', 'dap_resource_accesses')
@@ -0,0 +1,27 @@
+"""Add load checkpoint source
+
+Revision ID: 8e21b4c07d5a
+Revises: 5c3f2a9d1b7e
+Create Date: 2026-10-18 13:40:07.218954
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '8e21b4c07d5a'
+down_revision = '5c3f2a9d1b7e'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # The column is already there when ckan dapr init created the tables.
+    columns = {c['name'] for c in sa.inspect(op.get_bind()).get_columns('dap_load_checkpoints')}
+    if 'source' not in columns:
+        op.add_column('dap_load_checkpoints', sa.Column('source', sa.String(10)))
+
+
+def downgrade():
+    op.drop_column('dap_load_checkpoints', 'source')
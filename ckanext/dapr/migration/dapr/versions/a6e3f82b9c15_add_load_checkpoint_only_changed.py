@@ -0,0 +1,27 @@
+"""Add load checkpoint only changed flag
+
+Revision ID: a6e3f82b9c15
+Revises: d4a7c1e9f260
+Create Date: 2026-10-18 18:21:47.106392
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a6e3f82b9c15'
+down_revision = 'd4a7c1e9f260'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # The column is already there when ckan dapr init created the tables.
+    columns = {c['name'] for c in sa.inspect(op.get_bind()).get_columns('dap_load_checkpoints')}
+    if 'only_changed' not in columns:
+        op.add_column('dap_load_checkpoints', sa.Column('only_changed', sa.Boolean, default=False))
+
+
+def downgrade():
+    op.drop_column('dap_load_checkpoints', 'only_changed')
@@ -0,0 +1,37 @@
+"""Add package rankings
+
+Revision ID: d4a7c1e9f260
+Revises: 3b9d6f0e2c41
+Create Date: 2026-10-18 16:05:12.830417
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd4a7c1e9f260'
+down_revision = '3b9d6f0e2c41'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # The table is already there when ckan dapr init created the tables.
+    if 'dap_package_rankings' in sa.inspect(op.get_bind()).get_table_names():
+        return
+    op.create_table(
+        'dap_package_rankings',
+        sa.Column('window_days', sa.Integer, primary_key=True),
+        sa.Column('ranking', sa.String(10), primary_key=True),
+        sa.Column('rank', sa.Integer, primary_key=True),
+        sa.Column('package_id', sa.String(60)),
+        sa.Column('access_count', sa.Integer),
+        sa.Column('previous_count', sa.Integer),
+        sa.Column('growth', sa.Float),
+        sa.Column('end_date', sa.Date),
+    )
+
+
+def downgrade():
+    op.drop_table('dap_package_rankings')
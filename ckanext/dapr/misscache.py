@@ -0,0 +1,126 @@
+import array
+import hashlib
+import logging
+
+from ckan.lib.redis import connect_to_redis
+from ckan.plugins.toolkit import asint, config
+
+_log = logging.getLogger(__name__)
+
+_PREFIX = 'ckanext.dapr:misses'
+_DIGESTS_KEY = f'{_PREFIX}:digests'
+_STAMP_KEY = f'{_PREFIX}:stamp'
+_MODIFIED_KEY = f'{_PREFIX}:modified'
+
+DEFAULT_MISS_CACHE_DAYS = 7
+DEFAULT_MISS_CACHE_SIZE = 1000000
+
+
+def digest(key):
+    '''A stable 64-bit digest of a record key, the same in every process.
+
+    >>> digest('example.usa.gov/data.csv') == digest('example.usa.gov/data.csv')
+    True
+    '''
+    return int.from_bytes(hashlib.blake2b(key.encode('utf-8'), digest_size=8).digest(), 'little')
+
+
+class MissCache(object):
+    '''Persistent set of DAP record files known not to match any resource,
+    so repeat loads skip their lookups.
+
+    Files are kept as 64-bit digests in CKAN's Redis store, appended to by
+    every load. Unlike a Bloom filter, the set has no false positives that
+    would drop the downloads of real resources. The set is discarded when
+    it expires after ckanext.dapr.miss_cache_days, or as soon as the stamp
+    of the matching settings it was built against changes. When resources
+    change, only the files of the changed resource URLs are forgotten.
+    '''
+
+    def __init__(self, stamp, days = DEFAULT_MISS_CACHE_DAYS, size = DEFAULT_MISS_CACHE_SIZE):
+        self.stamp = stamp
+        self.ttl = days * 24 * 60 * 60
+        self.size = size
+        self._known = set()
+        self._new = array.array('Q')
+
+    def __contains__(self, key):
+        return digest(key) in self._known
+
+    def __len__(self):
+        return len(self._known)
+
+    def add(self, key):
+        if len(self._known) >= self.size:
+            return
+        d = digest(key)
+        if d not in self._known:
+            self._known.add(d)
+            self._new.append(d)
+
+    def load(self, modified = '', changed_keys = None):
+        '''Read the saved digests, discarding them if they were built against another stamp.
+
+        modified is the time resources were last created or changed, and
+        changed_keys(since) gives the keys of the resources changed after
+        the time saved by the previous load, which are forgotten since
+        their files may match now. Without changed_keys, the set is
+        discarded whenever modified changes.
+        '''
+        try:
+            redis = connect_to_redis()
+            stamp = redis.get(_STAMP_KEY)
+            if stamp is not None and stamp.decode('utf-8') == self.stamp:
+                digests = array.array('Q')
+                digests.frombytes(redis.get(_DIGESTS_KEY) or b'')
+                self._known = set(digests)
+                since = (redis.get(_MODIFIED_KEY) or b'').decode('utf-8')
+                if since != modified:
+                    self._forget(redis, changed_keys(since) if since and changed_keys else None)
+            else:
+                redis.delete(_DIGESTS_KEY)
+                redis.set(_STAMP_KEY, self.stamp, ex=self.ttl)
+            redis.set(_MODIFIED_KEY, modified, ex=self._remaining(redis))
+        except Exception:
+            _log.exception('Error reading the DAP miss cache.')
+        return self
+
+    def _remaining(self, redis):
+        # The digests expire with the stamp they were built against.
+        ttl = redis.ttl(_STAMP_KEY)
+        return ttl if ttl and ttl > 0 else self.ttl
+
+    def _forget(self, redis, keys):
+        '''Drop the digests of the given keys, or of every key when keys is None.
+        '''
+        if keys is None:
+            dropped = self._known
+        else:
+            dropped = self._known & {digest(k) for k in keys if k}
+        if not dropped:
+            return
+        self._known = self._known - dropped
+        _log.info('Forgetting %d files of changed resources in the DAP miss cache.', len(dropped))
+        redis.set(_DIGESTS_KEY, array.array('Q', self._known).tobytes(), ex=self._remaining(redis))
+
+    def save(self):
+        '''Append the digests added since the last save. Loads running side
+        by side each append their own, so none are lost.
+        '''
+        if not self._new:
+            return
+        try:
+            redis = connect_to_redis()
+            redis.append(_DIGESTS_KEY, self._new.tobytes())
+            redis.expire(_DIGESTS_KEY, self._remaining(redis))
+            self._new = array.array('Q')
+        except Exception:
+            _log.exception('Error saving the DAP miss cache.')
+
+
+def configured_cache(stamp, modified = '', changed_keys = None):
+    '''Load the miss cache for a stamp with the configured expiry and size.
+    '''
+    return MissCache(stamp,
+        asint(config.get('ckanext.dapr.miss_cache_days', DEFAULT_MISS_CACHE_DAYS)),
+        asint(config.get('ckanext.dapr.miss_cache_size', DEFAULT_MISS_CACHE_SIZE))).load(modified, changed_keys)
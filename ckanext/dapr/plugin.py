@@ -1,53 +1,161 @@
 # -*- coding: utf-8 -*-
+import datetime
 import logging
 
 from builtins import str, range
 
 import ckan.lib.helpers as h
 import ckan.plugins as p
-from ckan.plugins.toolkit import asbool, config, get_validator, url_for, redirect_to, render, get_action
+from ckan.plugins.toolkit import (abort, asbool, check_access, config, g, get_validator, url_for,
+    redirect_to, render, get_action, request, NotAuthorized)
 
 from ckan.exceptions import CkanVersionException
 
-from flask import Blueprint
+from flask import Blueprint, Response, stream_with_context
+
+from . import actions, cache, cli, daputil, export, helpers, matching, metrics, reporting
+from .daputil import DEFAULT_TOP_NUMBER, MAX_TOP_NUMBER
+from .fetch import MAX_BATCH_SIZE
 
 DEFAULT_API_URL = "https://api.gsa.gov/analytics/dap/v2.0.0/"
 DEFAULT_BATCH_SIZE = 2000
-MAX_BATCH_SIZE = 10000
 
 log = logging.getLogger(__name__)
 
 def show_top_packages():
-    redirect_to(url_for('.top'))
+    return redirect_to(url_for('.top'))
 
-def get_package_url_title(id):
-    res = (None, None)
+def get_package_urls_titles(ids):
+    '''Look up the page URL and title of several packages with a single search.
+    Returns a dictionary mapping each package id found to a (url, title) pair.
+    '''
+    res = {}
+    if not ids:
+        return res
     pf = get_action('package_search')
-    response = pf({'q':f'id:{id}', 'rows':1, 'fl':['url','title']})
-    if response.get('count', 0) > 0:
-        r = response['results'][0]
-        res = r.get('url', None), r.get('title', None)
-    else:
-        log.error('Could not retrieve URL and title for package %s', id)
-
+    id_list = ' OR '.join(f'"{id}"' for id in ids)
+    response = pf({}, {'fq': f'id:({id_list})', 'rows': len(ids), 'fl': ['id', 'name', 'title']})
+    for r in response.get('results', []):
+        res[r['id']] = url_for('dataset.read', id=r['name']), r.get('title', None) or r['name']
+    for id in ids:
+        if id not in res:
+            log.error('Could not retrieve URL and title for package %s', id)
     return res
 
+def _date_arg(name):
+    value = request.args.get(name, None)
+    if value is None:
+        return None
+    try:
+        return datetime.date.fromisoformat(value)
+    except ValueError:
+        log.info('Ignoring invalid %s argument %s', name, value)
+        return None
+
+def _render_datasets(datasets):
+    urls_titles = get_package_urls_titles([d.package_id for d in datasets])
+    render_data = []
+    for dataset in datasets:
+        if dataset.package_id in urls_titles:
+            url, title = urls_titles[dataset.package_id]
+            render_data.append({'url': url, 'title': title, 'count': dataset.access_count,
+                'growth': getattr(dataset, 'growth', None)})
+    return render_data
+
+def top_datasets(start_date = None, end_date = None, number = DEFAULT_TOP_NUMBER):
+    '''List the url, title and access count of the most accessed datasets.
+    The list is cached until the next load records new access counts.
+    '''
+    def compute():
+        return _render_datasets(daputil.top_packages(start_date, end_date, number))
+
+    return cache.cached(cache.cache_key('top_datasets', start_date, end_date, number), compute)
+
+def ranked_datasets(window_days = daputil.DEFAULT_RANKING_WINDOWS[0], ranking = daputil.RANKING_TOP,
+        number = DEFAULT_TOP_NUMBER):
+    '''List the url, title, access count and growth over the window before
+    of the datasets in a precomputed ranking for the latest window_days.
+    The list is cached until the next load records new access counts.
+    '''
+    def compute():
+        return _render_datasets(daputil.ranked_packages(window_days, ranking, number))
+
+    return cache.cached(cache.cache_key('ranked_datasets', window_days, ranking, number), compute)
+
+def trending_datasets(window_days = daputil.DEFAULT_RANKING_WINDOWS[0], number = DEFAULT_TOP_NUMBER):
+    '''List the datasets whose accesses grew the most over the latest window_days.
+    '''
+    return ranked_datasets(window_days, daputil.RANKING_TRENDING, number)
+
+def show_metrics():
+    '''Expose the last load's metrics and the report query latencies in the
+    Prometheus text format, if enabled in the configuration.
+    '''
+    if not asbool(config.get('ckanext.dapr.metrics_enabled', False)):
+        return abort(404)
+    return Response(metrics.prometheus_text(), mimetype='text/plain; version=0.0.4')
+
+def export_accesses():
+    '''Stream the daily access counts, filtered by the start_date, end_date,
+    package_id, resource_id and organization arguments, as CSV or, with
+    format=ndjson, newline-delimited JSON. Only sysadmins may export.
+    '''
+    try:
+        check_access('sysadmin', {'user': g.user})
+    except NotAuthorized:
+        return abort(403)
+    fmt = request.args.get('format', export.FORMAT_CSV)
+    if fmt not in export.RENDERERS:
+        return abort(400, f'Unknown export format {fmt}')
+    filters = {'start_date': _date_arg('start_date'), 'end_date': _date_arg('end_date'),
+        'package_id': request.args.get('package_id', None),
+        'resource_id': request.args.get('resource_id', None)}
+    organization = request.args.get('organization', None)
+    if organization is not None:
+        filters['organization_id'] = export.organization_id(organization)
+        if filters['organization_id'] is None:
+            return abort(404, f'Organization {organization} not found')
+    return Response(stream_with_context(export.export_chunks(fmt, **filters)),
+        mimetype=export.MIMETYPES[fmt],
+        headers={'Content-Disposition': f'attachment; filename=dap_accesses.{fmt}'})
+
 def show_top_datasets():
     '''Retrieve a list of datasets that have the highest number of accesses.
-    Display the retrieved list in a returned page.
+    Display the retrieved list in a returned page. With a window argument,
+    the precomputed ranking of the latest window days is shown instead,
+    and with ranking=trending, the datasets growing the fastest.
     '''
-    render_data = []
-    datasets = daputil.top_packages()
-    for dataset in datasets:
-        url,title = get_package_url_title(dataset.package_id)
-        render_data.append({'url': url, 'title': title})
-    render("top.html", data=render_data)
+    try:
+        number = min(int(request.args.get('number', DEFAULT_TOP_NUMBER)), MAX_TOP_NUMBER)
+    except ValueError:
+        number = DEFAULT_TOP_NUMBER
+    window = request.args.get('window', None)
+    if window is None:
+        render_data = top_datasets(_date_arg('start_date'), _date_arg('end_date'), number)
+        return render("top.html", extra_vars={'datasets': render_data})
+    ranking = request.args.get('ranking', daputil.RANKING_TOP)
+    if ranking not in (daputil.RANKING_TOP, daputil.RANKING_TRENDING):
+        return abort(400, f'Unknown ranking {ranking}')
+    try:
+        window_days = int(window)
+    except ValueError:
+        return abort(400, f'Invalid window {window}')
+    if window_days not in daputil.ranking_windows():
+        return abort(404, f'No ranking for a {window_days} day window')
+    render_data = ranked_datasets(window_days, ranking, number)
+    return render("top.html", extra_vars={'datasets': render_data, 'window': window_days,
+        'ranking': ranking})
 
 class daprPlugin(p.SingletonPlugin):
     p.implements(p.IConfigurable, inherit=True)
     p.implements(p.IConfigurer, inherit=True)
     p.implements(p.IBlueprint, inherit=True)
     p.implements(p.ITemplateHelpers)
+    p.implements(p.IResourceController, inherit=True)
+    p.implements(p.IPackageController, inherit=True)
+    p.implements(p.IClick)
+    p.implements(p.IActions)
+    p.implements(p.IAuthFunctions)
 
     def configure(self, config):
         """Load config settings for this extension from config file.
@@ -60,9 +168,7 @@ class daprPlugin(p.SingletonPlugin):
         self.keyfile = config.get("ckanext.dapr.keyfile", None)
         self.show_downloads = asbool(config.get("ckanext.dapr.show_downloads", True))
         self.api_url = config.get("ckanext.dapr.api_url", DEFAULT_API_URL)
-        self.batch_size - config.get("ckanext.dapr.batch_size", DEFAULT_BATCH_SIZE)
-
-        p.toolkit.add_resource("../assets", "ckanext-dap")
+        self.batch_size = config.get("ckanext.dapr.batch_size", DEFAULT_BATCH_SIZE)
 
     def update_config(self, config):
         """Change the CKAN environment configuration.
@@ -70,7 +176,7 @@ class daprPlugin(p.SingletonPlugin):
         See IConfigurer.
 
         """
-        p.toolkit.add_template_directory(config, "../templates")
+        p.toolkit.add_template_directory(config, "templates")
 
     def update_config_schema(self, schema):
         """Add runtime-editable configuration parameters.
@@ -85,7 +191,17 @@ class daprPlugin(p.SingletonPlugin):
             "ckanext.dapr.retrieval_agency": [im],
             "ckanext.dapr.show_downloads": [im],
             "ckanext.dapr.api_url": [im],
-            "ckanext.dapr.batch_size": [im, pi, get_validator('limit_to_configured_maximum')(MAX_BATCH_SIZE)]
+            "ckanext.dapr.batch_size": [im, pi, get_validator('limit_to_configured_maximum')(MAX_BATCH_SIZE)],
+            "ckanext.dapr.max_batch_size": [im, pi, get_validator('limit_to_configured_maximum')(MAX_BATCH_SIZE)],
+            "ckanext.dapr.write_batch_size": [im, pi],
+            "ckanext.dapr.max_retries": [im, get_validator('natural_number_validator')],
+            "ckanext.dapr.target_page_seconds": [im],
+            "ckanext.dapr.concurrency": [im, pi],
+            "ckanext.dapr.requests_per_hour": [im, pi],
+            "ckanext.dapr.metrics_enabled": [im],
+            "ckanext.dapr.index_downloads": [im],
+            "ckanext.dapr.index_recent_days": [im, pi],
+            "ckanext.dapr.trending_min_accesses": [im, pi],
         })
 
         return schema
@@ -99,5 +215,85 @@ class daprPlugin(p.SingletonPlugin):
         blueprint = Blueprint("dap_analytics", self.__module__)
         blueprint.template_folder = "templates"
         blueprint.add_url_rule("/analytics/package/top", "packages_top", view_func=show_top_packages)
-        blueprint.add_url_rule("analytics/dataset/top", "top", view_func=show_top_datasets)
+        blueprint.add_url_rule("/analytics/dataset/top", "top", view_func=show_top_datasets)
+        blueprint.add_url_rule("/analytics/metrics", "metrics", view_func=show_metrics)
+        blueprint.add_url_rule("/analytics/export", "export", view_func=export_accesses)
+        # Return the report session's connection to its pool after every request.
+        blueprint.teardown_app_request(reporting.remove)
         return blueprint
+
+    def get_helpers(self):
+        """Add the download count helpers for use in templates.
+
+        See ITemplateHelpers.
+
+        """
+        return {
+            "dapr_show_downloads": helpers.show_downloads,
+            "dapr_resource_downloads": helpers.resource_downloads,
+            "dapr_download_sparkline": helpers.download_sparkline,
+            "dapr_ranked_datasets": ranked_datasets,
+            "dapr_trending_datasets": trending_datasets,
+        }
+
+    def get_actions(self):
+        """Add the access statistics actions to the action API.
+
+        See IActions.
+
+        """
+        return actions.get_actions()
+
+    def get_auth_functions(self):
+        """Allow anyone to call the access statistics actions.
+
+        See IAuthFunctions.
+
+        """
+        return actions.get_auth_functions()
+
+    def get_commands(self):
+        """Add the dapr command group to the ckan CLI.
+
+        See IClick.
+
+        """
+        return cli.get_commands()
+
+    def before_dataset_index(self, pkg_dict):
+        """Add the dataset's total and recent download counts to its search
+        index document, for sorting and boosting search results.
+
+        See IPackageController.
+
+        """
+        if daputil.index_downloads():
+            pkg_dict.update(daputil.package_index_fields(pkg_dict["id"]))
+        return pkg_dict
+
+    def after_resource_create(self, context, resource):
+        """Add a new resource to the URL index used for matching DAP records.
+
+        See IResourceController.
+
+        """
+        if matching.url_index.loaded:
+            matching.url_index.add(resource)
+
+    def after_resource_update(self, context, resource):
+        """Refresh the indexed URL of an updated resource.
+
+        See IResourceController.
+
+        """
+        if matching.url_index.loaded:
+            matching.url_index.add(resource)
+
+    def before_resource_delete(self, context, resource, resources):
+        """Drop a resource about to be deleted from the URL index.
+
+        See IResourceController.
+
+        """
+        if matching.url_index.loaded:
+            matching.url_index.remove(resource.get("id"))
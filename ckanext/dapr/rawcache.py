@@ -0,0 +1,111 @@
+import gzip
+import json
+import logging
+import os
+import threading
+
+from ckan.plugins.toolkit import config
+
+from .metrics import metrics
+
+_log = logging.getLogger(__name__)
+
+DEFAULT_REPLAY_PAGE_SIZE = 10000
+
+
+class RawResponseStore(object):
+    '''Local store of raw DAP download records, kept as one gzip-compressed
+    JSON lines file per day under a directory, so historical downloads
+    can be matched again without calling the DAP API.
+
+    Each page written is appended to the files of the days its records
+    cover. Reading a day returns each (page, file) record once, keeping
+    the copy written last, so days fetched more than once are not counted twice.
+    '''
+
+    def __init__(self, directory):
+        self.directory = directory
+        self._lock = threading.Lock()
+
+    def _path(self, day):
+        return os.path.join(self.directory, day[:4], f'{day}.jsonl.gz')
+
+    def write_page(self, records):
+        '''Append the records of one API page to the files of their days.
+        '''
+        by_day = {}
+        for rec in records:
+            day = rec.get('date', None)
+            if day is None:
+                continue
+            by_day.setdefault(day, []).append(rec)
+        with self._lock:
+            for day, day_records in by_day.items():
+                path = self._path(day)
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                with gzip.open(path, 'at', encoding='utf-8', compresslevel=5) as f:
+                    for rec in day_records:
+                        f.write(json.dumps(rec, separators=(',', ':')))
+                        f.write('\n')
+
+    def days(self, start_date = None, end_date = None):
+        '''List the days stored, as ISO date strings in order, within an optional date range.
+        '''
+        if not os.path.isdir(self.directory):
+            return []
+        start = start_date.strftime('%Y-%m-%d') if start_date is not None else None
+        end = end_date.strftime('%Y-%m-%d') if end_date is not None else None
+        days = []
+        for year in os.listdir(self.directory):
+            year_dir = os.path.join(self.directory, year)
+            if not os.path.isdir(year_dir):
+                continue
+            for name in os.listdir(year_dir):
+                if not name.endswith('.jsonl.gz'):
+                    continue
+                day = name[:-len('.jsonl.gz')]
+                if (start is None or day >= start) and (end is None or day <= end):
+                    days.append(day)
+        return sorted(days)
+
+    def records(self, day):
+        '''Generate the stored records of one day, each (page, file) once.
+        '''
+        latest = {}
+        with gzip.open(self._path(day), 'rt', encoding='utf-8') as f:
+            for line in f:
+                rec = json.loads(line)
+                latest[(rec.get('page'), rec.get('file_name'))] = rec
+        yield from latest.values()
+
+    def pages(self, start_date = None, end_date = None, first_page = 1, page_size = DEFAULT_REPLAY_PAGE_SIZE):
+        '''Generate the stored records for a date range as pages of page_size
+        records, in the same order on every call so a checkpointed replay
+        can continue from first_page.
+        '''
+        skip = (first_page - 1) * page_size
+        page = []
+        for day in self.days(start_date, end_date):
+            with metrics.phase('fetch'):
+                day_records = list(self.records(day))
+            for rec in day_records:
+                if skip > 0:
+                    skip -= 1
+                    continue
+                page.append(rec)
+                if len(page) >= page_size:
+                    metrics.count('pages_fetched')
+                    yield page
+                    page = []
+        if page:
+            metrics.count('pages_fetched')
+            yield page
+
+
+def configured_store():
+    '''The raw response store set by ckanext.dapr.raw_cache_dir, or None if not configured.
+    '''
+    directory = config.get('ckanext.dapr.raw_cache_dir', None)
+    if not directory:
+        return None
+    return RawResponseStore(directory)
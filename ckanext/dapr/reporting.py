@@ -0,0 +1,90 @@
+import contextlib
+import logging
+import threading
+
+from sqlalchemy import engine_from_config, text
+from sqlalchemy.orm import scoped_session, sessionmaker
+
+import ckan.model as model
+from ckan.plugins.toolkit import config
+
+_log = logging.getLogger(__name__)
+
+_PREFIX = 'ckanext.dapr.reporting_sqlalchemy_'
+
+# The report sessions by database URL, each with its own pooled engine.
+_sessions = {}
+_lock = threading.Lock()
+
+# Whether the current thread's report queries run on CKAN's own session.
+_local = threading.local()
+
+
+def reporting_url():
+    return config.get(f'{_PREFIX}url', None) or None
+
+def _create_session(url):
+    # Engine options such as pool_size are read from the other
+    # ckanext.dapr.reporting_sqlalchemy_* settings, as CKAN reads its own.
+    options = {key: config[key] for key in config if key.startswith(_PREFIX)}
+    options[f'{_PREFIX}url'] = url
+    engine = engine_from_config(options, _PREFIX, pool_pre_ping=True)
+    _log.info("Running DAP report queries on %r", engine.url)
+    return scoped_session(sessionmaker(bind=engine, autoflush=False))
+
+@contextlib.contextmanager
+def primary():
+    '''Run the report queries of the block on CKAN's own session, for
+    results that must not be read from a replica still behind the latest
+    load, such as the search index fields a load refreshes.
+    '''
+    previous = getattr(_local, 'primary', False)
+    _local.primary = True
+    try:
+        yield
+    finally:
+        _local.primary = previous
+
+def session():
+    '''The session report queries run in: one on the database of
+    ckanext.dapr.reporting_sqlalchemy_url, such as a read-only replica,
+    or CKAN's own session when that is not set or within primary().
+    '''
+    url = reporting_url()
+    if url is None or getattr(_local, 'primary', False):
+        return model.meta.Session
+    report_session = _sessions.get(url)
+    if report_session is None:
+        with _lock:
+            report_session = _sessions.get(url)
+            if report_session is None:
+                report_session = _sessions[url] = _create_session(url)
+    return report_session
+
+def position():
+    '''The write position of CKAN's PostgreSQL database, for telling when
+    the reporting database has caught up with it, or None when reports run
+    on CKAN's database or the position cannot be told.
+    '''
+    if reporting_url() is None or model.meta.Session.get_bind().dialect.name != 'postgresql':
+        return None
+    return model.meta.Session.execute(text('SELECT CAST(pg_current_wal_lsn() AS text)')).scalar()
+
+def caught_up(position):
+    '''Whether the reporting database has replayed CKAN's database writes up
+    to a position given by position(). A reporting database that is not a
+    PostgreSQL standby is taken to be current.
+    '''
+    report_session = session()
+    if report_session.get_bind().dialect.name != 'postgresql':
+        return True
+    replayed = report_session.execute(text('SELECT pg_last_wal_replay_lsn() >= CAST(:position AS pg_lsn)'),
+        {'position': position}).scalar()
+    return replayed is None or replayed
+
+def remove(*args):
+    '''End the report session of the current thread, returning its
+    connection to the pool, such as when a request is torn down.
+    '''
+    for report_session in list(_sessions.values()):
+        report_session.remove()
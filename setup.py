@@ -28,7 +28,7 @@ setup(
     entry_points="""
         [ckan.plugins]
 	# Add plugins here, eg
-	dap=ckanext.dapr.plugin:DAPRPlugin
+	dapr=ckanext.dapr.plugin:daprPlugin
 
         [paste.paster_command]
         load = ckanext.dapr.commands:load
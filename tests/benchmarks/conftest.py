@@ -0,0 +1,25 @@
+import os
+
+import pytest
+
+
+def pytest_collection_modifyitems(config, items):
+    """ Skip the benchmarks unless DAPR_BENCHMARK is set, since they load
+    large volumes of data and take minutes to hours to run.
+    """
+    if os.environ.get('DAPR_BENCHMARK'):
+        return
+    skip = pytest.mark.skip(reason='Set DAPR_BENCHMARK=1 to run the benchmarks.')
+    for item in items:
+        if 'benchmarks' in item.nodeid:
+            item.add_marker(skip)
+
+
+def percentile(values, q):
+    """ The q-th quantile of a list of values, by the nearest-rank method.
+
+    >>> percentile([5, 1, 4, 2, 3], 0.5)
+    3
+    """
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(q * (len(ordered) - 1))))]
@@ -0,0 +1,72 @@
+""" Synthetic DAP download report data at a configurable scale.
+
+Records are computed from their position in the report rather than
+stored, so a report of any size can be paged through without holding
+it in memory.
+"""
+import datetime
+import random
+
+
+class SyntheticDAPReport:
+    """ A download report covering a number of sites, each with a number
+    of downloadable files, over a number of days. Every file has one
+    record per day, ordered by date. A matched_ratio share of the files
+    are referenced by CKAN resources (see resource_urls); the rest are
+    downloads from unrelated sites that a load has to skip.
+    """
+
+    def __init__(self, sites=50, files_per_site=200, days=30, matched_ratio=0.1,
+            first_day=datetime.date(2020, 1, 1), seed=0):
+        self.sites = sites
+        self.files_per_site = files_per_site
+        self.days = days
+        self.matched_ratio = matched_ratio
+        self.first_day = first_day
+        self.seed = seed
+        self.files = sites * files_per_site
+        self.matched_files = int(self.files * matched_ratio)
+
+    def __len__(self):
+        return self.files * self.days
+
+    def _file(self, n):
+        # Spread the matched files across all sites.
+        site = n % self.sites
+        return f'www.agency{site}.gov', f'/files/{n // self.sites}/data-{n}.csv'
+
+    def record(self, i):
+        day, n = divmod(i, self.files)
+        site, file_name = self._file(n)
+        # Download counts follow a long-tailed distribution, with most files
+        # downloaded a few times a day and a few downloaded heavily.
+        rng = random.Random(self.seed * 1000003 + i)
+        return {
+            'file_name': file_name,
+            'page': f'{site}/data/page-{n % 17}',
+            'date': (self.first_day + datetime.timedelta(days=day)).isoformat(),
+            'total_events': int(rng.paretovariate(1.2)),
+        }
+
+    def resource_urls(self):
+        """ The URLs to create CKAN resources for, so that matched_ratio of
+        the report's records match a resource.
+        """
+        for n in range(self.matched_files):
+            site, file_name = self._file(n)
+            yield f'https://{site}{file_name}'
+
+    def page(self, after, before, limit, page):
+        """ Return the records of one page of the report for a date range.
+        """
+        first = 0
+        last = len(self)
+        if after is not None:
+            first = max(first, (datetime.date.fromisoformat(after) - self.first_day).days * self.files)
+        if before is not None:
+            last = min(last, ((datetime.date.fromisoformat(before) - self.first_day).days + 1) * self.files)
+        start = first + (page - 1) * limit
+        return [self.record(i) for i in range(start, min(start + limit, last))]
+
+    def matched_records(self):
+        return self.matched_files * self.days
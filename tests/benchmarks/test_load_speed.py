@@ -0,0 +1,63 @@
+""" Records per second for a load of a synthetic DAP report served by a
+local stand-in for the DAP API.
+
+Run with: DAPR_BENCHMARK=1 pytest --ckan-ini=test.ini tests/benchmarks -s
+"""
+import time
+import uuid
+
+import pytest
+
+import ckan.model as model
+
+from ckanext.dapr import daputil, matching
+
+from ..dap_server import MockDAPServer
+from .synthetic import SyntheticDAPReport
+
+_SCALES = [
+    # sites, files per site, days, matched ratio
+    (20, 100, 30, 0.1),
+    (50, 200, 30, 0.05),
+    (100, 500, 30, 0.01),
+]
+
+
+def _create_resources(urls, per_package=500):
+    """ Insert packages and resources for the given URLs in bulk, which is
+    much faster than creating them through the action API.
+    """
+    packages = []
+    resources = []
+    for n, url in enumerate(urls):
+        if n % per_package == 0:
+            package_id = str(uuid.uuid4())
+            packages.append({'id': package_id, 'name': f'benchmark-{package_id}',
+                'type': 'dataset', 'state': 'active', 'private': False})
+        resources.append({'id': str(uuid.uuid4()), 'package_id': package_id, 'url': url,
+            'state': 'active', 'position': n % per_package})
+    model.Session.bulk_insert_mappings(model.Package, packages)
+    model.Session.bulk_insert_mappings(model.Resource, resources)
+    model.Session.commit()
+
+
+@pytest.mark.parametrize('sites, files_per_site, days, matched_ratio', _SCALES)
+@pytest.mark.usefixtures('clean_db', 'clean_redis')
+def test_load_records_per_second(sites, files_per_site, days, matched_ratio, monkeypatch, ckan_config):
+    daputil.init_dap_tables()
+    report = SyntheticDAPReport(sites, files_per_site, days, matched_ratio)
+    _create_resources(report.resource_urls())
+
+    monkeypatch.setenv('DAP_KEY', 'benchmark')
+    monkeypatch.setitem(ckan_config, 'ckanext.dapr.batch_size', 10000)
+    monkeypatch.setitem(ckan_config, 'ckanext.dapr.requests_per_hour', 3600000)
+    with MockDAPServer(report) as server:
+        monkeypatch.setitem(ckan_config, 'ckanext.dapr.api_url', server.url)
+        matching.url_index.loaded = False
+        began = time.perf_counter()
+        written = daputil.load_downloads(None, None)
+        elapsed = time.perf_counter() - began
+
+    assert written == report.matched_records()
+    print(f'\nload: {len(report)} records, {written} matched, {elapsed:.1f} s, '
+        f'{len(report) / elapsed:,.0f} records/s')
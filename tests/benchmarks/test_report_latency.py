@@ -0,0 +1,85 @@
+""" p50 and p99 latency of the report queries over a daily access count
+table of 1M, 10M and 50M rows, or the row counts listed in
+DAPR_BENCHMARK_ROWS (comma separated). PostgreSQL only, since the table
+is filled with generate_series.
+
+Run with: DAPR_BENCHMARK=1 pytest --ckan-ini=test.ini tests/benchmarks -s
+"""
+import datetime
+import os
+import random
+import time
+
+import pytest
+from sqlalchemy import text
+
+import ckan.model as model
+
+from ckanext.dapr import daputil
+
+from .conftest import percentile
+
+_ROWS = [int(n) for n in os.environ.get('DAPR_BENCHMARK_ROWS', '1000000,10000000,50000000').split(',')]
+_RESOURCES = 20000
+_RESOURCES_PER_PACKAGE = 8
+_FIRST_DAY = datetime.date(2018, 11, 8)
+_CALLS = 200
+
+
+def _fill_accesses(rows):
+    """ Fill the daily table with one row per resource per day, for as many
+    days as it takes to reach the given number of rows.
+    """
+    model.Session.execute(text('''
+        INSERT INTO dap_resource_accesses (resource_id, access_date, package_id, access_count)
+        SELECT 'res-' || (g % :resources),
+            CAST(:first_day AS date) + CAST(g / :resources AS integer),
+            'pkg-' || ((g % :resources) / :per_package),
+            1 + (g * 7919) % 97
+        FROM generate_series(0, :rows - 1) AS g
+    '''), {'resources': _RESOURCES, 'per_package': _RESOURCES_PER_PACKAGE,
+        'first_day': _FIRST_DAY, 'rows': rows})
+    model.Session.commit()
+    model.Session.execute(text('ANALYZE dap_resource_accesses'))
+    daputil.refresh_rollups()
+
+
+def _latency(call):
+    timings = []
+    for _ in range(_CALLS):
+        began = time.perf_counter()
+        call()
+        timings.append((time.perf_counter() - began) * 1000)
+    return percentile(timings, 0.5), percentile(timings, 0.99)
+
+
+@pytest.mark.parametrize('rows', _ROWS)
+@pytest.mark.usefixtures('clean_db', 'clean_redis')
+def test_report_query_latency(rows):
+    if model.meta.engine.dialect.name != 'postgresql':
+        pytest.skip('The report latency benchmark fills its table with PostgreSQL generate_series.')
+    daputil.init_dap_tables()
+    _fill_accesses(rows)
+
+    days = rows // _RESOURCES
+    rng = random.Random(rows)
+
+    def random_range():
+        start = _FIRST_DAY + datetime.timedelta(days=rng.randrange(max(1, days - 30)))
+        return start, start + datetime.timedelta(days=rng.randrange(1, 90))
+
+    calls = {
+        'top_packages': lambda: daputil.top_packages(),
+        'top_packages (range)': lambda: daputil.top_packages(*random_range()),
+        'top_resources': lambda: daputil.top_resources(),
+        'top_resources (range)': lambda: daputil.top_resources(*random_range()),
+        'total_resource_accesses': lambda: daputil.total_resource_accesses(
+            f'res-{rng.randrange(_RESOURCES)}', *random_range()),
+        'total_package_accesses': lambda: daputil.total_package_accesses(
+            f'pkg-{rng.randrange(_RESOURCES // _RESOURCES_PER_PACKAGE)}', *random_range()),
+        'total_accesses': lambda: daputil.total_accesses(*random_range()),
+    }
+    print(f'\n{rows:,} rows')
+    for name, call in calls.items():
+        p50, p99 = _latency(call)
+        print(f'  {name:<28} p50 {p50:8.2f} ms  p99 {p99:8.2f} ms')
@@ -0,0 +1,77 @@
+""" Fixtures shared by the extension's tests.
+"""
+import datetime
+
+import pytest
+
+import ckan.tests.factories as factories
+
+from ckanext.dapr import daputil, matching
+
+DAY = datetime.date(2020, 5, 20)
+
+
+@pytest.fixture
+def day():
+    """ The day most test access counts are recorded on.
+    """
+    return DAY
+
+
+@pytest.fixture
+def dap_tables(clean_db, clean_redis):
+    daputil.init_dap_tables()
+
+
+@pytest.fixture
+def accesses(dap_tables):
+    """ Daily access counts of two packages across three months, with their rollups.
+    """
+    daputil.update_access_counts([
+        {'resource_id': 'res-1', 'package_id': 'pkg-1', 'date': DAY, 'count': 5},
+        {'resource_id': 'res-1', 'package_id': 'pkg-1', 'date': datetime.date(2020, 6, 3), 'count': 2},
+        {'resource_id': 'res-2', 'package_id': 'pkg-1', 'date': datetime.date(2020, 7, 1), 'count': 3},
+        {'resource_id': 'res-3', 'package_id': 'pkg-2', 'date': DAY, 'count': 9},
+    ])
+    daputil.refresh_rollups()
+
+
+@pytest.fixture
+def record(dap_tables):
+    """ Record an access count for the first resource of a dataset.
+    """
+    def record(dataset, count, day=DAY):
+        daputil.update_access_counts([{'resource_id': dataset['resources'][0]['id'],
+            'package_id': dataset['id'], 'date': day, 'count': count}])
+    return record
+
+
+@pytest.fixture
+def dap_records():
+    """ DAP download records of two files over six days, two records a day.
+    """
+    return [
+        {'file_name': f'/data/{n % 2}.csv', 'page': 'example.usa.gov/data',
+            'date': (datetime.date(2020, 5, 1) + datetime.timedelta(days=n // 2)).isoformat(),
+            'total_events': n}
+        for n in range(12)
+    ]
+
+
+@pytest.fixture
+def dap_load(dap_tables, monkeypatch, ckan_config):
+    """ A dataset whose resources the dap_records files match, and settings
+    loading them from a mock DAP API four records a page.
+    """
+    dataset = factories.Dataset(resources=[{'url': 'https://example.usa.gov/data/0.csv'},
+        {'url': 'https://example.usa.gov/data/1.csv'}])
+    monkeypatch.setenv('DAP_KEY', 'test')
+    monkeypatch.setitem(ckan_config, 'ckanext.dapr.batch_size', 4)
+    monkeypatch.setitem(ckan_config, 'ckanext.dapr.write_batch_size', 1)
+    monkeypatch.setitem(ckan_config, 'ckanext.dapr.concurrency', 1)
+    monkeypatch.setitem(ckan_config, 'ckanext.dapr.requests_per_hour', 3600000)
+    # Keep the API's page numbers those of the checkpoints, and retry failures quickly.
+    monkeypatch.setitem(ckan_config, 'ckanext.dapr.max_batch_size', 4)
+    monkeypatch.setitem(ckan_config, 'ckanext.dapr.retry_backoff_seconds', 0.001)
+    matching.url_index.load()
+    return dataset
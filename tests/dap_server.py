@@ -0,0 +1,87 @@
+""" A local stand-in for the DAP API downloads report, for tests that
+exercise the HTTP retrieval code without calling api.gsa.gov.
+"""
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+
+class MockDAPServer:
+    """ Serve a list of DAP download records, or a synthetic report, as the
+    paginated /reports/download/data endpoint, honoring the after, before,
+    limit and page parameters.
+    """
+
+    def __init__(self, records):
+        self.records = records
+        self.requests = []
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), self._handler())
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+
+    @property
+    def url(self):
+        host, port = self._server.server_address
+        return f'http://{host}:{port}'
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def respond(self, path, params):
+        """ Return the status code, extra headers and body for a request.
+        """
+        if not path.endswith('/reports/download/data'):
+            return 404, {}, []
+        limit = int(params.get('limit', 1000))
+        page = int(params.get('page', 1))
+        if hasattr(self.records, 'page'):
+            # A synthetic report computes its pages on demand.
+            return 200, {}, self.records.page(params.get('after'), params.get('before'), limit, page)
+        after = params.get('after', '0000-00-00')
+        before = params.get('before', '9999-99-99')
+        selected = [r for r in self.records if after <= r['date'] <= before]
+        return 200, {}, selected[(page - 1) * limit:page * limit]
+
+    def _handler(self):
+        mock = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self):
+                parts = urlsplit(self.path)
+                params = {k: v[0] for k, v in parse_qs(parts.query).items()}
+                mock.requests.append(params)
+                status, headers, body = mock.respond(parts.path, params)
+                payload = json.dumps(body).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(payload)))
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
+
+
+class FailingDAPServer(MockDAPServer):
+    """ Fail every request for one page, as a throttled or broken API would.
+    """
+
+    def __init__(self, records, failing_page):
+        super().__init__(records)
+        self.failing_page = failing_page
+
+    def respond(self, path, params):
+        if int(params.get('page', 1)) == self.failing_page:
+            return 500, {}, []
+        return super().respond(path, params)
@@ -0,0 +1,99 @@
+import datetime
+
+import pytest
+
+import ckan.model as model
+
+from ckanext.dapr import daputil
+
+
+def _download(res_id, day, count, pkg_id='pkg-1'):
+    return {'resource_id': res_id, 'package_id': pkg_id, 'date': day, 'count': count}
+
+
+@pytest.mark.usefixtures('dap_tables')
+def test_reload_replaces_existing_rows(day):
+    """ Loading the same window twice leaves one row per resource and date,
+    holding the latest count.
+    """
+    daputil.update_access_counts([_download('res-1', day, 5), _download('res-2', day, 7)])
+    written = daputil.update_access_counts([_download('res-1', day, 6), _download('res-2', day, 7)])
+
+    assert written == 2
+    rows = model.Session.query(daputil.DAPResourceAccess).order_by(daputil.DAPResourceAccess.resource_id).all()
+    assert [(r.resource_id, r.access_count) for r in rows] == [('res-1', 6), ('res-2', 7)]
+
+
+@pytest.mark.usefixtures('dap_tables')
+def test_duplicate_records_in_chunk_are_summed(day):
+    written = daputil.update_access_counts([_download('res-1', day, 5), _download('res-1', day, 3)])
+
+    assert written == 1
+    assert model.Session.query(daputil.DAPResourceAccess.access_count).scalar() == 8
+
+
+@pytest.mark.usefixtures('dap_tables')
+def test_portable_upsert(day):
+    daputil.update_access_counts([_download('res-1', day, 5)])
+    daputil._upsert_portable(daputil._access_rows([_download('res-1', day, 9),
+        _download('res-1', day + datetime.timedelta(days=1), 2)]))
+    model.Session.commit()
+
+    rows = model.Session.query(daputil.DAPResourceAccess).order_by(daputil.DAPResourceAccess.access_date).all()
+    assert [r.access_count for r in rows] == [9, 2]
+
+
+@pytest.mark.usefixtures('dap_tables')
+def test_totals_from_rollups_match_daily_counts():
+    """ The total helpers answer from the rollups plus the daily rows of
+    partial months, giving the same sums as the daily table.
+    """
+    first = datetime.date(2020, 4, 25)
+    downloads = []
+    for n in range(80):
+        day = first + datetime.timedelta(days=n)
+        downloads.append(_download('res-1', day, n, 'pkg-1'))
+        downloads.append(_download('res-2', day, 2 * n, 'pkg-2'))
+    daputil.update_access_counts(downloads)
+    daputil.refresh_rollups({datetime.date(2020, m, 1) for m in (4, 5, 6, 7)})
+
+    def daily_sum(res_id, start, end):
+        return sum(d['count'] for d in downloads if d['resource_id'] == res_id
+            and (start is None or d['date'] >= start) and (end is None or d['date'] <= end))
+
+    ranges = [(None, None), (datetime.date(2020, 5, 1), datetime.date(2020, 6, 30)),
+        (datetime.date(2020, 4, 28), datetime.date(2020, 7, 3)),
+        (datetime.date(2020, 5, 3), datetime.date(2020, 5, 9)), (None, datetime.date(2020, 6, 15)),
+        (datetime.date(2020, 6, 2), None)]
+    for start, end in ranges:
+        assert daputil.total_resource_accesses('res-1', start, end) == daily_sum('res-1', start, end)
+        assert daputil.total_package_accesses('pkg-2', start, end) == daily_sum('res-2', start, end)
+        assert daputil.total_accesses(start, end) == \
+            daily_sum('res-1', start, end) + daily_sum('res-2', start, end)
+
+
+@pytest.mark.usefixtures('dap_tables')
+def test_refresh_only_touched_months():
+    daputil.update_access_counts([_download('res-1', datetime.date(2020, 5, 20), 5),
+        _download('res-1', datetime.date(2020, 6, 20), 7)])
+    daputil.refresh_rollups()
+    assert daputil.total_resource_accesses('res-1') == 12
+
+    daputil.update_access_counts([_download('res-1', datetime.date(2020, 6, 20), 10)])
+    daputil.refresh_rollups({datetime.date(2020, 6, 1)})
+    assert daputil.total_resource_accesses('res-1') == 15
+    assert daputil.total_package_accesses('pkg-1') == 15
+
+
+@pytest.mark.usefixtures('accesses')
+def test_refresh_drops_totals_of_removed_counts():
+    """ A package whose counts in a refreshed month are all removed gets its
+    totals recomputed and is reported as changed.
+    """
+    model.Session.query(daputil.DAPResourceAccess)\
+        .filter(daputil.DAPResourceAccess.resource_id == 'res-2').delete()
+    model.Session.commit()
+
+    assert daputil.refresh_rollups({datetime.date(2020, 7, 1)}) == {'pkg-1'}
+    assert daputil.total_resource_accesses('res-2') == 0
+    assert daputil.total_package_accesses('pkg-1') == 7
@@ -0,0 +1,76 @@
+import datetime
+
+import pytest
+
+import ckan.tests.helpers as helpers
+from ckan.plugins import toolkit
+
+from ckanext.dapr import daputil
+
+
+@pytest.mark.usefixtures('accesses')
+@pytest.mark.parametrize('start_date, end_date', [
+    (None, None),
+    (datetime.date(2020, 5, 20), None),
+    (datetime.date(2020, 5, 21), datetime.date(2020, 7, 31)),
+    (datetime.date(2020, 6, 1), datetime.date(2020, 6, 30)),
+])
+def test_grouped_counts_match_single_counts(start_date, end_date):
+    """ The grouped queries give the same counts as counting each id on its
+    own, including for ids with no accesses.
+    """
+    package_ids = ['pkg-1', 'pkg-2', 'pkg-none']
+    resource_ids = ['res-1', 'res-2', 'res-3', 'res-none']
+
+    assert daputil.package_accesses(package_ids, start_date, end_date) == \
+        {p: daputil.total_package_accesses(p, start_date, end_date) for p in package_ids}
+    assert daputil.resource_accesses(resource_ids, start_date, end_date) == \
+        {r: daputil.total_resource_accesses(r, start_date, end_date) for r in resource_ids}
+
+
+@pytest.mark.ckan_config('ckan.plugins', 'dapr')
+@pytest.mark.usefixtures('accesses', 'with_plugins')
+def test_access_counts_action():
+    result = helpers.call_action('dapr_access_counts', package_ids=['pkg-1', 'pkg-2'],
+        resource_ids=['res-1'], start_date='2020-06-01')
+    assert result == {'packages': {'pkg-1': 5, 'pkg-2': 0}, 'resources': {'res-1': 2}}
+
+    with pytest.raises(toolkit.ValidationError):
+        helpers.call_action('dapr_access_counts', start_date='2020-06-01')
+
+
+@pytest.mark.ckan_config('ckan.plugins', 'dapr')
+@pytest.mark.usefixtures('accesses', 'with_plugins')
+def test_top_actions():
+    assert helpers.call_action('dapr_top_packages', limit=1) == \
+        [{'package_id': 'pkg-1', 'access_count': 10}]
+    assert helpers.call_action('dapr_top_resources', start_date='2020-06-01') == [
+        {'resource_id': 'res-2', 'package_id': 'pkg-1', 'access_count': 3},
+        {'resource_id': 'res-1', 'package_id': 'pkg-1', 'access_count': 2},
+    ]
+
+
+@pytest.mark.ckan_config('ckan.plugins', 'dapr')
+@pytest.mark.usefixtures('accesses', 'with_plugins')
+def test_access_series_action():
+    series = helpers.call_action('dapr_access_series', package_id='pkg-1', interval='month',
+        start_date='2020-05-01', end_date='2020-07-31')
+    assert series == [{'date': '2020-05-01', 'count': 5}, {'date': '2020-06-01', 'count': 2},
+        {'date': '2020-07-01', 'count': 3}]
+
+    with pytest.raises(toolkit.ValidationError):
+        helpers.call_action('dapr_access_series', interval='day', start_date='2000-01-01')
+
+
+@pytest.mark.ckan_config('ckan.plugins', 'dapr')
+@pytest.mark.usefixtures('accesses', 'with_plugins')
+@pytest.mark.parametrize('action, params', [
+    ('dapr_access_counts', {'package_ids': ['pkg-1']}),
+    ('dapr_top_packages', {}),
+    ('dapr_top_resources', {}),
+    ('dapr_access_series', {'package_id': 'pkg-1'}),
+])
+def test_actions_reject_reversed_date_range(action, params):
+    with pytest.raises(toolkit.ValidationError) as e:
+        helpers.call_action(action, start_date='2020-08-10', end_date='2020-05-20', **params)
+    assert 'start_date' in e.value.error_dict
@@ -0,0 +1,79 @@
+import datetime
+import tracemalloc
+import uuid
+
+from ckanext.dapr.batch import AccessBatch
+
+_DAY = datetime.date(2020, 5, 20)
+
+
+def _records(n, resources=200, days=30):
+    ids = [(str(uuid.uuid4()), str(uuid.uuid4())) for _ in range(resources)]
+    for i in range(n):
+        res_id, pkg_id = ids[i % resources]
+        yield res_id, pkg_id, _DAY + datetime.timedelta(days=i // resources % days), i % 7 + 1
+
+
+def _allocated_per_record(build, records):
+    tracemalloc.start()
+    try:
+        before = tracemalloc.get_traced_memory()[0]
+        kept = build(records)
+        allocated = tracemalloc.get_traced_memory()[0] - before
+    finally:
+        tracemalloc.stop()
+    assert kept
+    return allocated / len(records)
+
+
+def test_batch_memory_per_record():
+    """ A batch holds a record in a small fraction of the memory of a
+    download dictionary, once the ids of the records are known.
+    """
+    records = list(_records(20000))
+
+    def batch(records):
+        b = AccessBatch()
+        b.extend(records)
+        return b
+
+    def dicts(records):
+        return [{'resource_id': res_id, 'package_id': pkg_id, 'date': day, 'count': count}
+            for res_id, pkg_id, day, count in records]
+
+    batch_bytes = _allocated_per_record(batch, records)
+    dict_bytes = _allocated_per_record(dicts, records)
+    assert batch_bytes < 24
+    assert batch_bytes * 5 < dict_bytes
+
+
+def test_batch_rows_sum_duplicates():
+    records = list(_records(2000, resources=10, days=5))
+    batch = AccessBatch()
+    batch.extend(records)
+    batch.extend(records)
+
+    expected = {}
+    for res_id, pkg_id, day, count in records:
+        expected[res_id, day] = expected.get((res_id, day), 0) + 2 * count
+    rows = list(batch.rows())
+    assert {(r['resource_id'], r['access_date']): r['access_count'] for r in rows} == expected
+    assert len(rows) == len(expected) == len(batch.summed())
+    assert batch.months() == {datetime.date(2020, 5, 1)}
+    assert batch.date_range() == (_DAY, _DAY + datetime.timedelta(days=4))
+
+
+def test_summed_batch_keeps_selected_rows():
+    batch = AccessBatch()
+    batch.append('res-1', 'pkg-1', _DAY, 5)
+    batch.append('res-2', 'pkg-1', _DAY, 3)
+    batch.append('res-1', 'pkg-1', _DAY, 2)
+
+    kept = batch.summed(lambda res_id, day, count: count > 5)
+    assert [(r['resource_id'], r['access_count']) for r in kept.rows()] == [('res-1', 7)]
+
+    # Clearing a batch keeps its ids coded for the next records.
+    batch.clear()
+    assert len(batch) == 0 and batch.date_range() is None
+    batch.append('res-2', 'pkg-1', _DAY, 1)
+    assert batch.resource_ids() == {'res-2'}
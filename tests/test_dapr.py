@@ -150,7 +150,7 @@ def test_targeted_load(monkeypatch, cli, load_test_data):
     def mock_dap_api(*args, **kwargs):
         return MockDAPAPI(args, kwargs)
 
-    monkeypatch.setattr(requests, 'get', mock_dap_api)
+    monkeypatch.setattr(requests.Session, 'get', mock_dap_api)
 
     from ../dapr/cli import load
 
@@ -165,7 +165,7 @@ def test_update_load(monkeypatch, cli, load_test_data):
     def mock_dap_api(*args, **kwargs):
         return MockDAPAPI(args, kwargs)
 
-    monkeypatch.setattr(requests, 'get', mock_dap_api)
+    monkeypatch.setattr(requests.Session, 'get', mock_dap_api)
 
     from ../dapr/cli import load
 
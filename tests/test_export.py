@@ -0,0 +1,54 @@
+import datetime
+import json
+
+import pytest
+
+import ckan.tests.factories as factories
+
+from ckanext.dapr import cli as dapr_cli, daputil, export
+
+
+@pytest.mark.usefixtures('accesses')
+def test_export_rows_filtered(day):
+    assert len(list(export.export_rows())) == 4
+    assert {r[2] for r in export.export_rows(package_id='pkg-1')} == {'res-1', 'res-2'}
+    assert list(export.export_rows(resource_id='res-1', start_date=day + datetime.timedelta(days=1))) == \
+        [(datetime.date(2020, 6, 3), 'pkg-1', 'res-1', 2)]
+
+
+def test_export_streams_in_chunks(monkeypatch, dap_tables, day):
+    monkeypatch.setattr(export, 'EXPORT_CHUNK_ROWS', 10)
+    daputil.update_access_counts([
+        {'resource_id': f'res-{n}', 'package_id': 'pkg-1', 'date': day, 'count': n}
+        for n in range(25)
+    ])
+
+    chunks = list(export.export_chunks(export.FORMAT_NDJSON))
+    assert len(chunks) == 3
+    records = [json.loads(line) for chunk in chunks for line in chunk.splitlines()]
+    assert sorted(r['access_count'] for r in records) == list(range(25))
+
+
+@pytest.mark.usefixtures('accesses')
+def test_export_command(cli, tmp_path):
+    output = tmp_path / 'accesses.csv'
+    result = cli.invoke(dapr_cli.export_, ['--package', 'pkg-2', '-o', str(output)])
+    assert not result.exit_code, result.output
+    assert output.read_text().splitlines() == [
+        'access_date,package_id,resource_id,access_count',
+        '2020-05-20,pkg-2,res-3,9',
+    ]
+
+
+@pytest.mark.ckan_config('ckan.plugins', 'dapr')
+@pytest.mark.usefixtures('accesses', 'with_plugins')
+def test_export_route_requires_sysadmin(app):
+    user = factories.UserWithToken()
+    app.get('/analytics/export', headers={'Authorization': user['token']}, status=403)
+
+    sysadmin = factories.SysadminWithToken()
+    response = app.get('/analytics/export', query_string={'format': 'ndjson', 'package_id': 'pkg-1'},
+        headers={'Authorization': sysadmin['token']})
+    assert response.headers['Content-Type'].startswith('application/x-ndjson')
+    records = [json.loads(line) for line in response.body.splitlines()]
+    assert sorted(r['resource_id'] for r in records) == ['res-1', 'res-1', 'res-2']
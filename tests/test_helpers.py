@@ -0,0 +1,40 @@
+import datetime
+
+import pytest
+
+import ckan.tests.factories as factories
+
+from ckanext.dapr import daputil, helpers
+
+
+@pytest.mark.usefixtures('accesses')
+def test_package_resource_accesses_grouped(day):
+    assert daputil.package_resource_accesses('pkg-1') == {'res-1': 7, 'res-2': 3}
+    assert daputil.package_resource_accesses('pkg-1', start_date=day, end_date=day) == {'res-1': 5}
+
+
+@pytest.mark.usefixtures('with_request_context')
+def test_resource_downloads_memoized_per_request(monkeypatch):
+    calls = []
+
+    def mock_accesses(package_id):
+        calls.append(package_id)
+        return {'res-1': 7}
+
+    monkeypatch.setattr(daputil, 'package_resource_accesses', mock_accesses)
+
+    for _ in range(50):
+        assert helpers.resource_downloads('pkg-1').get('res-1', 0) == 7
+    assert calls == ['pkg-1']
+
+
+@pytest.mark.ckan_config('ckan.plugins', 'dapr')
+@pytest.mark.ckan_config('ckanext.dapr.show_downloads', 'true')
+@pytest.mark.usefixtures('with_plugins')
+def test_dataset_page_shows_downloads(app, record):
+    dataset = factories.Dataset(resources=[{'url': 'https://example.usa.gov/a.csv'}])
+    record(dataset, 42)
+    daputil.refresh_rollups()
+
+    response = app.get(f"/dataset/{dataset['name']}")
+    assert '42 downloads' in response.body
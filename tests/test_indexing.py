@@ -0,0 +1,78 @@
+import datetime
+
+import pytest
+
+import ckan.tests.factories as factories
+
+from ckanext.dapr import daputil, plugin
+
+
+@pytest.fixture
+def reindexed(monkeypatch):
+    calls = []
+    monkeypatch.setattr(daputil.search, 'rebuild',
+        lambda package_ids, **kwargs: calls.append(sorted(package_ids)))
+    return calls
+
+
+def test_refresh_reports_changed_packages(record):
+    popular = factories.Dataset(resources=[{'url': 'https://example.usa.gov/a.csv'}])
+    obscure = factories.Dataset(resources=[{'url': 'https://example.usa.gov/b.csv'}])
+    record(popular, 50)
+    record(obscure, 5)
+    month = {datetime.date(2020, 5, 1)}
+    assert daputil.refresh_rollups(month) == {popular['id'], obscure['id']}
+
+    # Loading the same counts again changes nothing.
+    record(popular, 50)
+    assert daputil.refresh_rollups(month) == set()
+
+    record(obscure, 6)
+    assert daputil.refresh_rollups(month) == {obscure['id']}
+
+
+def test_refresh_downloads_reindexes_changed_packages(reindexed, record, day):
+    popular = factories.Dataset(resources=[{'url': 'https://example.usa.gov/a.csv'}])
+    obscure = factories.Dataset(resources=[{'url': 'https://example.usa.gov/b.csv'}])
+    record(popular, 50)
+    record(obscure, 5)
+    daputil.refresh_downloads()
+
+    record(obscure, 6)
+    daputil.update_access_counts([{'resource_id': 'res-gone', 'package_id': 'pkg-gone',
+        'date': day, 'count': 1}])
+    daputil.refresh_downloads({datetime.date(2020, 5, 1)})
+
+    # Packages that do not exist are not reindexed.
+    assert reindexed == [sorted([popular['id'], obscure['id']]), [obscure['id']]]
+
+
+def test_reindex_packages_leaving_recent_window(reindexed, monkeypatch, ckan_config, record):
+    """ Packages whose accesses leave the recent window are reindexed, even
+    when no load changed their counts.
+    """
+    monkeypatch.setitem(ckan_config, 'ckanext.dapr.index_recent_days', 7)
+    leaving = factories.Dataset(resources=[{'url': 'https://example.usa.gov/a.csv'}])
+    staying = factories.Dataset(resources=[{'url': 'https://example.usa.gov/b.csv'}])
+    record(leaving, 5, datetime.date.today() - datetime.timedelta(days=7))
+    record(staying, 5, datetime.date.today() - datetime.timedelta(days=3))
+    daputil.refresh_downloads()
+
+    # A day later, the first day of the window leaves it.
+    monkeypatch.setitem(ckan_config, 'ckanext.dapr.index_recent_days', 6)
+    daputil.reindex_downloads()
+    daputil.reindex_downloads()
+
+    assert reindexed == [sorted([leaving['id'], staying['id']]), [leaving['id']]]
+
+
+def test_index_document_download_counts(monkeypatch, ckan_config, record):
+    monkeypatch.setitem(ckan_config, 'ckanext.dapr.index_recent_days', 7)
+    dataset = factories.Dataset(resources=[{'url': 'https://example.usa.gov/a.csv'}])
+    record(dataset, 50, datetime.date.today() - datetime.timedelta(days=30))
+    record(dataset, 5, datetime.date.today() - datetime.timedelta(days=1))
+    daputil.refresh_rollups()
+
+    pkg_dict = plugin.daprPlugin().before_dataset_index({'id': dataset['id']})
+    assert pkg_dict['dapr_downloads_total'] == 55
+    assert pkg_dict['dapr_downloads_recent'] == 5
@@ -0,0 +1,132 @@
+import datetime
+import types
+
+import pytest
+
+import ckan.lib.redis as redis
+import ckan.model as model
+
+from ckanext.dapr import daputil, jobs
+
+from .dap_server import FailingDAPServer, MockDAPServer
+
+
+@pytest.fixture
+def job_statuses(monkeypatch):
+    """ The RQ status of each job, by id. Jobs not in it are missing.
+    """
+    statuses = {}
+
+    def job_from_id(job_id):
+        if job_id not in statuses:
+            raise KeyError(job_id)
+        return types.SimpleNamespace(get_status=lambda: statuses[job_id])
+
+    monkeypatch.setattr(jobs, 'job_from_id', job_from_id)
+    return statuses
+
+
+@pytest.fixture
+def queued(monkeypatch, job_statuses):
+    calls = []
+
+    def enqueue_job(fn, args, title=None, queue=None, rq_kwargs=None):
+        calls.append(args[0])
+        job_id = f'job-{len(calls)}'
+        job_statuses[job_id] = 'queued'
+        return types.SimpleNamespace(id=job_id)
+
+    monkeypatch.setattr(jobs, 'enqueue_job', enqueue_job)
+    return calls
+
+
+def _statuses():
+    return sorted((w['start_date'], w['status']) for w in jobs.load_status())
+
+
+def test_windows_queued_once_and_loaded(dap_load, queued, monkeypatch, ckan_config, dap_records):
+    jobs.enqueue_windows(datetime.date(2020, 5, 1), datetime.date(2020, 5, 6), 3)
+    assert len(queued) == 2
+    # Windows already queued are not queued again.
+    assert jobs.enqueue_windows(datetime.date(2020, 5, 1), datetime.date(2020, 5, 6), 3) == []
+    assert _statuses() == [('2020-05-01', 'queued'), ('2020-05-04', 'queued')]
+
+    with MockDAPServer(dap_records) as server:
+        monkeypatch.setitem(ckan_config, 'ckanext.dapr.api_url', server.url)
+        for checkpoint_id in queued:
+            jobs.load_window(checkpoint_id)
+
+    assert _statuses() == [('2020-05-01', 'done'), ('2020-05-04', 'done')]
+    assert daputil.total_package_accesses(dap_load['id']) == sum(range(12))
+
+
+def test_locked_window_is_skipped(dap_load, queued):
+    checkpoint, = jobs.enqueue_windows(datetime.date(2020, 5, 1), datetime.date(2020, 5, 6), 7)
+    lock = jobs._window_lock(redis.connect_to_redis(), checkpoint.start_date, checkpoint.end_date)
+    assert lock.acquire(blocking=False)
+    try:
+        assert _statuses() == [('2020-05-01', 'running')]
+        # Another worker picking up the same window leaves it alone.
+        jobs.load_window(checkpoint.id)
+        assert checkpoint.page == 0
+    finally:
+        lock.release()
+
+
+def test_failed_window_reported_and_retried(dap_load, queued, monkeypatch, ckan_config, dap_records):
+    checkpoint, = jobs.enqueue_windows(datetime.date(2020, 5, 1), datetime.date(2020, 5, 6), 7)
+    with FailingDAPServer(dap_records, failing_page=2) as server:
+        monkeypatch.setitem(ckan_config, 'ckanext.dapr.api_url', server.url)
+        with pytest.raises(Exception):
+            jobs.load_window(checkpoint.id)
+
+    status, = jobs.load_status()
+    assert status['status'] == 'failed'
+    assert 'page 2' in status['error']
+    assert status['pages'] == 1
+
+    assert [c.id for c in jobs.retry_failed()] == [checkpoint.id]
+    assert _statuses() == [('2020-05-01', 'queued')]
+
+
+def test_lost_window_reported_and_requeued(dap_load, queued, job_statuses):
+    """ A window whose worker was killed without recording an error is failed
+    once its job ended, and is queued again.
+    """
+    checkpoint, = jobs.enqueue_windows(datetime.date(2020, 5, 1), datetime.date(2020, 5, 6), 7)
+    job_statuses['job-1'] = 'started'
+    assert _statuses() == [('2020-05-01', 'queued')]
+
+    job_statuses['job-1'] = 'failed'
+    assert _statuses() == [('2020-05-01', 'failed')]
+    assert jobs.enqueue_windows(datetime.date(2020, 5, 1), datetime.date(2020, 5, 6), 7) == [checkpoint]
+    assert queued == [checkpoint.id, checkpoint.id]
+    assert _statuses() == [('2020-05-01', 'queued')]
+
+    # The record of a job that ended expires.
+    del job_statuses['job-2']
+    assert _statuses() == [('2020-05-01', 'failed')]
+    assert [c.id for c in jobs.retry_failed()] == [checkpoint.id]
+
+
+def test_update_window_writes_only_changed_rows(dap_load, queued, monkeypatch, ckan_config, dap_records):
+    with MockDAPServer(dap_records) as server:
+        monkeypatch.setitem(ckan_config, 'ckanext.dapr.api_url', server.url)
+        daputil.load_downloads(None, None)
+
+        revised = [dict(r) for r in dap_records]
+        revised[-1]['total_events'] += 10
+        server.records = revised
+        checkpoint, = jobs.enqueue_windows(datetime.date(2020, 5, 4), datetime.date(2020, 5, 6), 7,
+            only_changed=True)
+        refreshed = []
+        monkeypatch.setattr(daputil, 'refresh_downloads', refreshed.append)
+        jobs.load_window(checkpoint.id)
+
+    assert checkpoint.only_changed
+    assert checkpoint.rows_written == 1
+    assert refreshed == [{datetime.date(2020, 5, 1)}]
+    access = model.Session.query(daputil.DAPResourceAccess).get(
+        (dap_load['resources'][1]['id'], datetime.date(2020, 5, 6)))
+    assert access.access_count == 11 + 10
+
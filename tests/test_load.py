@@ -0,0 +1,149 @@
+import datetime
+
+import pytest
+
+from ckanext.dapr import cli as dapr_cli, daputil, fetch
+from ckanext.dapr.metrics import metrics
+
+from .dap_server import FailingDAPServer, MockDAPServer
+
+def test_interrupted_load_resumes_after_last_page(dap_load, monkeypatch, ckan_config, dap_records):
+    with FailingDAPServer(dap_records, failing_page=3) as server:
+        monkeypatch.setitem(ckan_config, 'ckanext.dapr.api_url', server.url)
+        with pytest.raises(fetch.DAPRetrievalError):
+            daputil.load_downloads(None, None)
+
+    checkpoint = daputil.unfinished_checkpoint()
+    assert checkpoint.page == 2
+    assert checkpoint.rows_written == 8
+
+    with MockDAPServer(dap_records) as server:
+        monkeypatch.setitem(ckan_config, 'ckanext.dapr.api_url', server.url)
+        written = daputil.load_downloads(None, None, checkpoint)
+
+    assert [int(r['page']) for r in server.requests][:2] == [3, 4]
+    assert written == 12
+    assert daputil.unfinished_checkpoint() is None
+    assert daputil.total_package_accesses(dap_load['id']) == sum(range(12))
+
+
+def test_load_without_api_key_keeps_counts(accesses, monkeypatch, ckan_config):
+    """ A load that cannot reach the DAP API fails before clearing its window.
+    """
+    monkeypatch.delenv('DAP_KEY', raising=False)
+    monkeypatch.setitem(ckan_config, 'ckanext.dapr.api_url', 'http://127.0.0.1:9')
+    with pytest.raises(ValueError):
+        daputil.load_downloads(None, None)
+    assert daputil.total_accesses() == 19
+
+
+@pytest.mark.parametrize('start_date, resumed', [
+    (None, False),
+    (datetime.date(2020, 5, 4), True),
+])
+def test_reload_supersedes_interrupted_load(dap_load, monkeypatch, ckan_config, dap_records, start_date,
+        resumed):
+    """ A load overlapping an interrupted one keeps resuming that load from
+    adding its remaining pages again: the interrupted load is closed when the
+    new load covers its window, and starts over otherwise.
+    """
+    with FailingDAPServer(dap_records, failing_page=3) as server:
+        monkeypatch.setitem(ckan_config, 'ckanext.dapr.api_url', server.url)
+        with pytest.raises(fetch.DAPRetrievalError):
+            daputil.load_downloads(None, None)
+    checkpoint = daputil.unfinished_checkpoint()
+
+    with MockDAPServer(dap_records) as server:
+        monkeypatch.setitem(ckan_config, 'ckanext.dapr.api_url', server.url)
+        daputil.load_downloads(start_date, None)
+        assert daputil.unfinished_checkpoints() == ([checkpoint] if resumed else [])
+        if resumed:
+            assert checkpoint.page == 0
+            daputil.load_downloads(None, None, checkpoint)
+
+    assert daputil.total_package_accesses(dap_load['id']) == sum(range(12))
+
+
+def test_day_split_across_chunks_is_summed(dap_load, monkeypatch, ckan_config, dap_records):
+    """ Records for one resource and day on pages written in different
+    chunks are summed, and loading the window again replaces the sum.
+    """
+    # The file of the third record is also linked from another page, on page two.
+    linked = {'file_name': '/data/0.csv', 'page': 'example.usa.gov/other', 'date': '2020-05-02',
+        'total_events': 10}
+    records = dap_records[:4] + [linked] + dap_records[4:]
+    res_id = dap_load['resources'][0]['id']
+    day = datetime.date(2020, 5, 2)
+
+    for _ in range(2):
+        with MockDAPServer(records) as server:
+            monkeypatch.setitem(ckan_config, 'ckanext.dapr.api_url', server.url)
+            daputil.load_downloads(None, None)
+        assert daputil.total_resource_accesses(res_id, day, day) == 2 + 10
+        assert daputil.total_package_accesses(dap_load['id']) == sum(range(12)) + 10
+
+
+def test_parallel_backfill_by_window(dap_load, monkeypatch, ckan_config, cli, dap_records):
+    with MockDAPServer(dap_records) as server:
+        monkeypatch.setitem(ckan_config, 'ckanext.dapr.api_url', server.url)
+        result = cli.invoke(dapr_cli.load, ['-s', '2020-05-01', '-e', '2020-05-06',
+            '--workers', '2', '--window', 'day'])
+
+    assert result.exit_code == 0, result.output
+    assert '2020-05-03 to 2020-05-03' in result.output
+    assert daputil.total_package_accesses(dap_load['id']) == sum(range(12))
+
+
+def test_update_writes_only_changed_rows(dap_load, monkeypatch, ckan_config, dap_records):
+    """ An update loads the trailing days again and writes only the rows
+    DAP revised or added, refreshing nothing when nothing changed.
+    """
+    with MockDAPServer(dap_records) as server:
+        monkeypatch.setitem(ckan_config, 'ckanext.dapr.api_url', server.url)
+        daputil.load_downloads(None, None)
+
+    revised = [dict(r) for r in dap_records]
+    revised[-1]['total_events'] += 10
+    revised.append({'file_name': '/data/0.csv', 'page': 'example.usa.gov/data',
+        'date': '2020-05-07', 'total_events': 4})
+    refreshed = []
+    monkeypatch.setattr(daputil, 'refresh_downloads', refreshed.append)
+    metrics.reset_load()
+    with MockDAPServer(revised) as server:
+        monkeypatch.setitem(ckan_config, 'ckanext.dapr.api_url', server.url)
+        written = daputil.load_downloads(daputil.update_start_date(2), None, only_changed=True)
+        assert all(r['after'] == '2020-05-04' for r in server.requests)
+
+    assert written == 2
+    counters = metrics.snapshot()['counters']
+    assert (counters['rows_inserted'], counters['rows_changed'], counters['rows_unchanged']) == (1, 1, 5)
+    assert refreshed == [{datetime.date(2020, 5, 1)}]
+
+    metrics.reset_load()
+    with MockDAPServer(revised) as server:
+        monkeypatch.setitem(ckan_config, 'ckanext.dapr.api_url', server.url)
+        assert daputil.load_downloads(daputil.update_start_date(2), None, only_changed=True) == 0
+    assert len(refreshed) == 1
+
+
+def test_update_compares_whole_days(dap_load, monkeypatch, ckan_config, dap_records):
+    """ An update compares a day's full count with the recorded one, even
+    when the day's records span pages.
+    """
+    # The file of 2020-05-05 is also linked from another page, a page after the first link.
+    linked = {'file_name': '/data/0.csv', 'page': 'example.usa.gov/other', 'date': '2020-05-05',
+        'total_events': 10}
+    records = dap_records[:10] + [linked] + dap_records[10:]
+    with MockDAPServer(records) as server:
+        monkeypatch.setitem(ckan_config, 'ckanext.dapr.api_url', server.url)
+        daputil.load_downloads(None, None)
+
+        refreshed = []
+        monkeypatch.setattr(daputil, 'refresh_downloads', refreshed.append)
+        metrics.reset_load()
+        assert daputil.load_downloads(daputil.update_start_date(2), None, only_changed=True) == 0
+
+    counters = metrics.snapshot()['counters']
+    assert (counters.get('rows_changed', 0), counters['rows_unchanged']) == (0, 6)
+    assert refreshed == []
+
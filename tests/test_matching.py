@@ -0,0 +1,110 @@
+import pytest
+
+import ckan.tests.factories as factories
+import ckan.tests.helpers as helpers
+
+from ckanext.dapr import daputil, matching
+
+
+@pytest.mark.ckan_config('ckan.plugins', 'dapr')
+@pytest.mark.usefixtures('clean_db', 'with_plugins')
+def test_url_index_bulk_load():
+    """ The index maps both http and https forms of a resource URL to the
+    resource and package ids.
+    """
+    dataset = factories.Dataset()
+    resource = factories.Resource(package_id=dataset['id'],
+        url='http://studentaid.gov/sites/default/files/PortfolioSummary.xls')
+
+    index = matching.ResourceURLIndex()
+    index.load()
+
+    assert index.lookup('https://studentaid.gov/sites/default/files/PortfolioSummary.xls') == \
+        (resource['id'], dataset['id'])
+    assert index.lookup('https://studentaid.gov/unknown.xls') == (None, None)
+
+
+@pytest.mark.ckan_config('ckan.plugins', 'dapr')
+@pytest.mark.usefixtures('clean_db', 'with_plugins')
+def test_url_index_follows_resource_changes():
+    """ Once loaded, the shared index is kept current by the plugin's
+    resource hooks.
+    """
+    dataset = factories.Dataset()
+    matching.url_index.load()
+
+    resource = factories.Resource(package_id=dataset['id'], url='https://example.usa.gov/first.csv')
+    assert matching.url_index.lookup('https://example.usa.gov/first.csv')[0] == resource['id']
+
+    helpers.call_action('resource_patch', id=resource['id'], url='https://example.usa.gov/second.csv')
+    assert matching.url_index.lookup('https://example.usa.gov/first.csv') == (None, None)
+    assert matching.url_index.lookup('https://example.usa.gov/second.csv')[0] == resource['id']
+
+    helpers.call_action('resource_delete', id=resource['id'])
+    assert matching.url_index.lookup('https://example.usa.gov/second.csv') == (None, None)
+
+
+@pytest.mark.usefixtures('clean_db')
+def test_download_path_fast_path(monkeypatch, ckan_config):
+    """ Records for the local site's download URLs are matched by the
+    resource id in their path, and other records by their URL, including
+    harvested resources that link to another CKAN site's download URLs.
+    """
+    monkeypatch.setitem(ckan_config, 'ckan.site_url', 'https://data.example.gov')
+    dataset = factories.Dataset()
+    uploaded = factories.Resource(package_id=dataset['id'], url='bpersonnel2021-22.csv')
+    harvested = factories.Resource(package_id=dataset['id'],
+        url='https://data.ed.gov/dataset/idea/resource/80bc1b6e-f748-4b2e-81a6-746d8fcbd975/download/b.csv')
+    matching.url_index.load()
+    looked_up = []
+    monkeypatch.setattr(daputil, 'get_resource_ids',
+        lambda url: looked_up.append(url) or matching.url_index.lookup(url))
+
+    path_matcher = matching.configured_path_matcher()
+    local_file = f"/dataset/{dataset['name']}/resource/{uploaded['id']}/download/bpersonnel2021-22.csv"
+    assert daputil.match_resource(local_file, 'data.example.gov/dataset/x', path_matcher) == \
+        (uploaded['id'], dataset['id'])
+    assert looked_up == []
+
+    remote_file = '/dataset/idea/resource/80bc1b6e-f748-4b2e-81a6-746d8fcbd975/download/b.csv'
+    assert daputil.match_resource(remote_file, 'data.ed.gov/dataset/idea', path_matcher) == \
+        (harvested['id'], dataset['id'])
+    assert len(looked_up) == 1
+
+
+def _records(*files):
+    return [[{'file_name': path, 'page': f'{site}/page', 'date': '2020-05-20', 'total_events': 1}
+        for site, path in files]]
+
+
+@pytest.mark.usefixtures('clean_db', 'clean_redis')
+def test_unrelated_sites_and_known_misses_skip_lookups(monkeypatch):
+    """ Records from sites no resource links to are dropped without a
+    lookup, and files found not to match are remembered across loads.
+    """
+    dataset = factories.Dataset()
+    resource = factories.Resource(package_id=dataset['id'], url='https://example.usa.gov/data.csv')
+    matching.url_index.load()
+    looked_up = []
+    monkeypatch.setattr(daputil, 'get_resource_ids',
+        lambda url: looked_up.append(url) or matching.url_index.lookup(url))
+    pages = _records(('example.usa.gov', '/data.csv'), ('example.usa.gov', '/other.csv'),
+        ('example.usa.gov', '/third.csv'), ('unrelated.gov', '/data.csv'))
+
+    misses = daputil.miss_cache()
+    matched = list(daputil.match_downloads(pages, misses))
+    assert [d['resource_id'] for d in matched] == [resource['id']]
+    assert looked_up == ['https://example.usa.gov/data.csv', 'https://example.usa.gov/other.csv',
+        'https://example.usa.gov/third.csv']
+    misses.save()
+
+    looked_up.clear()
+    assert len(list(daputil.match_downloads(pages, daputil.miss_cache()))) == 1
+    assert looked_up == ['https://example.usa.gov/data.csv']
+
+    # A new resource may match a remembered miss, so only that file is forgotten.
+    looked_up.clear()
+    factories.Resource(package_id=dataset['id'], url='https://example.usa.gov/other.csv')
+    matching.url_index.load()
+    assert len(list(daputil.match_downloads(pages, daputil.miss_cache()))) == 2
+    assert looked_up == ['https://example.usa.gov/data.csv', 'https://example.usa.gov/other.csv']
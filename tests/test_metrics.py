@@ -0,0 +1,52 @@
+import pytest
+
+from ckanext.dapr import daputil, metrics
+
+
+def test_report_latency_histogram():
+    registry = metrics.Metrics()
+
+    @registry.timed('top_packages')
+    def query():
+        return []
+
+    for _ in range(3):
+        query()
+    registry.observe('top_packages', 30.0)
+
+    histogram = registry.histogram_snapshot()['top_packages']
+    assert histogram['count'] == 4
+    # The slow observation falls above the largest bucket.
+    assert sum(histogram['buckets']) == 3
+
+
+@pytest.mark.usefixtures('clean_redis')
+def test_prometheus_text_includes_last_load():
+    metrics.metrics.reset()
+    metrics.metrics.count('records_seen', 10)
+    metrics.metrics.count('records_matched', 4)
+    metrics.metrics.count('records_fetched', 20)
+    metrics.metrics.add_time('fetch', 1.5)
+    metrics.publish_load(metrics.metrics.snapshot(), 4.0)
+    daputil.total_accesses()
+
+    text = metrics.prometheus_text()
+    assert 'dapr_last_load_count{counter="records_matched"} 4' in text
+    assert 'dapr_last_load_phase_seconds{phase="fetch"} 1.5' in text
+    assert 'dapr_last_load_records_per_second 5.0' in text
+    assert 'dapr_report_query_seconds_count{query="total_accesses"} 1' in text
+
+
+@pytest.mark.ckan_config('ckan.plugins', 'dapr')
+@pytest.mark.ckan_config('ckanext.dapr.metrics_enabled', 'true')
+@pytest.mark.usefixtures('with_plugins', 'clean_redis')
+def test_metrics_endpoint(app):
+    response = app.get('/analytics/metrics')
+    assert response.headers['Content-Type'].startswith('text/plain')
+    assert '# TYPE dapr_report_query_seconds histogram' in response.body
+
+
+@pytest.mark.ckan_config('ckan.plugins', 'dapr')
+@pytest.mark.usefixtures('with_plugins')
+def test_metrics_endpoint_disabled_by_default(app):
+    app.get('/analytics/metrics', status=404)
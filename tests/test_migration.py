@@ -0,0 +1,63 @@
+import datetime
+
+import pytest
+import sqlalchemy as sa
+
+import ckan.model as model
+
+from ckanext.dapr import daputil
+
+
+@pytest.mark.ckan_config('ckan.plugins', 'dapr')
+@pytest.mark.usefixtures('with_plugins', 'clean_db')
+def test_migrations_create_tables_and_indexes(migrate_db_for):
+    migrate_db_for('dapr')
+
+    inspector = sa.inspect(model.meta.engine)
+    assert {'dap_resource_accesses', 'dap_resource_monthly', 'dap_package_monthly',
+        'dap_resource_totals', 'dap_package_totals', 'dap_load_checkpoints', 'dap_package_rankings'} <= \
+        set(inspector.get_table_names())
+    indexes = {i['name']: i['column_names'] for i in inspector.get_indexes('dap_resource_accesses')}
+    assert indexes['ix_dap_resource_accesses_package_date'] == ['package_id', 'access_date']
+    assert indexes['ix_dap_resource_accesses_access_date'] == ['access_date']
+    columns = {c['name'] for c in inspector.get_columns('dap_load_checkpoints')}
+    assert {'source', 'job_id', 'error', 'only_changed'} <= columns
+
+
+@pytest.mark.ckan_config('ckan.plugins', 'dapr')
+@pytest.mark.usefixtures('with_plugins', 'clean_db')
+def test_migrations_after_init(migrate_db_for):
+    """ Sites that created the tables with ckan dapr init can still upgrade.
+    """
+    daputil.init_dap_tables()
+    migrate_db_for('dapr')
+
+    inspector = sa.inspect(model.meta.engine)
+    assert 'ix_dap_resource_accesses_access_date' in \
+        {i['name'] for i in inspector.get_indexes('dap_resource_accesses')}
+
+
+
+@pytest.mark.ckan_config('ckan.plugins', 'dapr')
+@pytest.mark.ckan_config('ckanext.dapr.partition_accesses', 'true')
+@pytest.mark.usefixtures('with_plugins', 'clean_db')
+def test_partitions_created_ahead_of_loads(migrate_db_for):
+    """ Loads create the partitions of the coming months, moving the counts
+    the default partition holds for them.
+    """
+    if model.meta.engine.dialect.name != 'postgresql':
+        pytest.skip('Partitioning needs PostgreSQL.')
+    migrate_db_for('dapr')
+    today = datetime.date(datetime.date.today().year + 3, 2, 10)
+    model.Session.add(daputil.DAPResourceAccess(resource_id='res-1', package_id='pkg-1',
+        access_date=today, access_count=4))
+    model.Session.commit()
+
+    created = daputil.ensure_partitions(today)
+    assert created[0] == datetime.date(today.year - 1, 1, 1)
+    assert created[-1] == datetime.date(today.year, 3, 1)
+    assert daputil.ensure_partitions(today) == []
+
+    partition = f'dap_resource_accesses_{today:%Y_%m}'
+    assert model.Session.execute(sa.text(f'SELECT access_count FROM {partition}')).scalar() == 4
+    assert model.Session.execute(sa.text('SELECT count(*) FROM dap_resource_accesses_default')).scalar() == 0
@@ -0,0 +1,57 @@
+import datetime
+
+from ckanext.dapr import daputil, rawcache
+
+from .dap_server import MockDAPServer
+
+
+def test_store_keeps_latest_copy_of_each_record(tmp_path, dap_records):
+    store = rawcache.RawResponseStore(str(tmp_path))
+    store.write_page(dap_records[:4])
+    # A later load fetches the same day again with a revised count.
+    store.write_page([dict(dap_records[0], total_events=99)])
+
+    assert store.days() == ['2020-05-01', '2020-05-02']
+    assert store.days(start_date=datetime.date(2020, 5, 2)) == ['2020-05-02']
+    counts = [r['total_events'] for r in store.records('2020-05-01')]
+    assert counts == [99, 1]
+
+
+def test_store_pages_resume(tmp_path, dap_records):
+    store = rawcache.RawResponseStore(str(tmp_path))
+    store.write_page(dap_records)
+
+    pages = list(store.pages(page_size=5))
+    assert [len(p) for p in pages] == [5, 5, 2]
+    assert list(store.pages(page_size=5, first_page=3)) == pages[2:]
+
+
+def test_replay_matches_without_api(dap_load, monkeypatch, ckan_config, tmp_path, dap_records):
+    monkeypatch.setitem(ckan_config, 'ckanext.dapr.raw_cache_dir', str(tmp_path))
+    with MockDAPServer(dap_records) as server:
+        monkeypatch.setitem(ckan_config, 'ckanext.dapr.api_url', server.url)
+        daputil.load_downloads(None, None)
+    assert daputil.total_package_accesses(dap_load['id']) == sum(range(12))
+
+    # Point the API somewhere unreachable: the replay must not use it.
+    monkeypatch.setitem(ckan_config, 'ckanext.dapr.api_url', 'http://127.0.0.1:9')
+    written = daputil.load_downloads(None, None, source=daputil.SOURCE_CACHE)
+
+    assert written == 12
+    assert daputil.total_package_accesses(dap_load['id']) == sum(range(12))
+
+
+def test_replay_keeps_days_not_stored(dap_load, monkeypatch, ckan_config, tmp_path, dap_records):
+    """ A replay replaces only the days the store holds, since it cannot load the others.
+    """
+    with MockDAPServer(dap_records) as server:
+        monkeypatch.setitem(ckan_config, 'ckanext.dapr.api_url', server.url)
+        daputil.load_downloads(None, None)
+    # The store was turned on after the first days were loaded.
+    store = rawcache.RawResponseStore(str(tmp_path))
+    store.write_page(dap_records[4:])
+    monkeypatch.setitem(ckan_config, 'ckanext.dapr.raw_cache_dir', str(tmp_path))
+
+    assert daputil.load_downloads(None, None, source=daputil.SOURCE_CACHE) == 8
+    assert daputil.total_package_accesses(dap_load['id']) == sum(range(12))
+
@@ -0,0 +1,58 @@
+import datetime
+
+import pytest
+
+import ckan.model as model
+
+from ckanext.dapr import cache, daputil, export, reporting
+
+
+def test_reports_fall_back_to_primary_session():
+    assert reporting.session() is model.meta.Session
+
+
+@pytest.mark.usefixtures('accesses')
+def test_reports_use_reporting_database(monkeypatch, ckan_config, day):
+    # The primary database stands in for a replica.
+    monkeypatch.setitem(ckan_config, 'ckanext.dapr.reporting_sqlalchemy_url', ckan_config['sqlalchemy.url'])
+    session = reporting.session()
+    try:
+        assert session is not model.meta.Session
+        assert session.get_bind() is not model.meta.engine
+        assert reporting.session() is session
+
+        assert daputil.total_accesses() == 19
+        assert [(p.package_id, p.access_count) for p in daputil.top_packages()] == [('pkg-1', 10), ('pkg-2', 9)]
+        assert daputil.access_series(day, day) == [(day, 14)]
+        assert len(list(export.export_rows(package_id='pkg-1'))) == 3
+    finally:
+        reporting.remove()
+
+
+@pytest.mark.usefixtures('accesses')
+def test_index_fields_read_primary(monkeypatch, ckan_config, tmp_path):
+    """ A replica behind the latest load serves reports, but not the search
+    index fields, and reports computed on it are not cached until it catches up.
+    """
+    monkeypatch.setitem(ckan_config, 'ckanext.dapr.reporting_sqlalchemy_url', f'sqlite:///{tmp_path}/replica.db')
+    monkeypatch.setattr(reporting, 'position', lambda: '0/16B3748')
+    lagging = [True]
+    monkeypatch.setattr(reporting, 'caught_up', lambda position: not lagging[0])
+    replica = reporting.session()
+    try:
+        tables = [t for name, t in model.meta.metadata.tables.items() if name.startswith('dap_')]
+        model.meta.metadata.create_all(replica.get_bind(), tables=tables)
+        cache.invalidate()
+
+        assert daputil.total_accesses() == 0
+        assert daputil.package_index_fields('pkg-1')['dapr_downloads_total'] == 10
+
+        computed = []
+        def compute():
+            computed.append(len(computed) + 1)
+            return computed[-1]
+        assert [cache.cached('report', compute) for _ in range(2)] == [1, 2]
+        lagging[0] = False
+        assert [cache.cached('report', compute) for _ in range(2)] == [3, 3]
+    finally:
+        reporting.remove()
@@ -0,0 +1,139 @@
+import time
+
+import pytest
+
+import ckan.lib.redis as redis
+
+from ckanext.dapr import daputil, fetch
+
+from .dap_server import MockDAPServer
+
+_RECORDS = [
+    {'file_name': f'/{n}.csv', 'page': 'example.usa.gov/data',
+        'date': '2020-05-20', 'total_events': n}
+    for n in range(1, 11)
+]
+
+
+class ThrottlingDAPServer(MockDAPServer):
+    """ Reject the requests with the given numbers, counting from 1, with a
+    status and optional Retry-After header, as a throttled API would.
+    """
+
+    def __init__(self, records, throttled, status=429, retry_after=None):
+        super().__init__(records)
+        self.throttled = set(throttled)
+        self.status = status
+        self.retry_after = retry_after
+
+    def respond(self, path, params):
+        if len(self.requests) in self.throttled:
+            headers = {'Retry-After': self.retry_after} if self.retry_after is not None else {}
+            return self.status, headers, []
+        return super().respond(path, params)
+
+
+def _fetcher(server, limit=2, **kwargs):
+    kwargs.setdefault('concurrency', 1)
+    return fetch.PageFetcher(f'{server.url}/reports/download/data', {}, {'limit': limit},
+        requests_per_hour=3600000, **kwargs)
+
+
+def test_pages_returned_in_order():
+    """ Pages fetched concurrently are still handed back in page order,
+    and paging stops at the first empty page.
+    """
+    with MockDAPServer(_RECORDS) as server:
+        fetcher = fetch.PageFetcher(f'{server.url}/reports/download/data', {}, {'limit': 2},
+            concurrency=4, requests_per_hour=3600000)
+        pages = list(fetcher.pages())
+
+    assert [r['total_events'] for jr in pages for r in jr] == list(range(1, 11))
+    # The requests after the first empty page are bounded by the concurrency.
+    assert len(server.requests) <= len(pages) + 4
+
+
+def test_failed_page_raises():
+    """ A failed request is reported, rather than treated as the last page,
+    so a load can tell an interruption from the end of the report.
+    """
+    with MockDAPServer(_RECORDS) as server:
+        fetcher = fetch.PageFetcher(f'{server.url}/missing', {}, {'limit': 2}, concurrency=2,
+            requests_per_hour=3600000)
+        with pytest.raises(fetch.DAPRetrievalError):
+            list(fetcher.pages())
+
+
+def test_token_bucket_limits_rate():
+    bucket = fetch.TokenBucket(rate=50, capacity=1)
+    began = time.monotonic()
+    for _ in range(6):
+        bucket.acquire()
+    # The first token is available immediately, the next five take 1/50 s each.
+    assert time.monotonic() - began >= 0.09
+
+
+@pytest.mark.usefixtures('clean_redis')
+def test_shared_rate_limiter_spans_processes():
+    """ Limiters of separate processes, sharing one Redis, keep to one rate
+    together, and a pause asked for by one holds the others.
+    """
+    limiters = [fetch.SharedRateLimiter(redis.connect_to_redis(), rate=50) for _ in range(2)]
+    began = time.time()
+    for _ in range(3):
+        for limiter in limiters:
+            limiter.acquire()
+    # The first request goes at once, the next five take 1/50 s each.
+    assert time.time() - began >= 0.09
+
+    limiters[0].pause(0.1)
+    paused = time.time()
+    limiters[1].acquire()
+    assert time.time() - paused >= 0.09
+
+
+@pytest.mark.usefixtures('clean_redis')
+def test_dap_pages_uses_configured_api(monkeypatch, ckan_config):
+    monkeypatch.setenv('DAP_KEY', 'test')
+    with MockDAPServer(_RECORDS) as server:
+        monkeypatch.setitem(ckan_config, 'ckanext.dapr.api_url', server.url)
+        monkeypatch.setitem(ckan_config, 'ckanext.dapr.batch_size', 4)
+        monkeypatch.setitem(ckan_config, 'ckanext.dapr.requests_per_hour', 3600000)
+        pages = list(daputil.dap_pages(None, None))
+
+    assert [len(jr) for jr in pages] == [4, 4, 2]
+
+
+def test_page_size_adapts():
+    """ Requests grow to the largest page size while the API keeps up, and
+    shrink after throttling, while pages are handed back in the configured
+    limit and order.
+    """
+    records = [dict(_RECORDS[0], total_events=n) for n in range(60)]
+    with ThrottlingDAPServer(records, throttled=[6], retry_after='0') as server:
+        pages = list(_fetcher(server, max_limit=8).pages())
+
+    assert [r['total_events'] for jr in pages for r in jr] == list(range(60))
+    assert {len(jr) for jr in pages} == {2}
+    # The throttled sixth request is retried at its size, and the next ones are smaller.
+    assert [int(r['limit']) for r in server.requests] == [2, 2, 4, 8, 8, 8, 8, 4, 4, 8, 8, 8]
+
+
+def test_throttled_request_waits_retry_after():
+    with ThrottlingDAPServer(_RECORDS, throttled=[1], retry_after='0.3') as server:
+        began = time.monotonic()
+        pages = list(_fetcher(server, concurrency=2).pages())
+
+    assert time.monotonic() - began >= 0.3
+    assert [r['total_events'] for jr in pages for r in jr] == list(range(1, 11))
+
+
+def test_failing_requests_back_off_then_raise():
+    with ThrottlingDAPServer(_RECORDS, throttled=[1, 2], status=503) as server:
+        pages = list(_fetcher(server, backoff=0.001).pages())
+    assert [r['total_events'] for jr in pages for r in jr] == list(range(1, 11))
+
+    with ThrottlingDAPServer(_RECORDS, throttled=range(1, 10), status=503) as server:
+        with pytest.raises(fetch.DAPRetrievalError):
+            list(_fetcher(server, max_retries=2, backoff=0.001).pages())
+    assert len(server.requests) == 3
@@ -0,0 +1,42 @@
+import datetime
+
+import pytest
+
+from ckanext.dapr import cache, daputil, helpers
+
+
+@pytest.mark.usefixtures('accesses')
+def test_series_fills_gaps(day):
+    assert daputil.access_series(datetime.date(2020, 6, 1), datetime.date(2020, 6, 4), package_id='pkg-1') == [
+        (datetime.date(2020, 6, 1), 0),
+        (datetime.date(2020, 6, 2), 0),
+        (datetime.date(2020, 6, 3), 2),
+        (datetime.date(2020, 6, 4), 0),
+    ]
+    assert daputil.access_series(day, datetime.date(2020, 6, 10), 'week', resource_id='res-1') == [
+        (datetime.date(2020, 5, 18), 5),
+        (datetime.date(2020, 5, 25), 0),
+        (datetime.date(2020, 6, 1), 2),
+        (datetime.date(2020, 6, 8), 0),
+    ]
+    assert daputil.access_series(datetime.date(2020, 4, 1), datetime.date(2020, 7, 1), 'month') == [
+        (datetime.date(2020, 4, 1), 0),
+        (datetime.date(2020, 5, 1), 14),
+        (datetime.date(2020, 6, 1), 2),
+        (datetime.date(2020, 7, 1), 3),
+    ]
+
+
+@pytest.mark.usefixtures('accesses')
+def test_sparkline_cached_until_load():
+    sparkline = helpers.download_sparkline('pkg-1', days=14)
+    assert sparkline['end_date'] == '2020-07-01'
+    assert len(sparkline['counts']) == 14
+    assert sparkline['total'] == 3
+
+    daputil.update_access_counts([{'resource_id': 'res-1', 'package_id': 'pkg-1',
+        'date': datetime.date(2020, 6, 20), 'count': 10}])
+    assert helpers.download_sparkline('pkg-1', days=14) == sparkline
+
+    cache.invalidate()
+    assert helpers.download_sparkline('pkg-1', days=14)['total'] == 13
@@ -0,0 +1,91 @@
+import datetime
+
+import pytest
+
+import ckan.tests.factories as factories
+
+from ckanext.dapr import cache, daputil, plugin
+
+
+@pytest.mark.ckan_config('ckan.plugins', 'dapr')
+@pytest.mark.usefixtures('with_plugins', 'with_request_context')
+def test_top_datasets_cached_until_load(record):
+    popular = factories.Dataset(title='Popular', resources=[{'url': 'https://example.usa.gov/a.csv'}])
+    obscure = factories.Dataset(title='Obscure', resources=[{'url': 'https://example.usa.gov/b.csv'}])
+    record(popular, 50)
+    record(obscure, 5)
+    daputil.refresh_rollups()
+
+    top = plugin.top_datasets()
+    assert [(d['title'], d['count']) for d in top] == [('Popular', 50), ('Obscure', 5)]
+
+    record(obscure, 500)
+    daputil.refresh_rollups()
+    assert plugin.top_datasets() == top
+
+    cache.invalidate()
+    assert [d['title'] for d in plugin.top_datasets()] == ['Obscure', 'Popular']
+
+
+@pytest.mark.ckan_config('ckan.plugins', 'dapr')
+@pytest.mark.usefixtures('with_plugins')
+def test_top_page(app, record):
+    dataset = factories.Dataset(title='Popular', resources=[{'url': 'https://example.usa.gov/a.csv'}])
+    record(dataset, 50)
+    daputil.refresh_rollups()
+
+    response = app.get('/analytics/dataset/top')
+    assert 'Popular' in response.body
+
+
+def _accesses(package_id, counts, day):
+    # Daily counts for the days before and including day, latest last.
+    return [{'resource_id': f'{package_id}-res', 'package_id': package_id,
+        'date': day - datetime.timedelta(days=len(counts) - 1 - i), 'count': c}
+        for i, c in enumerate(counts)]
+
+
+@pytest.mark.usefixtures('dap_tables')
+def test_rankings(ckan_config, monkeypatch, day):
+    monkeypatch.setitem(ckan_config, 'ckanext.dapr.ranking_windows', '7 30')
+    monkeypatch.setitem(ckan_config, 'ckanext.dapr.trending_min_accesses', 10)
+    daputil.update_access_counts(
+        # Steady, and the most accessed.
+        _accesses('pkg-steady', [10] * 14, day) +
+        # Doubled over the latest week.
+        _accesses('pkg-rising', [2] * 7 + [4] * 7, day) +
+        # Grew tenfold, but too rarely accessed to trend.
+        _accesses('pkg-rare', [1] + [0] * 12 + [10 - 1], day) +
+        # Not accessed in the latest week.
+        _accesses('pkg-old', [50] + [0] * 13, day))
+    daputil.refresh_rankings()
+
+    assert [(r.package_id, r.access_count, r.previous_count) for r in daputil.ranked_packages(7)] == \
+        [('pkg-steady', 70, 70), ('pkg-rising', 28, 14), ('pkg-rare', 9, 1)]
+    assert [(r.package_id, r.growth) for r in daputil.ranked_packages(7, daputil.RANKING_TRENDING)] == \
+        [('pkg-rising', 1.0), ('pkg-steady', 0.0)]
+    assert [r.package_id for r in daputil.ranked_packages(7, number=1)] == ['pkg-steady']
+    assert [(r.package_id, r.access_count) for r in daputil.ranked_packages(30)] == \
+        [('pkg-steady', 140), ('pkg-old', 50), ('pkg-rising', 42), ('pkg-rare', 10)]
+    assert daputil.ranked_packages(30, daputil.RANKING_TRENDING) == []
+    assert daputil.ranked_packages(90) == []
+
+    # Refreshing replaces the previous rankings.
+    daputil.update_access_counts(_accesses('pkg-rising', [2] * 7 + [40] * 7, day))
+    daputil.refresh_rankings()
+    assert [r.package_id for r in daputil.ranked_packages(7)] == ['pkg-rising', 'pkg-steady', 'pkg-rare']
+
+
+@pytest.mark.ckan_config('ckan.plugins', 'dapr')
+@pytest.mark.usefixtures('with_plugins')
+def test_trending_page(app, record, day):
+    dataset = factories.Dataset(title='Rising', resources=[{'url': 'https://example.usa.gov/a.csv'}])
+    record(dataset, 10, day - datetime.timedelta(days=7))
+    record(dataset, 30)
+    daputil.refresh_downloads()
+
+    response = app.get('/analytics/dataset/top', query_string={'window': 7, 'ranking': 'trending'})
+    assert 'Rising' in response.body
+    assert '+200%' in response.body
+    app.get('/analytics/dataset/top', query_string={'window': 8}, status=404)
+    app.get('/analytics/dataset/top', query_string={'window': 7, 'ranking': 'bogus'}, status=400)